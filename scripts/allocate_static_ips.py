@@ -0,0 +1,357 @@
+"""
+Allocate the static_ips and add_nics_static_ips of a deployment from its subnets.
+
+The modules read both lists by position:
+
+    compute_instance   static_ips[<trailing number of the VM name> - 1]
+    add_nics           add_nics_static_ips[nic_index * len(vms) + vm_index]
+
+The allocator reads the deployment's JSON tfvars, keeps every address the lists already give a VM, and hands the
+lowest free addresses of the subnet to the VMs and NICs that have none.  --subnet is the primary subnet's CIDR, and
+--nic-subnet is given once per entry of additional_nics, in order.  Lists on the same subnet share its addresses, so
+a subnet given more than once never hands out an address twice.  The network, broadcast and first host (gateway)
+addresses of every subnet are never handed out, nor are the --reserved addresses, ranges or CIDRs, nor the addresses
+in the --used-file files (one per line, e.g. from `openstack port list -f value -c "Fixed IP Addresses"`).
+
+Growing the fleet with --vm-count (or --instance-name for deployments with explicit names) keeps every existing
+VM's addresses.  add_nics_static_ips is laid out again for the new number of VMs, so the existing addresses move to
+their new positions instead of shifting onto other VMs.  With --only-new, existing VMs without an address are left
+without one.
+
+The output is a var file with the lists, and vm_count or instance_names when they grew, to layer after the
+deployment's own var files:
+
+    python scripts/allocate_static_ips.py --var-file fleet.tfvars.json --subnet 10.0.0.0/22 \\
+        --nic-subnet 10.1.0.0/22 --reserved 10.0.0.2-10.0.0.20 --vm-count 1200 --output static-ips.tfvars.json
+    terraform apply -var-file=fleet.tfvars.json -var-file=static-ips.tfvars.json
+"""
+import argparse
+import bisect
+import ipaddress
+import json
+import sys
+
+from shard_fleet import VARIABLES_FILE, load_var_files, load_variable_defaults, name_index, vm_names
+
+
+def parse_range(value):
+    """
+    (first, last) address of "10.0.0.5", "10.0.0.0/28" or "10.0.0.10-10.0.0.20".
+    """
+    if "-" in value:
+        first, last = [ipaddress.ip_address(part.strip()) for part in value.split("-", 1)]
+    elif "/" in value:
+        network = ipaddress.ip_network(value, strict=False)
+        first, last = network.network_address, network.broadcast_address
+    else:
+        first = last = ipaddress.ip_address(value)
+    if first.version != last.version or first > last:
+        raise ValueError("invalid address range '%s'" % value)
+    return first, last
+
+
+def load_used(paths):
+    used = []
+    for path in paths:
+        with open(path, "r") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    used.append(ipaddress.ip_address(line))
+                except ValueError:
+                    raise ValueError("%s:%d: invalid address '%s'" % (path, line_number, line))
+    return used
+
+
+class AddressPool(object):
+    """
+    The free addresses of one subnet.  Addresses that may not be handed out are kept as intervals, sorted and merged
+    once before the first lookup; the free addresses are the gaps between them, handed out lowest first.  A pool of
+    n blocked ranges hands out m addresses in O(n log n + m).
+    """
+
+    def __init__(self, cidr, reserved=()):
+        self.network = ipaddress.ip_network(cidr, strict=False)
+        self.address = type(self.network.network_address)
+        self.first = int(self.network.network_address)
+        self.last = int(self.network.broadcast_address)
+        self.blocked = [(self.first, min(self.first + 1, self.last))]
+        if self.network.version == 4:
+            self.blocked.append((self.last, self.last))
+        self.starts = None
+        self.allocated = 0
+        for first, last in reserved:
+            self.block(first, last)
+
+    def __contains__(self, address):
+        return address.version == self.network.version and address in self.network
+
+    def block(self, first, last=None):
+        """
+        Never hand out the addresses first..last; the part outside the subnet is ignored.
+        """
+        last = first if last is None else last
+        if first.version != self.network.version:
+            return
+        first, last = max(int(first), self.first), min(int(last), self.last)
+        if first <= last:
+            if self.allocated:
+                raise RuntimeError("addresses are blocked after the first allocation")
+            self.blocked.append((first, last))
+            self.starts = None
+
+    def index(self):
+        merged = []
+        for first, last in sorted(self.blocked):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        self.blocked = merged
+        self.starts = [first for first, _ in merged]
+        self.cursor = 0
+        self.next_free = self.first
+
+    def is_blocked(self, address):
+        if self.starts is None:
+            self.index()
+        position = bisect.bisect_right(self.starts, int(address)) - 1
+        return position >= 0 and int(address) <= self.blocked[position][1]
+
+    def allocate(self):
+        if self.starts is None:
+            self.index()
+        while self.cursor < len(self.blocked) and self.blocked[self.cursor][1] < self.next_free:
+            self.cursor += 1
+        if self.cursor < len(self.blocked) and self.blocked[self.cursor][0] <= self.next_free:
+            self.next_free = self.blocked[self.cursor][1] + 1
+            self.cursor += 1
+        if self.next_free > self.last:
+            raise ValueError("subnet %s has no free addresses left" % self.network)
+        self.next_free += 1
+        self.allocated += 1
+        return self.address(self.next_free - 1)
+
+    def free(self):
+        if self.starts is None:
+            self.index()
+        blocked = sum(last - first + 1 for first, last in self.blocked)
+        return self.last - self.first + 1 - blocked - self.allocated
+
+
+class Allocator(object):
+    """
+    The addresses of every VM (by name) and of every VM's NICs, read from the current lists and completed from the
+    pools.  The primary and NIC pools may be the same pool when they are on one subnet.  `warnings` lists the VMs that
+    get no static IP.
+    """
+
+    def __init__(self, variables, names, primary_pool=None, nic_pools=()):
+        self.variables = variables
+        self.old_names = vm_names(variables)
+        self.names = names
+        self.primary_pool = primary_pool
+        self.nic_pools = list(nic_pools)
+        self.nic_total = len(variables.get("additional_nics") or [])
+        if self.nic_pools and len(self.nic_pools) != self.nic_total:
+            raise ValueError("expected one --nic-subnet per additional_nics entry (%d), got %d" % (self.nic_total, len(self.nic_pools)))
+
+        self.static_ips = list(variables.get("static_ips") or [])
+        self.indexes, self.warnings = self.primary_indexes()
+        self.primary = {}
+        for name, index in self.indexes.items():
+            if index < len(self.static_ips) and self.static_ips[index]:
+                self.primary[name] = self.static_ips[index]
+        self.nics = self.nic_addresses()
+
+    def primary_indexes(self):
+        """
+        {VM name: static_ips position}, and the warnings for the VMs without one.
+        """
+        indexes = {}
+        readers = {}
+        warnings = []
+        for name in self.names:
+            index = name_index(name)
+            if index is None:
+                warnings.append("VM '%s' has no trailing number and gets no static IP" % name)
+                continue
+            if index in readers:
+                raise ValueError("VMs '%s' and '%s' both read static_ips[%d]" % (readers[index], name, index))
+            readers[index] = name
+            indexes[name] = index
+        return indexes, warnings
+
+    def nic_addresses(self):
+        """
+        {(VM name, NIC index): address} from add_nics_static_ips as laid out for the current VMs.
+        """
+        current = list(self.variables.get("add_nics_static_ips") or [])
+        nics = {}
+        for nic_index in range(self.nic_total):
+            for vm_index, name in enumerate(self.old_names):
+                position = nic_index * len(self.old_names) + vm_index
+                if position < len(current) and current[position]:
+                    nics[(name, nic_index)] = current[position]
+        return nics
+
+    def assignments(self):
+        """
+        (what, pool, [(VM name, address)]) of static_ips and of every NIC's addresses.
+        """
+        lists = [("static_ips", self.primary_pool, sorted(self.primary.items()))]
+        for nic_index in range(self.nic_total):
+            pool = self.nic_pools[nic_index] if self.nic_pools else None
+            assignments = sorted((name, value) for (name, index), value in self.nics.items() if index == nic_index)
+            lists.append(("NIC %d" % nic_index, pool, assignments))
+        return lists
+
+    def claim(self, new_names):
+        """
+        Block the addresses already assigned in every list in its pool, before any is handed out.  They must be in the
+        pool's subnet and assigned only once across the lists sharing the pool, and those of VMs not deployed yet must
+        not be reserved or in use.
+        """
+        owners = {}
+        for what, pool, assignments in self.assignments():
+            for name, value in assignments:
+                address = ipaddress.ip_address(value)
+                key = (pool.network if pool is not None else what, address)
+                if key in owners:
+                    raise ValueError("%s is assigned to both %s and %s of %s" % (value, owners[key], what, name))
+                owners[key] = "%s of %s" % (what, name)
+                if pool is None:
+                    continue
+                if address not in pool:
+                    raise ValueError("%s of %s: %s is not in %s" % (what, name, value, pool.network))
+                if name in new_names and pool.is_blocked(address):
+                    raise ValueError("%s of new VM %s: %s is reserved or already in use" % (what, name, value))
+        for _, pool, assignments in self.assignments():
+            for _, value in assignments:
+                if pool is not None:
+                    pool.block(ipaddress.ip_address(value))
+
+    def allocate(self, only_new=False):
+        """
+        Give every VM and NIC without an address the next free address of its pool; returns how many were handed out.
+        """
+        new_names = set(self.names) - set(self.old_names)
+        self.claim(new_names)
+
+        allocated = 0
+        for name in self.names:
+            if name in self.indexes and name not in self.primary and (name in new_names or not only_new):
+                if self.primary_pool is None:
+                    raise ValueError("VM '%s' needs a static IP, pass --subnet" % name)
+                self.primary[name] = str(self.primary_pool.allocate())
+                allocated += 1
+        for nic_index, pool in enumerate(self.nic_pools):
+            for name in self.names:
+                if (name, nic_index) not in self.nics and (name in new_names or not only_new):
+                    self.nics[(name, nic_index)] = str(pool.allocate())
+                    allocated += 1
+        return allocated
+
+    def layout(self):
+        """
+        static_ips and add_nics_static_ips in the positions the modules read for the VMs in `names`.
+        """
+        static_ips = list(self.static_ips)
+        for name, address in self.primary.items():
+            index = self.indexes[name]
+            static_ips.extend([""] * (index + 1 - len(static_ips)))
+            static_ips[index] = address
+
+        add_nics_static_ips = [self.nics.get((name, nic_index), "") for nic_index in range(self.nic_total) for name in self.names]
+        while add_nics_static_ips and not add_nics_static_ips[-1]:
+            add_nics_static_ips.pop()
+        return static_ips, add_nics_static_ips
+
+
+def grown_names(variables, vm_count=None, instance_names=()):
+    """
+    The VM names after growing the deployment: existing VMs keep their names and positions.
+    """
+    names = vm_names(variables)
+    if variables.get("use_name_formatting", True):
+        if instance_names:
+            raise ValueError("--instance-name needs use_name_formatting = false, use --vm-count")
+        if vm_count is not None:
+            if vm_count < len(names):
+                raise ValueError("--vm-count %d is less than the current vm_count %d" % (vm_count, len(names)))
+            names = vm_names(dict(variables, vm_count=vm_count))
+    elif vm_count is not None:
+        raise ValueError("--vm-count needs use_name_formatting = true, use --instance-name")
+    else:
+        names = vm_names(dict(variables, instance_names=names + list(instance_names)))
+    return names
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Allocate static_ips and add_nics_static_ips for a deployment.")
+    parser.add_argument("--var-file", action="append", required=True, help="JSON tfvars of the deployment, repeat to layer them")
+    parser.add_argument("--variables-file", default=VARIABLES_FILE, help="variables.tf with the defaults (default: the root module's)")
+    parser.add_argument("--subnet", metavar="CIDR", help="CIDR of the primary subnet (subnet_name)")
+    parser.add_argument("--nic-subnet", action="append", default=[], metavar="CIDR", help="CIDR of the subnet of each additional_nics entry, in order")
+    parser.add_argument("--reserved", action="append", default=[], metavar="RANGE", help="Address, CIDR or first-last range never to hand out")
+    parser.add_argument("--used-file", action="append", default=[], metavar="path", help="File of addresses already in use, one per line")
+    parser.add_argument("--vm-count", type=int, help="Grow a deployment using name formatting to this many VMs")
+    parser.add_argument("--instance-name", action="append", default=[], help="Add a VM to a deployment with explicit instance_names")
+    parser.add_argument("--only-new", action="store_true", help="Only allocate for VMs added by --vm-count or --instance-name")
+    parser.add_argument("--output", metavar="path", help="Write the var file to this file (default: stdout)")
+    return parser.parse_args(args)
+
+
+def main(args):
+    options = parse_args(args)
+    try:
+        variables = load_variable_defaults(options.variables_file)
+        variables.update(load_var_files(options.var_file))
+        reserved = [parse_range(value) for value in options.reserved]
+        used = load_used(options.used_file)
+
+        pools = {}
+        for cidr in ([options.subnet] if options.subnet else []) + options.nic_subnet:
+            network = ipaddress.ip_network(cidr, strict=False)
+            if network not in pools:
+                pools[network] = AddressPool(cidr, reserved)
+                for address in used:
+                    pools[network].block(address)
+        primary_pool = pools[ipaddress.ip_network(options.subnet, strict=False)] if options.subnet else None
+        nic_pools = [pools[ipaddress.ip_network(cidr, strict=False)] for cidr in options.nic_subnet]
+
+        names = grown_names(variables, options.vm_count, options.instance_name)
+        allocator = Allocator(variables, names, primary_pool, nic_pools)
+        allocated = allocator.allocate(options.only_new)
+        static_ips, add_nics_static_ips = allocator.layout()
+    except (IOError, OSError, ValueError) as err:
+        print("Error: %s" % err, file=sys.stderr)
+        return 1
+
+    for warning in allocator.warnings:
+        print("Warning: %s" % warning, file=sys.stderr)
+
+    tfvars = {"static_ips": static_ips, "add_nics_static_ips": add_nics_static_ips}
+    if names != vm_names(variables):
+        if variables.get("use_name_formatting", True):
+            tfvars["vm_count"] = len(names)
+        else:
+            tfvars["instance_names"] = names
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(tfvars, f, indent=2)
+            f.write("\n")
+    else:
+        print(json.dumps(tfvars, indent=2))
+
+    summary = ["%d VMs, %d addresses allocated" % (len(names), allocated)]
+    for network, pool in pools.items():
+        summary.append("%s: %d free" % (network, pool.free()))
+    print("; ".join(summary), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
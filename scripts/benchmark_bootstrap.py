@@ -0,0 +1,212 @@
+"""
+End-to-end latency benchmark for bootstrap.py against local stand-in services.
+
+The benchmark starts the stand-in services from stand_ins.py (OpenStack vendordata, the Platform Services activation
+and job API and the installer host), creates a fake guest root with stub agent and package binaries on PATH, and then
+runs `bootstrap.main()` in-process for the requested commands.  The wall time of every run and of every traced phase is reported as p50/p95.
+
+With --import-time it instead measures `import bootstrap` in fresh interpreters, less the interpreter startup, and
+fails if the import created any file.
+
+Example:
+
+    python scripts/benchmark_bootstrap.py --iterations 20 --job-seconds 2 --bandwidth 5000000
+    python scripts/benchmark_bootstrap.py --import-time --iterations 50
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from stand_ins import SCRIPTS_DIR, FakeServices, create_guest_root, load_bootstrap, patch_endpoints
+
+COMMANDS = ("install", "reregister", "uninstall")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class Benchmark(object):
+    def __init__(self, options):
+        self.options = options
+        self.work_dir = tempfile.mkdtemp(prefix="bootstrap-benchmark-")
+        self.guest_root = os.path.join(self.work_dir, "root")
+        self.services = FakeServices(
+            job_seconds=options.job_seconds,
+            bandwidth=options.bandwidth,
+            installer_size=options.installer_size,
+            latency=options.latency / 1000.0,
+        )
+        self.samples = dict((command, {}) for command in COMMANDS)
+        self.failures = []
+
+    def load_bootstrap(self):
+        bootstrap = load_bootstrap()
+        bootstrap.logger.handlers = [logging.NullHandler()]
+        patch_endpoints(bootstrap, self.services.base_url)
+        return bootstrap
+
+    def reset(self, bootstrap):
+        """
+        Give every run the per-process state a fresh `python bootstrap.py` invocation would start with.
+        """
+        bootstrap.tracer = bootstrap.Tracer()
+        bootstrap.GuestOs.facts = bootstrap.GuestFacts()
+        bootstrap.Platform.metadata = bootstrap.MetadataCache()
+        bootstrap.journal = bootstrap.Journal()
+        bootstrap.CommandRunner.history = []
+        if self.options.cold_cache:
+            # main() has not set the guest root yet on the first run, so the guest path is not resolved by bootstrap.
+            shutil.rmtree(os.path.join(self.guest_root, bootstrap.INSTALLER_CACHE_DIR.lstrip("/")), ignore_errors=True)
+
+    def run_command(self, bootstrap, command):
+        argv = ["--guest-root", self.guest_root, command]
+        if command in ("install", "reregister"):
+            argv += ["--platform", "openstack"]
+        argv += ["--platform-services-base-url", self.services.base_url]
+
+        self.reset(bootstrap)
+        started_at = time.time()
+        try:
+            bootstrap.main(argv)
+            exitcode = 0
+        except SystemExit as err:
+            exitcode = err.code
+        wall = time.time() - started_at
+
+        if exitcode:
+            self.failures.append((command, exitcode))
+        samples = self.samples[command]
+        samples.setdefault("wall", []).append(wall)
+        for phase, duration in bootstrap.tracer.phase_durations().items():
+            samples.setdefault(phase, []).append(duration)
+
+    def run(self):
+        os.environ["PATH"] = os.pathsep.join([create_guest_root(self.guest_root), os.environ.get("PATH", "")])
+        os.environ["STUB_INSTALL_SECONDS"] = str(self.options.install_seconds)
+        os.environ["STUB_REGISTER_SECONDS"] = str(self.options.register_seconds)
+        self.services.start()
+        try:
+            bootstrap = self.load_bootstrap()
+            for _ in range(self.options.iterations):
+                for command in self.options.commands:
+                    self.run_command(bootstrap, command)
+        finally:
+            self.services.stop()
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        return self.report()
+
+    def report(self):
+        report = {"iterations": self.options.iterations, "failures": self.failures, "commands": {}}
+        for command in self.options.commands:
+            phases = {}
+            for phase, values in self.samples[command].items():
+                phases[phase] = {"runs": len(values), "p50": round(percentile(values, 0.5), 4), "p95": round(percentile(values, 0.95), 4)}
+            report["commands"][command] = phases
+        return report
+
+
+def measure_import(iterations):
+    """
+    Time `import bootstrap` in fresh interpreters against bare interpreter startup, in an empty working directory that
+    must still be empty afterwards.
+    """
+    work_dir = tempfile.mkdtemp(prefix="bootstrap-import-")
+    statements = {"startup": "pass", "import": "import sys; sys.path.insert(0, %r); import bootstrap" % SCRIPTS_DIR}
+    samples = dict((name, []) for name in statements)
+    try:
+        for _ in range(iterations):
+            for name, statement in statements.items():
+                started_at = time.time()
+                subprocess.check_call([sys.executable, "-c", statement], cwd=work_dir)
+                samples[name].append(time.time() - started_at)
+        created_files = sorted(os.listdir(work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    startup = percentile(samples["startup"], 0.5)
+    imports = [max(0.0, sample - startup) for sample in samples["import"]]
+    return {
+        "iterations": iterations,
+        "startup": {"p50": round(startup, 4), "p95": round(percentile(samples["startup"], 0.95), 4)},
+        "import": {"p50": round(percentile(imports, 0.5), 4), "p95": round(percentile(imports, 0.95), 4)},
+        "created_files": created_files,
+    }
+
+
+def format_import_report(report):
+    lines = ["import bootstrap (%d iterations)" % report["iterations"], "  %-24s %10s %10s" % ("", "p50 (s)", "p95 (s)")]
+    for name in ("startup", "import"):
+        lines.append("  %-24s %10.4f %10.4f" % (name, report[name]["p50"], report[name]["p95"]))
+    if report["created_files"]:
+        lines.append("Importing bootstrap created files: %s" % ", ".join(report["created_files"]))
+    return "\n".join(lines)
+
+
+def format_report(report):
+    lines = []
+    for command, phases in report["commands"].items():
+        lines.append("%s (%d iterations)" % (command, report["iterations"]))
+        lines.append("  %-24s %10s %10s %6s" % ("phase", "p50 (s)", "p95 (s)", "runs"))
+        ordered = sorted(phases.items(), key=lambda item: (item[0] != "wall", -item[1]["p50"]))
+        for phase, stats in ordered:
+            lines.append("  %-24s %10.4f %10.4f %6d" % (phase, stats["p50"], stats["p95"], stats["runs"]))
+        lines.append("")
+    if report["failures"]:
+        lines.append("Failed runs (command, exit code): %s" % report["failures"])
+    return "\n".join(lines)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmark bootstrap.py against local stand-in services.")
+    parser.add_argument("--iterations", type=int, default=10, help="Runs of every command (default: 10)")
+    parser.add_argument(
+        "--commands",
+        type=lambda value: [command for command in value.split(",") if command],
+        default=list(COMMANDS),
+        help="Comma separated commands to run per iteration, in order (default: install,reregister,uninstall)",
+    )
+    parser.add_argument("--job-seconds", type=float, default=1.0, help="Seconds an activation job stays RUNNING (default: 1)")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Installer download bandwidth in bytes per second, 0 for unthrottled")
+    parser.add_argument("--installer-size", type=int, default=20 * 1024 * 1024, help="Installer size in bytes (default: 20 MiB)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Milliseconds of latency added to every request")
+    parser.add_argument("--install-seconds", type=float, default=0.5, help="Seconds the stub package install takes")
+    parser.add_argument("--register-seconds", type=float, default=0.1, help="Seconds the stub agent registration takes")
+    parser.add_argument("--cold-cache", action="store_true", help="Clear the installer cache before every run")
+    parser.add_argument("--import-time", action="store_true", help="Only measure the time it takes to import bootstrap")
+    parser.add_argument("--json", dest="json_file", metavar="path", help="Also write the report as JSON to this file")
+    options = parser.parse_args(args)
+    unknown = [command for command in options.commands if command not in COMMANDS]
+    if unknown:
+        parser.error("unknown commands: %s" % ", ".join(unknown))
+    return options
+
+
+def main(args):
+    options = parse_args(args)
+    if options.import_time:
+        report = measure_import(options.iterations)
+        print(format_import_report(report))
+        failed = bool(report["created_files"])
+    else:
+        report = Benchmark(options).run()
+        print(format_report(report))
+        failed = bool(report["failures"])
+    if options.json_file:
+        with open(options.json_file, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,27 @@
 # Version: 2.0 (578d03a6632b46c13c46f36390507eba57abbf44)
-import argparse
+import copy
 import datetime
+import functools
+import hashlib
+import io
 import json
 import logging
 import os
+import random
+import select
+import ssl
 import subprocess
 import sys
-import tempfile
+import threading
 import time
-from argparse import RawTextHelpFormatter
+import zlib
 from contextlib import contextmanager
 import shutil
 
 HTTP_PROXY = None
+LOG_FILE = "agent_bootstrap.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
 
 EXIT_CODES = {
     "100": "Failed to install Package 'amazon-ssm-agent'",
@@ -26,7 +35,7 @@ EXIT_CODES = {
     "108": "POST request to activation url failed.",
     "109": "POST request to activation url did not return a Location header.",
     "110": "Failed to execute agent registration command.",
-    "111": "Failed to execute agent diagnostics command.",
+    "111": "Reserved, no longer returned: a failed agent diagnostics command is reported in the diagnostics of the result instead.",
     "112": "Management agent was not registered successfully.",
     "113": "'ssm-cli' command does not exist",
     "114": "Failed to execute clear agent registration command",
@@ -50,10 +59,14 @@ EXIT_CODES = {
     "132": "Operating system is not unsupported.",
     "137": "Installation cannot continue because 'vmtoolsd' is not installed, please install 'vmtoolsd' before continuing",
     "138": "Failed to get token from OpenStack vendordata. The underlying API might have an outage.",
+    "139": "Downloaded agent package installer did not match the expected SHA-256 digest.",
+    "140": "Installer source manifest could not be read or is invalid.",
+    "141": "Installer source manifest has no SSM Agent installer for this distribution and architecture.",
 }
-SORTED_EXIT_CODES = sorted(EXIT_CODES.items(), key=lambda exit_code: exit_code[0])
 
-EXIT_CODES_FOR_EPILOG = "\n".join([": ".join(exit_code) for exit_code in SORTED_EXIT_CODES])
+
+def exit_codes_epilog():
+    return "\n".join([": ".join(exit_code) for exit_code in sorted(EXIT_CODES.items(), key=lambda exit_code: exit_code[0])])
 
 
 def is_python2():
@@ -71,37 +84,159 @@ def as_text(message, level="DEBUG"):
     return "[%s] %s - %s" % (current_timestamp, level, message)
 
 
-def as_json(message, details, level="DEBUG"):
-    return {"timestamp": get_timestamp(), "level": "%s" % (level), "message": "%s" % (message), "details": "%s" % (details)}
+def as_json(message, details, level="DEBUG", phases=None, diagnostics=None):
+    result = {"timestamp": get_timestamp(), "level": "%s" % (level), "message": "%s" % (message), "details": "%s" % (details)}
+    if phases:
+        result["phases"] = phases
+    if diagnostics:
+        result["diagnostics"] = diagnostics
+    return result
+
+
+class LogFormatter(logging.Formatter):
+    """
+    The log line format.  With `bare_results`, result records (see `log_result()`) marked bare are written as their
+    message alone.
+    """
+
+    def __init__(self, bare_results=False):
+        logging.Formatter.__init__(self, fmt="[%(asctime)s.%(msecs)03d] %(levelname)-5s - %(message)s", datefmt="%Y-%m-%dT%H:%M:%S")
+        self.converter = time.gmtime
+        self.bare_results = bare_results
+
+    def format(self, record):
+        if self.bare_results and getattr(record, "bare", False):
+            return record.getMessage()
+        return logging.Formatter.format(self, record)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    One JSON object per record; a result record carries the result dict itself.
+    """
+
+    def format(self, record):
+        timestamp = "%s.%03dZ" % (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)), record.msecs)
+        entry = {"timestamp": timestamp, "level": record.levelname, "thread": record.threadName, "message": record.getMessage()}
+        if getattr(record, "result", None):
+            entry["result"] = record.result
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
 
+class ConsoleLevelFilter(logging.Filter):
+    """
+    Drops records below `level` from stdout, except result records (see `log_result()`).  The log files keep every
+    record for post-mortems.
+    """
+
+    def __init__(self, level=logging.DEBUG):
+        logging.Filter.__init__(self)
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level or hasattr(record, "result")
+
+
+class RotatingLogFile(logging.FileHandler):
+    """
+    Log file that is rotated once it grows beyond `max_bytes`, keeping `backup_count` gzip compressed rotations
+    (".1.gz" is the newest).  The file is only created by the first record.
+    """
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        logging.FileHandler.__init__(self, filename, delay=True)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def emit(self, record):
+        if self.max_bytes and self.stream is not None and self.stream.tell() >= self.max_bytes:
+            self.rotate()
+        logging.FileHandler.emit(self, record)
+
+    def rotate(self):
+        import gzip
+
+        self.stream.close()
+        self.stream = None
+        for index in range(self.backup_count - 1, 0, -1):
+            rotated = "%s.%d.gz" % (self.baseFilename, index)
+            if os.path.exists(rotated):
+                os.rename(rotated, "%s.%d.gz" % (self.baseFilename, index + 1))
+        if self.backup_count:
+            with open(self.baseFilename, "rb") as source:
+                target = gzip.open("%s.1.gz" % self.baseFilename, "wb")
+                try:
+                    shutil.copyfileobj(source, target)
+                finally:
+                    target.close()
+        os.remove(self.baseFilename)
+
+
+def setup_logger(json_file=None):
+    """
+    Attach the rotating log file and stdout handlers, and a JSON lines file with `json_file`.  Called by `main()`
+    rather than at import, so importing the module does no I/O; a caller that configured handlers of its own keeps
+    them.
 
-def setup_logger():
+    On Python 3 the logger only puts records on a queue and a background thread writes them, so slow disks and
+    terminals, and the compression of a rotated file, do not hold up the run.  Python 2 lacks QueueHandler, there the
+    handlers write directly.
+    """
+    global log_listener
+    _logger = logging.getLogger(__name__)
+    if _logger.handlers:
+        return _logger
     logging.addLevelName(logging.WARNING, "WARN")
     logging.addLevelName(logging.CRITICAL, "CRIT")
 
-    formatter = logging.Formatter(
-        fmt="[%(asctime)s.%(msecs)03d] %(levelname)-5s - %(message)s",
-        datefmt="%Y-%m-%dT%H:%M:%S",
-    )
-    formatter.converter = time.gmtime
-
-    logs_fh = logging.FileHandler("agent_bootstrap.log")
-    logs_fh.setLevel(logging.DEBUG)
-    logs_fh.setFormatter(formatter)
+    logs_fh = RotatingLogFile(LOG_FILE)
+    logs_fh.setFormatter(LogFormatter())
     logs_fh.set_name("agent_bootstrap_logs")
 
     logs_sh = logging.StreamHandler(stream=sys.stdout)
-    logs_sh.setLevel(logging.DEBUG)
-    logs_sh.setFormatter(formatter)
+    logs_sh.setFormatter(LogFormatter(bare_results=True))
     logs_sh.set_name("agent_bootstrap_stream_logs")
+    logs_sh.addFilter(console_filter)
+
+    handlers = [logs_fh, logs_sh]
+    if json_file:
+        logs_jh = RotatingLogFile(json_file)
+        logs_jh.setFormatter(JsonLinesFormatter())
+        logs_jh.set_name("agent_bootstrap_json_logs")
+        handlers.append(logs_jh)
 
-    _logger = logging.getLogger(__name__)
     _logger.setLevel(logging.DEBUG)
-    _logger.addHandler(logs_fh)
-    _logger.addHandler(logs_sh)
+    if is_python2():
+        for handler in handlers:
+            _logger.addHandler(handler)
+        return _logger
+
+    import atexit
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+
+    records = queue.Queue()
+    log_listener = QueueListener(records, *handlers)
+    log_listener.start()
+    atexit.register(stop_logging)
+    _logger.addHandler(QueueHandler(records))
     return _logger
 
 
+def stop_logging():
+    """
+    Write out the queued records and stop the background writer, later records are written directly.
+    """
+    global log_listener
+    if log_listener is None:
+        return
+    listener, log_listener = log_listener, None
+    logger.handlers = list(listener.handlers)
+    listener.stop()
+
+
 class Enum(object):
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
@@ -117,6 +252,7 @@ class Enum(object):
 
 
 if is_python2():
+    from pipes import quote as quote_argument
     from urlparse import urlparse
     from httplib import (  # noqa: F401
         HTTPSConnection,
@@ -125,6 +261,7 @@ if is_python2():
         HTTPResponse,
     )
 else:
+    from shlex import quote as quote_argument
     from urllib.parse import urlparse
     from http.client import (  # noqa: F401
         HTTPSConnection,
@@ -139,27 +276,66 @@ IGNORE_TAG_KEY = "rackspace-addon-ignore"
 PLATFORMS = Enum(GCP="gcp", AZURE="azure", VMWARE="vmware", DEDICATED="dedicated", OPENSTACK_FLEX="openstack_flex", OPENSTACK="openstack")
 PLATFORM_SERVICES_BASE_URL = "https://add-ons.api.manage.rackspace.com"
 SSM_SERVICE = "amazon-ssm-agent"
-REGISTRATION_WAIT = 10
-logger = setup_logger()
+REGISTRATION_TIMEOUT = 120
+REGISTRATION_POLL_INTERVAL = 0.5
+AGENT_REGISTRATION_FILE = "/var/lib/amazon/ssm/registration"
+GUEST_ROOT = "/"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+INSTALLER_CACHE_DIR = "/var/cache/rackspace/ssm-bootstrap/installers"
+INSTALLER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+INSTALLER_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+INSTALLER_PROBE_TIMEOUT = 3
+HTTP_CACHE_DIR = "/var/cache/rackspace/ssm-bootstrap/metadata"
+HTTP_CACHE_MAX_AGE = 24 * 60 * 60
+# Metadata documents without credentials, the only ones kept on disk between runs (GCP attributes, Azure compute).
+HTTP_CACHE_URLS = (
+    "http://metadata.google.internal/computeMetadata/v1/instance/attributes/",
+    "http://169.254.169.254/metadata/instance/compute",
+)
+COMMAND_TIMEOUT = 60
+DIAGNOSTICS_TIMEOUT = 30
+COMMAND_OUTPUT_LIMIT = 1024 * 1024
+PACKAGE_COMMAND_TIMEOUT = 600
+JOURNAL_FILE = "/var/lib/rackspace/ssm-bootstrap/journal.json"
+ACTIVATION_MAX_AGE = 60 * 60
+logger = logging.getLogger(__name__)
+log_listener = None
+console_filter = ConsoleLevelFilter()
 result_format = "text"
 result_delimiter = "".join(["-" * 25, "%s", "-" * 25])
 
 
 def set_log_level(log_level):
-    for handler in logger.handlers:
-        if handler.name == "stderr":
-            handler.setLevel(log_level)
+    """
+    Records below `log_level` are not written to stdout, the log files are always written at DEBUG.
+    """
+    console_filter.level = logging.WARNING if log_level == "WARN" else getattr(logging, log_level)
+
+
+def log_result(level, result):
+    """
+    Log a result line even when --log-level is above `level`.  With the json result format it is written to stdout
+    without the log line prefix, so it can be parsed.
+    """
+    extra = {"bare": result_format == "json", "result": result if isinstance(result, dict) else None}
+    logger.handle(logger.makeRecord(logger.name, level, "(result)", 0, result, None, None, extra=extra))
 
 
 def command_exists(prog):
-    if is_python2():
-        from distutils.spawn import find_executable
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory, prog)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
 
-        return find_executable(prog)
-    else:
-        from shutil import which
 
-        return which(prog)
+def guest_path(path):
+    """
+    Absolute guest paths are resolved below GUEST_ROOT, which lets the script run against a fake root filesystem.
+    """
+    if GUEST_ROOT == "/" or not os.path.isabs(path):
+        return path
+    return os.path.join(GUEST_ROOT, path.lstrip("/"))
 
 
 def file_exists(path):
@@ -190,14 +366,210 @@ def is_truthy(value):
     return isinstance(value, str) and value.lower() in ("t", "true", "y", "yes", "1")
 
 
-def run_command(cmd):
-    return subprocess.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True, shell=True)
+class Tracer(object):
+    """
+    Collects named, nested spans covering the bootstrap phases, HTTP requests and commands.
+
+    Spans nest per thread and carry attributes such as attempt counts, bytes and statuses; `annotate()` adds
+    attributes to the innermost open span of the calling thread.  Spans can be exported as Chrome trace-event JSON
+    (load the file in chrome://tracing or Perfetto) and summarized as per-phase durations.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_at = time.time()
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, category="phase", **attributes):
+        stack = self.stack()
+        span = {"name": name, "category": category, "start": time.time(), "end": None, "tid": threading.current_thread().ident, "args": attributes}
+        with self.lock:
+            self.spans.append(span)
+        stack.append(span)
+        try:
+            yield span["args"]
+        except SystemExit as err:
+            span["args"]["exitcode"] = err.code
+            raise
+        except BaseException as err:
+            span["args"]["error"] = "%s: %s" % (type(err).__name__, err)
+            raise
+        finally:
+            span["end"] = time.time()
+            stack.pop()
+
+    def record(self, name, category, start, end, **attributes):
+        """
+        Add a span that has already completed, for work timed outside of `span()` such as event loop callbacks.
+        """
+        with self.lock:
+            self.spans.append({"name": name, "category": category, "start": start, "end": end, "tid": threading.current_thread().ident, "args": attributes})
+
+    def annotate(self, **attributes):
+        stack = self.stack()
+        if stack:
+            stack[-1]["args"].update(attributes)
+
+    def phase_durations(self):
+        """
+        Seconds spent per phase, open phases included up to now.
+        """
+        now = time.time()
+        durations = {}
+        with self.lock:
+            for span in self.spans:
+                if span["category"] == "phase":
+                    durations[span["name"]] = round(durations.get(span["name"], 0) + (span["end"] or now) - span["start"], 3)
+        return durations
+
+    def chrome_trace(self):
+        now = time.time()
+        events = []
+        with self.lock:
+            for span in self.spans:
+                events.append(
+                    {
+                        "name": span["name"],
+                        "cat": span["category"],
+                        "ph": "X",
+                        "ts": int((span["start"] - self.started_at) * 1000000),
+                        "dur": int(((span["end"] or now) - span["start"]) * 1000000),
+                        "pid": os.getpid(),
+                        "tid": span["tid"],
+                        "args": dict((key, "%s" % value) for (key, value) in span["args"].items()),
+                    }
+                )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path):
+        file_write(json.dumps(self.chrome_trace()), path)
+        logger.debug("Wrote trace with %d spans to %s", len(self.spans), path)
+
+
+tracer = Tracer()
+
+
+def traced(name, category="phase"):
+    """
+    Decorator running the decorated function inside a tracer span.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, category=category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def command_line(argv):
+    return " ".join(quote_argument(arg) for arg in argv)
+
+
+class CommandRunner(object):
+    """
+    Runs commands from an argv list without a shell, with a timeout and a cap on the output that is kept.
+
+    Output is read as it is produced and, when `stream` is set, logged line by line.  Failures raise
+    subprocess.CalledProcessError (CommandRunner.Timeout when the command was killed after `timeout` seconds) and
+    every command's exit code and wall time is recorded in `history`.
+    """
+
+    history = []
+
+    class Timeout(subprocess.CalledProcessError):
+        pass
+
+    @classmethod
+    def run(cls, argv, timeout=COMMAND_TIMEOUT, stream=False, output_limit=COMMAND_OUTPUT_LIMIT):
+        argv = list(argv)
+        with tracer.span(os.path.basename(argv[0]), category="command", argv=command_line(argv)) as span:
+            result, returncode, timed_out = cls.execute(argv, timeout, stream, output_limit)
+            span.update(returncode=returncode, timed_out=timed_out, output_bytes=len(result))
+        if timed_out:
+            raise CommandRunner.Timeout(returncode, command_line(argv), output="%s\n[command timed out after %g seconds]" % (result, timeout))
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command_line(argv), output=result)
+        return result
+
+    @classmethod
+    def execute(cls, argv, timeout, stream, output_limit):
+        started_at = time.time()
+        try:
+            process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        except OSError as err:
+            raise subprocess.CalledProcessError(127, command_line(argv), output="%s: %s" % (argv[0], err))
+
+        output = {"lines": [], "size": 0, "truncated": False}
+        reader = threading.Thread(target=cls.read_output, args=(argv, process.stdout, output, stream, output_limit))
+        reader.daemon = True
+        reader.start()
+
+        returncode = cls.wait(process, timeout)
+        timed_out = returncode is None
+        if timed_out:
+            process.kill()
+            returncode = process.wait()
+        # A daemon started by the command may keep its output pipe open, so only wait briefly for the remaining output.
+        reader.join(1)
+
+        duration = time.time() - started_at
+        cls.history.append({"argv": argv, "returncode": returncode, "duration": duration, "timed_out": timed_out})
+        logger.debug("Command %s exited with %d after %.2f seconds", command_line(argv), returncode, duration)
+
+        result = "".join(output["lines"])
+        if output["truncated"]:
+            result += "\n[output truncated after %d bytes]" % output_limit
+        return result, returncode, timed_out
+
+    @staticmethod
+    def wait(process, timeout):
+        """
+        Wait for `process` to exit, returning its exit code, or None if it is still running after `timeout` seconds.
+        """
+        if not is_python2():
+            try:
+                return process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                return None
+        deadline = time.time() + timeout
+        while process.poll() is None:
+            if time.time() > deadline:
+                return None
+            time.sleep(0.05)
+        return process.returncode
+
+    @staticmethod
+    def read_output(argv, pipe, output, stream, output_limit):
+        for line in iter(pipe.readline, ""):
+            if output["size"] + len(line) > output_limit:
+                output["truncated"] = True
+                continue
+            output["lines"].append(line)
+            output["size"] += len(line)
+            if stream:
+                logger.debug("[%s] %s", os.path.basename(argv[0]), line.rstrip())
+        pipe.close()
+
+
+def run_command(argv, timeout=COMMAND_TIMEOUT, stream=False):
+    return CommandRunner.run(argv, timeout=timeout, stream=stream)
 
 
 def format_command_error(cmd, err):
     return "\n".join(
         [
-            "Failed command: %s" % cmd,
+            "Failed command: %s" % command_line(cmd),
             "ExitCode: %d" % err.returncode,
             "Output: %s" % err.output,
         ]
@@ -242,7 +614,323 @@ def unset_proxy():
     os.environ.pop("https_proxy", None)
 
 
+class Backoff(object):
+    """
+    Poll/retry schedule shared by every wait loop in the script.
+
+    Iterating over `attempts()` yields attempt numbers starting at 1 and sleeps between them with exponential backoff
+    and jitter, so hosts booted together do not poll in lockstep.  Iteration stops once `max_attempts` have been made
+    or `deadline` seconds have passed since the first attempt, whichever comes first; the caller handles giving up
+    after the loop.
+    """
+
+    def __init__(self, name, initial_delay=0.5, max_delay=10, multiplier=2, jitter=0.5, deadline=None, max_attempts=None):
+        self.name = name
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+
+    def delays(self):
+        delay = self.initial_delay
+        while True:
+            yield random.uniform(delay * (1 - self.jitter), delay)
+            delay = min(delay * self.multiplier, self.max_delay)
+
+    def attempts(self):
+        started_at = time.time()
+        delays = self.delays()
+        attempt = 0
+        while True:
+            attempt += 1
+            tracer.annotate(attempts=attempt)
+            yield attempt
+            if self.max_attempts and attempt >= self.max_attempts:
+                return
+            delay = next(delays)
+            if self.deadline is not None:
+                remaining = started_at + self.deadline - time.time()
+                if remaining <= 0:
+                    return
+                delay = min(delay, remaining)
+            logger.debug("%s: attempt %d did not succeed, retrying in %.2f seconds", self.name, attempt, delay)
+            time.sleep(delay)
+
+
+class Task(object):
+    """
+    Runs a callable on a background thread so independent bootstrap steps can overlap.
+
+    `join()` returns the callable's result or re-raises its exception in the joining thread.  A `die()` inside the
+    task is deferred until then, so failures are reported once, from the main thread, in the order the caller joins.
+    """
+
+    state = threading.local()
+
+    class Failure(Exception):
+        def __init__(self, msg, details, exitcode, diagnostics=None):
+            super(Task.Failure, self).__init__(msg)
+            self.msg = msg
+            self.details = details
+            self.exitcode = exitcode
+            self.diagnostics = diagnostics
+
+    def __init__(self, name, target, *args, **kwargs):
+        self.name = name
+        self.target = target
+        self.result = None
+        self.error = None
+        self.elapsed = None
+        self.thread = threading.Thread(target=self.run, name=name, args=args, kwargs=kwargs)
+        self.thread.daemon = True
+
+    @classmethod
+    def in_task(cls):
+        return getattr(cls.state, "in_task", False)
+
+    def start(self):
+        logger.debug("Starting background task: %s", self.name)
+        self.thread.start()
+        return self
+
+    def run(self, *args, **kwargs):
+        Task.state.in_task = True
+        started_at = time.time()
+        try:
+            self.result = self.target(*args, **kwargs)
+        except BaseException as err:
+            self.error = err
+        finally:
+            self.elapsed = time.time() - started_at
+
+    def wait(self):
+        """
+        Wait for the task to finish without raising its failure, for a caller that is about to exit anyway.
+        """
+        self.thread.join()
+
+    def join(self):
+        self.thread.join()
+        logger.debug("Background task finished: %s", self.name)
+        if isinstance(self.error, Task.Failure):
+            die(self.error.msg, details=self.error.details, exitcode=self.error.exitcode, diagnostics=self.error.diagnostics)
+        elif self.error is not None:
+            raise self.error
+        return self.result
+
+
+class KeyedLocks(object):
+    """
+    One lock per key, so work on different keys proceeds in parallel while work on the same key is done once.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+
+class HttpCache(object):
+    """
+    On-disk store of GET responses with their ETag/Last-Modified validators, kept between runs.
+
+    A stored document is revalidated with a conditional request and a 304 is answered from the store, so an unchanged
+    document is not downloaded again.  Entries not revalidated for `max_age` seconds are ignored.  Only documents
+    below one of the `urls` prefixes are stored: identity tokens, attested documents and the OpenStack vendordata are
+    credentials and never written to disk.  Responses without a validator or with "Cache-Control: no-store" are not
+    stored either.  The store is only readable by its owner.
+    """
+
+    dropped_headers = ("connection", "content-encoding", "content-length", "transfer-encoding")
+
+    def __init__(self, directory=HTTP_CACHE_DIR, max_age=HTTP_CACHE_MAX_AGE, urls=HTTP_CACHE_URLS):
+        self.directory = directory
+        self.max_age = max_age
+        self.urls = urls
+
+    def file_path(self, url):
+        return os.path.join(guest_path(self.directory), "%s.json" % hashlib.sha256(url.encode("utf-8")).hexdigest()[:32])
+
+    def storable(self, url):
+        return any(url.startswith(prefix) for prefix in self.urls)
+
+    def load(self, url):
+        if not self.storable(url):
+            return None
+        path = self.file_path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    @staticmethod
+    def validators(entry):
+        headers = {}
+        if entry["headers"].get("etag"):
+            headers["If-None-Match"] = entry["headers"]["etag"]
+        if entry["headers"].get("last-modified"):
+            headers["If-Modified-Since"] = entry["headers"]["last-modified"]
+        return headers
+
+    @staticmethod
+    def same_validators(entry, response):
+        return all(entry["headers"].get(name) == response.headers.get(name) for name in ("etag", "last-modified"))
+
+    def save(self, url, response):
+        if not self.storable(url):
+            return
+        if not (response.headers.get("etag") or response.headers.get("last-modified")):
+            return
+        if "no-store" in response.headers.get("cache-control", ""):
+            return
+        try:
+            body = response.text
+        except UnicodeDecodeError:
+            return
+        headers = dict((name, value) for (name, value) in response.headers.items() if name not in self.dropped_headers)
+        entry = {"url": url, "status": response.status, "reason": response.reason, "headers": headers, "body": body}
+        path = self.file_path(url)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0o700)
+            fd = os.open("%s.tmp" % path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.rename("%s.tmp" % path, path)
+        except (IOError, OSError) as err:
+            logger.debug("Failed to store %s in the HTTP cache: %s", url, err)
+
+    def touch(self, url):
+        try:
+            os.utime(self.file_path(url), None)
+        except OSError:
+            pass
+
+    @staticmethod
+    def response(entry):
+        body = entry["body"].encode("utf-8")
+        lines = ["HTTP/1.1 %d %s" % (entry["status"], entry["reason"])]
+        lines += ["%s: %s" % (name, value) for (name, value) in entry["headers"].items()]
+        lines.append("Content-Length: %d" % len(body))
+        return AsyncHttpClient.parse_response("GET", ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+class MetadataCache(object):
+    """
+    Memoizes platform metadata documents for `ttl` seconds so each document is fetched once per run.
+
+    Documents are keyed by method and url, so HEAD probes such as the installer check are cached alongside them.
+    `prefetch()` fetches documents concurrently (see `AsyncHttpClient`) on a background task; `get()` waits for a fetch
+    of the same document that is already in flight instead of issuing another request.  Failed fetches are not cached,
+    `get()` retries them and raises.  Refreshing a GET document is a conditional request, and a 304 reuses the response
+    already in memory, with its parsed JSON.  Documents without credentials are also kept in `store` (see `HttpCache`),
+    so they are revalidated in later runs too; credentials such as the OpenStack vendordata are only revalidated
+    against the response of this run.
+    """
+
+    def __init__(self, ttl=300, timeout=10, store=None):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.entries = {}
+        self.lock_for = KeyedLocks()
+        self.store = store or HttpCache()
+
+    def cached(self, key, refresh=False):
+        entry = self.entries.get(key)
+        if entry and not refresh and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def get(self, url, headers=None, refresh=False, method="GET"):
+        key = (method, url)
+        with self.lock_for(key):
+            response = self.cached(key, refresh)
+            if response is not None:
+                logger.debug("Using cached metadata document: %s %s", method, url)
+                return response
+            response = self.fetch([(method, url, dict(headers or {}))])[0]
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+    def fetch(self, requests, timeout=None):
+        stored, conditional = {}, []
+        for method, url, headers in requests:
+            entry = (self.store.load(url) or self.memory_entry(url)) if method == "GET" else None
+            if entry:
+                stored[url] = entry
+                headers = dict(headers, **self.store.validators(entry))
+            logger.debug("Attempting %s request to: %s with headers: %s", method, url, headers)
+            conditional.append((method, url, headers))
+        responses = AsyncHttpClient.gather(conditional, timeout=timeout or self.timeout)
+        now = time.time()
+        for index, (method, url, _) in enumerate(requests):
+            if isinstance(responses[index], Exception):
+                continue
+            if method == "GET":
+                responses[index] = self.revalidated(url, responses[index], stored.get(url))
+            self.entries[(method, url)] = (now, responses[index])
+        return responses
+
+    def memory_entry(self, url):
+        """
+        The validators of the response to `url` already in memory, in the form of a stored entry.
+        """
+        current = self.entries.get(("GET", url))
+        if current and current[1].ok:
+            return {"headers": current[1].headers}
+        return None
+
+    def revalidated(self, url, response, entry):
+        if response.status == 304 and entry:
+            logger.debug("HTTP cache hit, %s is not modified", url)
+            self.store.touch(url)
+            current = self.entries.get(("GET", url))
+            if current and self.store.same_validators(entry, current[1]):
+                return current[1]
+            return self.store.response(entry)
+        logger.debug("HTTP cache miss for %s: %s", url, response.full_status)
+        if response.ok:
+            self.store.save(url, response)
+        return response
+
+    def fetch_missing(self, requests, timeout=None):
+        """
+        Fetch the `requests` that are not cached and return their responses, or errors, by (method, url).
+        """
+        keys = sorted(set((method, url) for method, url, _ in requests))
+        locks = [self.lock_for(key) for key in keys]
+        for lock in locks:
+            lock.acquire()
+        try:
+            missing = [request for request in requests if self.cached(request[:2]) is None]
+            responses = self.fetch(missing, timeout) if missing else []
+            return dict((request[:2], response) for request, response in zip(missing, responses))
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def prefetch(self, documents, timeout=None):
+        """
+        Start fetching `documents`, given as (url, headers) or (method, url, headers), in one concurrent batch.
+        """
+        requests = [tuple(document) if len(document) == 3 else ("GET",) + tuple(document) for document in documents]
+        if requests:
+            Task("prefetch metadata", self.fetch_missing, requests, timeout).start()
+
+
 class Platform(object):
+    metadata = MetadataCache()
+
     @staticmethod
     def get(name):
         if name == PLATFORMS.GCP:
@@ -271,10 +959,23 @@ class Platform(object):
         def get_activation_url(cls):
             return "%s/v1.0/instance/gcp/activate" % PLATFORM_SERVICES_BASE_URL
 
+        @classmethod
+        def instance_identity_url(cls):
+            return "%s/service-accounts/default/identity?audience=platform.manage.rackspace.com&format=full" % cls.instance_metadata_base_url
+
+        @classmethod
+        def attributes_url(cls):
+            return "%s/attributes/?recursive=true" % cls.instance_metadata_base_url
+
+        @classmethod
+        def metadata_documents(cls):
+            headers = {"Metadata-Flavor": "Google"}
+            return [(cls.attributes_url(), dict(headers, Accept="application/json")), (cls.instance_identity_url(), headers)]
+
         @classmethod
         def get_token(cls):
-            instance_identity_url = "%s/service-accounts/default/identity?audience=platform.manage.rackspace.com&format=full" % cls.instance_metadata_base_url
-            response = HttpClient.get(instance_identity_url, headers={"Metadata-Flavor": "Google"})
+            instance_identity_url = cls.instance_identity_url()
+            response = Platform.metadata.get(instance_identity_url, headers={"Metadata-Flavor": "Google"})
             if not response.ok:
                 die("GET request to instance identity url %s failed: %s\n%s" % (instance_identity_url, response.full_status, response.dump()), exitcode=124)
             return response.text
@@ -287,10 +988,10 @@ class Platform(object):
 
         @classmethod
         def get_metadata_attribute(cls, key):
-            url = "%s/attributes/%s" % (cls.instance_metadata_base_url, key)
-            response = HttpClient.get(url, headers={"Metadata-Flavor": "Google"})
+            url = cls.attributes_url()
+            response = Platform.metadata.get(url, headers={"Metadata-Flavor": "Google", "Accept": "application/json"})
             if response.ok:
-                return response.text
+                return (response.json() or {}).get(key)
             elif response.status == 404:
                 return None
             die("GET request to metadata url %s failed: %s\n%s" % (url, response.full_status, response.dump()), exitcode=125)
@@ -304,8 +1005,14 @@ class Platform(object):
         def get_activation_url(cls):
             return "%s/v1.0/instance/azure/activate" % PLATFORM_SERVICES_BASE_URL
 
+        @classmethod
+        def metadata_documents(cls):
+            headers = {"Metadata": "true", "Accept": "application/json"}
+            return [(cls.instance_metadata_url, headers), (cls.attest_url, headers)]
+
         @classmethod
         def get_token(cls):
+            Platform.metadata.prefetch(cls.metadata_documents())
             instance_metadata = cls.get_metadata()
             attest_doc = cls.get_attest_document()
             return json.dumps(
@@ -324,7 +1031,7 @@ class Platform(object):
 
         @classmethod
         def get_attest_document(cls):
-            response = HttpClient.get_json(cls.attest_url, headers={"Metadata": "true"})
+            response = Platform.metadata.get(cls.attest_url, headers={"Metadata": "true", "Accept": "application/json"})
             if not response.ok:
                 die("GET request to metadata attest url %s failed: %s\n%s" % (cls.attest_url, response.full_status, response.dump()), exitcode=121)
             return response.json()
@@ -346,48 +1053,50 @@ class Platform(object):
 
         @classmethod
         def get_metadata(cls):
-            response = HttpClient.get_json(cls.instance_metadata_url, headers={"Metadata": "true"})
+            response = Platform.metadata.get(cls.instance_metadata_url, headers={"Metadata": "true", "Accept": "application/json"})
             if not response.ok:
                 die("GET request to metadata instance url %s failed: %s\n%s" % (cls.instance_metadata_url, response.full_status, response.dump()), exitcode=120)
             return response.json()
 
     class Vmware(object):
-        vmtoolsd_cmd = 'vmtoolsd --cmd "info-get guestinfo.machine.id"'
+        vmtoolsd_cmd = ["vmtoolsd", "--cmd", "info-get guestinfo.machine.id"]
         name = "vmware"
-        get_token_attempts = 20
-        get_token_delay = 60
+        get_token_schedule = Backoff("Vmware get token", initial_delay=2, max_delay=60, deadline=20 * 60, max_attempts=40)
 
         @classmethod
         def get_activation_url(cls):
             return "%s/v1.0/instance/activate" % PLATFORM_SERVICES_BASE_URL
 
+        @classmethod
+        def metadata_documents(cls):
+            return []
+
         @classmethod
         def get_token(cls):
-            if not command_exists("vmtoolsd"):
+            if not GuestOs.facts.command_path("vmtoolsd"):
                 die("Installation cannot continue because 'vmtoolsd' is not installed, please install 'vmtoolsd' before continuing", exitcode=137)
-            for attempt in range(1, cls.get_token_attempts):
-                logger.debug("Running vmware get token command (attempt: %d): %s" % (attempt, cls.vmtoolsd_cmd))
+            for attempt in cls.get_token_schedule.attempts():
+                logger.debug("Running vmware get token command (attempt: %d): %s", attempt, command_line(cls.vmtoolsd_cmd))
                 try:
-                    token = run_command(cls.vmtoolsd_cmd).strip()
+                    token = run_command(cls.vmtoolsd_cmd, timeout=30).strip()
                 except subprocess.CalledProcessError as e:
                     if e.returncode == 1:
-                        logger.debug("Vmware get token command returned no token, checking again in one minute")
+                        logger.debug("Vmware get token command returned no token")
                         token = None
                     else:
                         die("Vmware get token command failed\n%s" % format_command_error(cls.vmtoolsd_cmd, e), exitcode=119)
                 if token:
                     logger.debug("Found vmware auth token: %s", token)
                     return token
-                time.sleep(cls.get_token_delay)
             die(
                 "Could not retrieve token after %d attempts.  Rackspace vmware provisioning is responsible for setting the 'guestinfo.machine.id' custom property."
-                % cls.get_token_attempts,
+                % attempt,
                 exitcode=118,
             )
 
         @classmethod
         def is_agent_disabled(cls):
-            logger.debug("Platform '%s' does not support bypassing agent bootstrap using tags" % cls.name)
+            logger.debug("Platform '%s' does not support bypassing agent bootstrap using tags", cls.name)
             return False
 
     class Dedicated(Vmware):
@@ -396,11 +1105,12 @@ class Platform(object):
 
         @classmethod
         def get_token(cls):
-            if not file_exists(cls.token_file):
-                die("Token file not found: %s.  Rackspace dedicated server provisioning is responsible for populating this file.", exitcode=122)
-            token = file_read(cls.token_file).strip()
+            token_file = guest_path(cls.token_file)
+            if not file_exists(token_file):
+                die("Token file not found: %s.  Rackspace dedicated server provisioning is responsible for populating this file." % token_file, exitcode=122)
+            token = file_read(token_file).strip()
             if not token:
-                die("Token file is empty: %s.  Rackspace dedicated server provisioning is responsible for populating this file.", exitcode=123)
+                die("Token file is empty: %s.  Rackspace dedicated server provisioning is responsible for populating this file." % token_file, exitcode=123)
             return token
 
         @classmethod
@@ -413,19 +1123,22 @@ class Platform(object):
 
     class OpenStack(object):
         name = "openstack"
-        get_token_attempts = 20
-        get_token_delay = 60
+        get_token_schedule = Backoff("OpenStack get token", initial_delay=2, max_delay=60, deadline=20 * 60, max_attempts=40)
         vendordata_api_url = "http://169.254.169.254/openstack/latest/vendor_data2.json"
 
         @classmethod
         def get_activation_url(cls):
             return "%s/v2/instance/activate" % PLATFORM_SERVICES_BASE_URL
 
+        @classmethod
+        def metadata_documents(cls):
+            return [(cls.vendordata_api_url, {"Accept": "application/json"})]
+
         @classmethod
         def get_token(cls):
-            for attempt in range(1, cls.get_token_attempts + 1):
-                logger.debug("Getting OpenStack vendordata (attempt: %d): %s" % (attempt, cls.vendordata_api_url))
-                response = HttpClient.get_json(cls.vendordata_api_url)
+            for attempt in cls.get_token_schedule.attempts():
+                logger.debug("Getting OpenStack vendordata (attempt: %d): %s", attempt, cls.vendordata_api_url)
+                response = Platform.metadata.get(cls.vendordata_api_url, headers={"Accept": "application/json"}, refresh=attempt > 1)
                 if not response.ok:
                     die("GET request to vendordata url %s failed: %s\n%s" % (cls.vendordata_api_url, response.full_status, response.dump()), exitcode=138)
                 parsed_response = response.json()
@@ -433,16 +1146,15 @@ class Platform(object):
                 error_message = parsed_response.get("platform_services", {}).get("error", {}).get("message")
                 if not token:
                     if error_message:
-                        logger.debug("Got error message from vendordata API: %s" % error_message)
+                        logger.debug("Got error message from vendordata API: %s", error_message)
                         die("Failed to get token from OpenStack vendordata. Reason: %s" % error_message, exitcode=138)
-                    logger.debug("No token found in vendordata, checking again in one minute")
-                    time.sleep(cls.get_token_delay)
+                    logger.debug("No token found in vendordata")
                     continue
                 return token
 
             die(
                 "Could not retrieve token after %d attempts. This is likely caused by an outage in the Platform Services API. Please try again later."
-                % cls.get_token_attempts,
+                % attempt,
                 exitcode=138,
             )
 
@@ -454,13 +1166,282 @@ class Platform(object):
             return False
 
 
+class PackageDatabase(object):
+    """
+    Reads the state of a package from the installed-package database instead of asking the package manager.
+
+    On dpkg based distros the status file is parsed directly.  On rpm based distros `rpm -q` is used, which only reads
+    the local rpmdb, where `yum list installed` may load repository metadata or hang on unreachable repositories.
+    `query()` returns `{"installed", "version", "source"}`, or None when the database could not be read.
+    """
+
+    dpkg_status_file = "/var/lib/dpkg/status"
+
+    @classmethod
+    def query(cls, package_db, package=SSM_SERVICE):
+        if package_db == "dpkg":
+            return cls.query_dpkg(package)
+        elif package_db == "rpm":
+            return cls.query_rpm(package)
+        return None
+
+    @classmethod
+    def query_dpkg(cls, package):
+        path = guest_path(cls.dpkg_status_file)
+        state = {"installed": False, "version": None, "source": path}
+        try:
+            with io.open(path, "r", encoding="utf-8", errors="replace") as f:
+                # Stanzas are separated by blank lines; only the fields of the wanted package's stanza are kept.
+                fields = None
+                for line in f:
+                    if line.startswith("Package:"):
+                        fields = {} if line[len("Package:") :].strip() == package else None
+                    elif fields is not None and line.strip() and not line[0].isspace() and ":" in line:
+                        key, value = line.split(":", 1)
+                        fields[key] = value.strip()
+                    elif fields is not None and not line.strip():
+                        if cls.dpkg_installed(fields):
+                            break
+                        fields = None
+        except (IOError, OSError) as err:
+            logger.debug("Cannot read dpkg status file %s: %s", path, err)
+            return None
+        if fields is not None and cls.dpkg_installed(fields):
+            state.update(installed=True, version=fields.get("Version"))
+        return state
+
+    @staticmethod
+    def dpkg_installed(fields):
+        # "install ok installed"; removed packages keep a stanza with "deinstall ok config-files".
+        return fields.get("Status", "").split()[-1:] == ["installed"]
+
+    @classmethod
+    def query_rpm(cls, package):
+        if not GuestOs.facts.command_path("rpm"):
+            return None
+        cmd = ["rpm", "-q", "--queryformat", "%{VERSION}-%{RELEASE}", package]
+        try:
+            return {"installed": True, "version": run_command(cmd).strip() or None, "source": "rpmdb"}
+        except subprocess.CalledProcessError as e:
+            if e.returncode == 1 and "not installed" in e.output:
+                return {"installed": False, "version": None, "source": "rpmdb"}
+            logger.debug("Cannot query the rpm database\n%s", format_command_error(cmd, e))
+            return None
+
+
+class GuestFacts(object):
+    """
+    Per-run snapshot of guest facts: distro, init system, tool paths and package state.
+
+    Each fact is gathered at most once and then served from memory until it is explicitly invalidated, e.g. after the
+    package is installed.  `prefetch()` gathers facts on background tasks so they are ready by the time the install
+    steps need them; a fact whose gathering failed there is logged, and gathered again with its error raised on first
+    use.
+    """
+
+    tools = ("systemctl", "service", "ssm-cli", "amazon-ssm-agent")
+    package_facts = ("package", "package_installed", "path:ssm-cli", "path:amazon-ssm-agent")
+
+    def __init__(self):
+        self.values = {}
+        self.lock_for = KeyedLocks()
+
+    def get(self, name):
+        with self.lock_for(name):
+            if name not in self.values:
+                self.values[name] = self.gather(name)
+            return self.values[name]
+
+    def gather(self, name):
+        if name.startswith("path:"):
+            return command_exists(name[len("path:"):])
+        return getattr(self, "gather_%s" % name)()
+
+    def command_path(self, prog):
+        return self.get("path:%s" % prog)
+
+    def gather_distro(self):
+        return GuestOs.detect_distro()
+
+    def gather_init_system(self):
+        for init_system in ("systemctl", "service"):
+            if self.command_path(init_system):
+                return init_system
+        return None
+
+    @traced("package_check")
+    def gather_package(self):
+        """
+        State of the agent package: read from the package database, or else asked from the package manager.
+        """
+        distro_config = Distro.get_config(GuestOs.get_distro())
+        state = PackageDatabase.query(distro_config.package_db)
+        if state is None and journal.get("package_installed"):
+            if self.command_path("amazon-ssm-agent"):
+                logger.debug("Package amazon-ssm-agent was installed by an earlier run and the agent is present, skipping the package query")
+                state = {"installed": True, "version": None, "source": "journal"}
+            else:
+                journal.discard("package_installed")
+        if state is None:
+            state = {"installed": GuestOs.query_ssm_package_installed(), "version": None, "source": command_line(distro_config.check_installed_cmd)}
+        if state["installed"]:
+            logger.debug("Package amazon-ssm-agent %s is installed (from %s)", state["version"] or "(unknown version)", state["source"])
+        return state
+
+    def gather_package_installed(self):
+        return self.get("package")["installed"]
+
+    def prefetch(self, names=None):
+        if names is None:
+            names = ["path:%s" % tool for tool in self.tools] + ["init_system", "distro", "package_installed"]
+        for name in names:
+            Task("gather guest fact %s" % name, self.prefetch_fact, name).start()
+
+    def prefetch_fact(self, name):
+        try:
+            self.get(name)
+        except Task.Failure as err:
+            logger.debug("Prefetching guest fact %s failed: %s", name, err.msg)
+        except Exception:
+            logger.warning("Prefetching guest fact %s failed", name, exc_info=True)
+
+    def invalidate(self, *names):
+        for name in names:
+            with self.lock_for(name):
+                self.values.pop(name, None)
+
+
+class Inotify(object):
+    """
+    Minimal inotify(7) binding through ctypes, reporting that something changed in a set of directories.
+
+    `create()` returns None where inotify is not available (not Linux, no libc, out of watches) so callers can fall
+    back to polling.
+    """
+
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    # Completed writes only, a file appended to in many small writes reports one change when it is closed.
+    events = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, fd, paths):
+        self.fd = fd
+        self.paths = paths
+
+    @classmethod
+    def create(cls, paths):
+        paths = [path for path in paths if os.path.isdir(path)]
+        if not paths or not sys.platform.startswith("linux"):
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        except (ImportError, OSError, AttributeError) as err:
+            logger.debug("inotify is not available: %s", err)
+            return None
+        if fd < 0:
+            logger.debug("inotify_init1 failed: %s", os.strerror(ctypes.get_errno()))
+            return None
+        for path in paths:
+            if libc.inotify_add_watch(fd, path.encode("utf-8"), cls.events) < 0:
+                logger.debug("inotify_add_watch %s failed: %s", path, os.strerror(ctypes.get_errno()))
+                os.close(fd)
+                return None
+        return cls(fd, paths)
+
+    def wait(self, timeout):
+        """
+        Block until a watched directory changes or `timeout` seconds passed, returning whether anything changed.
+        """
+        readable = select.select([self.fd], [], [], max(0, timeout))[0]
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RegistrationWaiter(object):
+    """
+    Waits until the agent confirms its registration, rather than sleeping a fixed time after it was started.
+
+    The agent is asked (`ssm-cli get-instance-information`) right away and again whenever its registration state
+    changes, watched with inotify, or every `poll_interval` seconds where inotify is not available.  Checks are never
+    closer than `poll_interval` seconds, however often the state changes.  It returns the instance information as soon
+    as the agent reports it, or None once `timeout` seconds have passed.  The log directory is not watched: the agent,
+    and `ssm-cli` itself, write to it all the time.
+    """
+
+    watch_dirs = ("/var/lib/amazon/ssm",)
+
+    def __init__(self, timeout=REGISTRATION_TIMEOUT, poll_interval=REGISTRATION_POLL_INTERVAL):
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    @traced("registration_wait")
+    def wait(self):
+        deadline = time.time() + self.timeout
+        watcher = Inotify.create([guest_path(path) for path in self.watch_dirs])
+        # With inotify the poll only catches changes outside the watched directories, so it can be much slower.
+        poll_interval = self.poll_interval * 8 if watcher else self.poll_interval
+        logger.debug("Waiting up to %g seconds for the agent registration (%s)", self.timeout, "inotify" if watcher else "polling")
+        attempt = 0
+        try:
+            while True:
+                attempt += 1
+                checked_at = time.time()
+                agent_info = GuestOs.get_agent_information(quiet=True)
+                tracer.annotate(attempts=attempt, inotify=watcher is not None)
+                if agent_info:
+                    logger.debug("Agent confirmed its registration after %d checks", attempt)
+                    return agent_info
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.warning("Agent did not confirm its registration within %g seconds", self.timeout)
+                    return None
+                if watcher:
+                    watcher.wait(min(remaining, poll_interval))
+                    time.sleep(max(0, min(deadline, checked_at + self.poll_interval) - time.time()))
+                else:
+                    time.sleep(min(remaining, poll_interval))
+        finally:
+            if watcher:
+                watcher.close()
+
+
 class GuestOs(object):
+    facts = GuestFacts()
+    service_status_schedule = Backoff("Agent service status", initial_delay=0.2, max_delay=2, deadline=30, max_attempts=20)
+    diagnostics_cmd = ["ssm-cli", "get-diagnostics"]
+    instance_information_cmd = ["ssm-cli", "get-instance-information"]
+
     class AgentDiagnostics:
         def __init__(self, from_cmd):
             self.from_cmd = from_cmd
+            # Index the checks once, status queries and lookups by name are then dictionary lookups.
+            self.by_status = {}
+            self.by_name = {}
+            for check in from_cmd:
+                self.by_status.setdefault(check.get("Status"), []).append(check)
+                self.by_name[check.get("Check")] = check
 
         def filter_checks(self, status):
-            return [check for check in self.from_cmd if check["Status"] == status]
+            return self.by_status.get(status, [])
+
+        def check(self, name):
+            return self.by_name.get(name)
 
         def failed_checks(self):
             return self.filter_checks("Failed")
@@ -474,165 +1455,229 @@ class GuestOs(object):
         def checks(self):
             return self.from_cmd
 
+        def report(self):
+            return {
+                "total": len(self.from_cmd),
+                "by_status": dict((status, [check.get("Check") for check in checks]) for (status, checks) in self.by_status.items()),
+                "failed": self.failed_checks(),
+            }
+
     @staticmethod
+    @traced("agent_disabled_check")
     def is_agent_disabled(platform):
         return platform.is_agent_disabled()
 
     @staticmethod
+    @traced("clear_registration")
     def clear_agent_registration():
-        cmd = "amazon-ssm-agent -register -clear"
-        if not command_exists("amazon-ssm-agent"):
+        cmd = ["amazon-ssm-agent", "-register", "-clear"]
+        if not GuestOs.facts.command_path("amazon-ssm-agent"):
             die("Command: amazon-ssm-agent not found in $PATH", exitcode=127)
         try:
-            logger.debug("Running agent registration clear command: %s" % cmd)
+            logger.debug("Running agent registration clear command: %s", command_line(cmd))
             result = run_command(cmd)
             return result.strip()
         except subprocess.CalledProcessError as e:
             die("Agent registration clear command failed\n%s" % format_command_error(cmd, e), exitcode=114)
 
     @staticmethod
-    def get_agent_information():
-        cmd = "ssm-cli get-instance-information"
-        if not command_exists("ssm-cli"):
+    def has_registration_state():
+        """
+        Whether an agent was registered on this guest before.  Its registration survives removing the package.
+        """
+        return file_exists(guest_path(AGENT_REGISTRATION_FILE))
+
+    @staticmethod
+    @traced("agent_information")
+    def get_agent_information(quiet=False):
+        cmd = GuestOs.instance_information_cmd
+        if not GuestOs.facts.command_path("ssm-cli"):
             die("Command: ssm-cli not found in $PATH", exitcode=113)
         try:
-            logger.debug("Running agent instance information command: %s" % cmd)
+            logger.debug("Running agent instance information command: %s", command_line(cmd))
             result = run_command(cmd)
             return json.loads(result)
         except subprocess.CalledProcessError as e:
             error_line = [line for line in e.output.split("\n") if "error:" in line]
-            logger.warning("Agent is not registered (exitcode: %d): %s" % (e.returncode, error_line))
+            (logger.debug if quiet else logger.warning)("Agent is not registered (exitcode: %d): %s", e.returncode, error_line)
             return False
 
     @classmethod
-    def check_ssm_activation(cls):
-        ssm_diagnostics = cls.get_ssm_diagnostics()
-        failed_checks = ssm_diagnostics.failed_checks()
-        agent_info = cls.get_agent_information()
+    @traced("check_activation")
+    def check_ssm_activation(cls, agent_info=None):
+        ssm_diagnostics, agent_info, report = cls.collect_diagnostics(agent_info)
+        failed_checks = ssm_diagnostics.failed_checks() if ssm_diagnostics else []
         if failed_checks:
-            logger.warning("Some management agent diagnostic checks failed, please review:\n%s" % json.dumps(failed_checks, indent=2))
+            logger.warning("Some management agent diagnostic checks failed, please review:\n%s", json.dumps(failed_checks, indent=2))
         if agent_info:
-            success("Management agent was registered successfully.", details=json.dumps(agent_info))
+            success("Management agent was registered successfully.", details=json.dumps(agent_info), diagnostics=report)
         else:
-            die("Management agent was not registered successfully, view /var/log/amazon/ssm/errors.log for details", exitcode=112)
+            die("Management agent was not registered successfully, view /var/log/amazon/ssm/errors.log for details", exitcode=112, diagnostics=report)
+
+    @classmethod
+    @traced("collect_diagnostics")
+    def collect_diagnostics(cls, agent_info=None, timeout=DIAGNOSTICS_TIMEOUT):
+        """
+        Run `ssm-cli get-diagnostics` and, unless `agent_info` is already known, `ssm-cli get-instance-information`
+        concurrently, each with `timeout`.  A collector that fails or times out is recorded in the report with its
+        error while the results of the others are kept.  Returns `(diagnostics, agent_info, report)`.
+        """
+        if not cls.facts.command_path("ssm-cli"):
+            die("Command: ssm-cli not found in $PATH", exitcode=129)
+        collectors = [("diagnostics", cls.get_ssm_diagnostics, cls.diagnostics_cmd)]
+        if not agent_info:
+            collectors.append(("instance_information", cls.query_agent_information, cls.instance_information_cmd))
+        tasks = [(name, cmd, Task("collect agent %s" % name, collector, timeout).start()) for (name, collector, cmd) in collectors]
+
+        results = {"instance_information": agent_info}
+        report = {"collectors": {}}
+        for name, cmd, task in tasks:
+            try:
+                results[name] = task.join()
+                report["collectors"][name] = {"ok": True}
+            except subprocess.CalledProcessError as e:
+                report["collectors"][name] = {"ok": False, "error": format_command_error(cmd, e)}
+            except (ValueError, KeyError) as err:
+                report["collectors"][name] = {"ok": False, "error": "Unexpected output: %s" % err}
+            report["collectors"][name]["seconds"] = round(task.elapsed, 3)
+            if not report["collectors"][name]["ok"]:
+                logger.warning("Collecting agent %s failed: %s", name, report["collectors"][name]["error"])
+
+        if results.get("diagnostics"):
+            report["checks"] = results["diagnostics"].report()
+        report["instance_information"] = results.get("instance_information") or None
+        return results.get("diagnostics"), results.get("instance_information"), report
 
     @staticmethod
     def is_ssm_package_installed():
+        return GuestOs.facts.get("package_installed")
+
+    @staticmethod
+    def get_ssm_package_version():
+        return GuestOs.facts.get("package")["version"]
+
+    @staticmethod
+    def query_ssm_package_installed():
         distro_config = Distro.get_config(GuestOs.get_distro())
         check_installed_cmd = distro_config.check_installed_cmd
-        logger.debug("Checking if amazon-ssm-agent package is already installed: %s" % check_installed_cmd)
+        logger.debug("Checking if amazon-ssm-agent package is already installed: %s", command_line(check_installed_cmd))
         try:
-            run_command(check_installed_cmd)
+            run_command(check_installed_cmd, timeout=PACKAGE_COMMAND_TIMEOUT)
             return True
         except subprocess.CalledProcessError as e:
-            logger.debug("Package amazon-ssm-agent is not currently installed\n%s" % format_command_error(check_installed_cmd, e))
+            logger.debug("Package amazon-ssm-agent is not currently installed\n%s", format_command_error(check_installed_cmd, e))
             return False
 
     @staticmethod
+    @traced("uninstall_package")
     def uninstall_ssm_package():
         distro_config = Distro.get_config(GuestOs.get_distro())
         cmd = distro_config.uninstall_cmd
-        logger.debug("Running ssm package uninstall command: %s" % cmd)
+        logger.debug("Running ssm package uninstall command: %s", command_line(cmd))
         try:
-            result = run_command(cmd)
-            logger.debug("Uninstalled ssm package\n%s" % result)
+            run_command(cmd, timeout=PACKAGE_COMMAND_TIMEOUT, stream=True)
+            logger.debug("Uninstalled ssm package")
+            journal.clear()
         except subprocess.CalledProcessError as e:
             die("Package uninstall command failed\n%s" % format_command_error(cmd, e), exitcode=101)
+        finally:
+            GuestOs.facts.invalidate(*GuestFacts.package_facts)
 
     @staticmethod
+    @traced("install_package")
     def install_ssm_package(package_installer_path):
         distro_config = Distro.get_config(GuestOs.get_distro())
-        cmd = distro_config.install_cmd % package_installer_path
-        logger.debug("Running ssm package install command: %s" % cmd)
+        cmd = distro_config.install_cmd + [package_installer_path]
+        logger.debug("Running ssm package install command: %s", command_line(cmd))
         try:
-            result = run_command(cmd)
-            logger.debug("Installed ssm package\n%s" % result)
+            run_command(cmd, timeout=PACKAGE_COMMAND_TIMEOUT, stream=True)
+            logger.debug("Installed ssm package")
+            journal.record("package_installed", installer=package_installer_path)
         except subprocess.CalledProcessError as e:
             die("Package install command failed\n%s" % format_command_error(cmd, e), exitcode=100)
+        finally:
+            GuestOs.facts.invalidate(*GuestFacts.package_facts)
+
+    @classmethod
+    def service_command(cls, action):
+        init_system = cls.facts.get("init_system")
+        if init_system == "systemctl":
+            return ["systemctl", {"status": "is-active"}.get(action, action), SSM_SERVICE]
+        elif init_system == "service":
+            return ["service", SSM_SERVICE, action]
+        die("Neither systemctl or service commands found in $PATH, bootstrap install cannot continue.", exitcode=130)
 
     @classmethod
     def stop_ssm_service(cls):
-        cmd = None
-        if command_exists("systemctl"):
-            cmd = "systemctl stop %s" % SSM_SERVICE
-        elif command_exists("service"):
-            cmd = "service %s stop" % SSM_SERVICE
-        if not cmd:
-            die("Neither systemctl or service commands found in $PATH, bootstrap install cannot continue.", exitcode=130)
-
-        logger.debug("Running stop agent service command: %s" % cmd)
+        cmd = cls.service_command("stop")
+        logger.debug("Running stop agent service command: %s", command_line(cmd))
         try:
-            result = run_command(cmd)
-            logger.debug("Stop agent service command succeeded\n%s" % result)
+            run_command(cmd, stream=True)
+            logger.debug("Stop agent service command succeeded")
         except subprocess.CalledProcessError as e:
             die("Stop agent service command failed\n%s" % format_command_error(cmd, e), exitcode=103)
 
+    @staticmethod
+    def get_ssm_diagnostics(timeout=DIAGNOSTICS_TIMEOUT):
+        cmd = GuestOs.diagnostics_cmd
+        logger.debug("Running agent diagnostics command: %s", command_line(cmd))
+        return GuestOs.AgentDiagnostics(json.loads(run_command(cmd, timeout=timeout))["DiagnosticsOutput"])
+
+    @staticmethod
+    def query_agent_information(timeout=DIAGNOSTICS_TIMEOUT):
+        cmd = GuestOs.instance_information_cmd
+        logger.debug("Running agent instance information command: %s", command_line(cmd))
+        return json.loads(run_command(cmd, timeout=timeout))
+
     @classmethod
-    def get_ssm_diagnostics(cls):
-        cmd = "ssm-cli get-diagnostics"
-        if not command_exists("ssm-cli"):
-            die("Command: ssm-cli not found in $PATH", exitcode=129)
+    def is_ssm_service_running(cls):
         try:
-            logger.debug("Running agent diagnostics command: %s" % cmd)
-            result = run_command(cmd)
-            return GuestOs.AgentDiagnostics(json.loads(result)["DiagnosticsOutput"])
-        except subprocess.CalledProcessError as e:
-            die("Agent diagnostics command failed\n%s" % format_command_error(cmd, e), exitcode=111)
+            run_command(cls.service_command("status"), timeout=15)
+            return True
+        except subprocess.CalledProcessError:
+            return False
 
     @classmethod
     def start_ssm_service(cls):
-        start_cmd, status_cmd = None, None
-        if command_exists("systemctl"):
-            start_cmd = "systemctl start %s" % SSM_SERVICE
-            status_cmd = "systemctl is-active %s" % SSM_SERVICE
-        elif command_exists("service"):
-            start_cmd = "service %s start" % SSM_SERVICE
-            status_cmd = "service %s status" % SSM_SERVICE
-        if not start_cmd:
-            die("Neither systemctl or service commands found in $PATH, bootstrap install cannot continue.", exitcode=130)
-
-        logger.debug("Running start agent service command: %s" % start_cmd)
+        start_cmd, status_cmd = cls.service_command("start"), cls.service_command("status")
+        logger.debug("Running start agent service command: %s", command_line(start_cmd))
         try:
-            start_result = run_command(start_cmd)
-            logger.debug("Start agent service command succeeded\n%s" % start_result)
+            run_command(start_cmd, stream=True)
+            logger.debug("Start agent service command succeeded")
         except subprocess.CalledProcessError as e:
             die("Start agent service command failed\n%s" % format_command_error(start_cmd, e), exitcode=102)
 
         last_err = None
-        for attempt in range(1, 10):
-            logger.debug("Checking if agent service is running (attempt: %d): %s" % (attempt, status_cmd))
+        for attempt in cls.service_status_schedule.attempts():
+            logger.debug("Checking if agent service is running (attempt: %d): %s", attempt, command_line(status_cmd))
             try:
-                status_result = run_command(status_cmd)
-                logger.debug("Agent service is now running: %s" % status_result)
+                status_result = run_command(status_cmd, timeout=15)
+                logger.debug("Agent service is now running: %s", status_result)
                 return True
             except subprocess.CalledProcessError as e:
                 last_err = e
-                logger.debug("Agent service is not running yet, checking again in one second (exitcode: %d)" % e.returncode)
+                logger.debug("Agent service is not running yet (exitcode: %d)", e.returncode)
         die("Agent service failed to reach a running state\n%s" % format_command_error(status_cmd, last_err), exitcode=104)
 
     @classmethod
     def register_ssm(cls, activation):
-        cmd = 'amazon-ssm-agent -y -register -code "%s" -id "%s" -region "%s"' % (
-            activation["code"],
-            activation["id"],
-            activation["region"],
-        )
+        cmd = ["amazon-ssm-agent", "-y", "-register", "-code", activation["code"], "-id", activation["id"], "-region", activation["region"]]
+        # An activation may only be good for one registration, never reuse it once a registration was attempted.
+        journal.discard("activation")
         try:
-            logger.debug("Running agent registration command: %s" % cmd)
+            logger.debug("Running agent registration command: %s", command_line(cmd))
             with proxy_context():
-                run_command(cmd)
+                run_command(cmd, stream=True)
             logger.debug("Agent registration succeeded")
         except subprocess.CalledProcessError as e:
             die("Agent registration command failed\n%s" % format_command_error(cmd, e), exitcode=110)
 
-    @classmethod
-    def activate_ssm(cls, activation):
-        cls.stop_ssm_service()
-        cls.register_ssm(activation)
-        cls.start_ssm_service()
-
     @staticmethod
     def get_distro():
+        return GuestOs.facts.get("distro")
+
+    @staticmethod
+    def detect_distro():
         def get_id_line(line):
             if line.startswith("ID="):
                 return True
@@ -641,33 +1686,34 @@ class GuestOs(object):
         def get_id(path):
             return file_find(path, get_id_line).split("=")[1].strip()
 
-        centos_release = "/etc/centos-release"
-        redhat_release = "/etc/redhat-release"
-        os_release = "/etc/os-release"
+        centos_release = guest_path("/etc/centos-release")
+        redhat_release = guest_path("/etc/redhat-release")
+        os_release = guest_path("/etc/os-release")
 
         log_msg = "Found %s file, assuming that distro is %s"
         if file_exists(centos_release):
-            logger.debug(log_msg % (centos_release, DISTROS.CENTOS))
+            logger.debug(log_msg, centos_release, DISTROS.CENTOS)
             return DISTROS.CENTOS
         elif file_exists(redhat_release):
-            logger.debug(log_msg % (redhat_release, DISTROS.RHEL))
+            logger.debug(log_msg, redhat_release, DISTROS.RHEL)
             return DISTROS.RHEL
         elif file_exists(os_release):
             distro_id = get_id(os_release)
             if distro_id:
-                logger.debug(log_msg % (os_release, distro_id))
+                logger.debug(log_msg, os_release, distro_id)
                 return distro_id
         die("Could not determine guest operating system Linux distribution.", exitcode=131)
 
 
 class DistroConfig:
-    def __init__(self, default_package_installer_url, regional_package_installer_url, install_cmd, uninstall_cmd, check_installed_cmd):
+    def __init__(self, default_package_installer_url, regional_package_installer_url, install_cmd, uninstall_cmd, check_installed_cmd, package_db=None):
         self.default_package_installer_url = default_package_installer_url
         self.regional_package_installer_url = regional_package_installer_url
         self.region = None
         self.install_cmd = install_cmd
         self.uninstall_cmd = uninstall_cmd
         self.check_installed_cmd = check_installed_cmd
+        self.package_db = package_db
 
     @property
     def package_installer_url(self):
@@ -676,35 +1722,63 @@ class DistroConfig:
 
         return self.regional_package_installer_url.format(region=self.region)
 
+    @property
+    def package_installer_path(self):
+        return "latest/%s" % self.default_package_installer_url.split("/latest/", 1)[1]
+
+    def for_region(self, region):
+        """
+        A copy of this config that downloads from `region`.  The per-distro configs are shared by every thread of the
+        run and never changed.
+        """
+        distro_config = copy.copy(self)
+        distro_config.region = region
+        return distro_config
+
+    def package_installer_urls(self, mirrors=None):
+        """
+        Candidate installer urls in order of preference: the regional url when a region is set, the default url and
+        the installer on every mirror in `mirrors`, base urls laid out like the regional buckets.
+        """
+        urls = [self.package_installer_url]
+        if self.region is not None:
+            urls.append(self.default_package_installer_url)
+        urls.extend("%s/%s" % (mirror.rstrip("/"), self.package_installer_path) for mirror in mirrors or [])
+        return urls
+
 
 class Distro(object):
     UbuntuConfig = DistroConfig(
         default_package_installer_url="https://s3.amazonaws.com/ec2-downloads-windows/SSMAgent/latest/debian_amd64/amazon-ssm-agent.deb",
         regional_package_installer_url="https://amazon-ssm-{region}.s3.{region}.amazonaws.com/latest/debian_amd64/amazon-ssm-agent.deb",
-        install_cmd="dpkg -i %s",
-        uninstall_cmd="dpkg -r %s" % SSM_SERVICE,
-        check_installed_cmd="dpkg -l %s" % SSM_SERVICE,
+        install_cmd=["dpkg", "-i"],
+        uninstall_cmd=["dpkg", "-r", SSM_SERVICE],
+        check_installed_cmd=["dpkg", "-l", SSM_SERVICE],
+        package_db="dpkg",
     )
     DebianConfig = DistroConfig(
         default_package_installer_url="https://s3.amazonaws.com/ec2-downloads-windows/SSMAgent/latest/debian_amd64/amazon-ssm-agent.deb",
         regional_package_installer_url="https://amazon-ssm-{region}.s3.{region}.amazonaws.com/latest/debian_amd64/amazon-ssm-agent.deb",
-        install_cmd="dpkg -i %s",
-        uninstall_cmd="dpkg -r %s" % SSM_SERVICE,
-        check_installed_cmd="dpkg -l %s" % SSM_SERVICE,
+        install_cmd=["dpkg", "-i"],
+        uninstall_cmd=["dpkg", "-r", SSM_SERVICE],
+        check_installed_cmd=["dpkg", "-l", SSM_SERVICE],
+        package_db="dpkg",
     )
     RhelConfig = DistroConfig(
         default_package_installer_url="https://s3.amazonaws.com/ec2-downloads-windows/SSMAgent/latest/linux_amd64/amazon-ssm-agent.rpm",
         regional_package_installer_url="https://amazon-ssm-{region}.s3.{region}.amazonaws.com/latest/linux_amd64/amazon-ssm-agent.rpm",
-        install_cmd="yum install -y %s",
-        uninstall_cmd="yum remove -y %s" % SSM_SERVICE,
-        check_installed_cmd="yum list installed %s" % SSM_SERVICE,
+        install_cmd=["yum", "install", "-y"],
+        uninstall_cmd=["yum", "remove", "-y", SSM_SERVICE],
+        check_installed_cmd=["yum", "list", "installed", SSM_SERVICE],
+        package_db="rpm",
     )
     SuseConfig = DistroConfig(
         default_package_installer_url="https://s3.amazonaws.com/ec2-downloads-windows/SSMAgent/latest/linux_amd64/amazon-ssm-agent.rpm",
         regional_package_installer_url="https://amazon-ssm-{region}.s3.{region}.amazonaws.com/latest/linux_amd64/amazon-ssm-agent.rpm",
-        install_cmd="rpm --install %s",
-        uninstall_cmd="rpm -e %s" % SSM_SERVICE,
-        check_installed_cmd="rpm -q %s" % SSM_SERVICE,
+        install_cmd=["rpm", "--install"],
+        uninstall_cmd=["rpm", "-e", SSM_SERVICE],
+        check_installed_cmd=["rpm", "-q", SSM_SERVICE],
+        package_db="rpm",
     )
     CentosConfig = RhelConfig
 
@@ -723,24 +1797,68 @@ class Distro(object):
         else:
             die("Operating system '%s' is not unsupported." % distro, exitcode=132)
 
-        distro_config.region = region
-        return distro_config
+        return distro_config.for_region(region)
 
 
 class HttpClient(object):
     request_exceptions = (HTTPException, IOError)
+    # Only these are sent again when a pooled connection fails, a retried POST could create a second activation.
+    idempotent_methods = ("GET", "HEAD")
 
     class Response(object):
+        """
+        Status and headers are parsed once, the body is only read when `content` is first accessed or streamed with
+        `iter_content()`; reading the whole body returns the connection to the pool.  A gzip Content-Encoding is
+        decoded transparently.
+        """
+
+        __slots__ = ("raw_response", "status", "reason", "headers", "elapsed", "sha256", "_content", "_json", "_release", "_decoder")
+
         def __init__(self, raw_response):
             self.raw_response = raw_response
-            self._content = raw_response.read()
+            self.status = raw_response.status
+            self.reason = raw_response.reason
+            self.headers = dict((key.lower(), val) for (key, val) in raw_response.getheaders())
+            self.elapsed = None
+            self.sha256 = None
+            self._content = None
+            self._json = None
+            self._release = None
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if self.headers.get("content-encoding") == "gzip" else None
+
+        def decode(self, data, final=False):
+            if self._decoder is None:
+                return data
+            try:
+                return self._decoder.decompress(data) + (self._decoder.flush() if final else b"")
+            except zlib.error as err:
+                raise HttpClient.RequestException("Invalid gzip response body: %s" % err)
+
+        def iter_content(self, chunk_size=DOWNLOAD_CHUNK_SIZE):
+            while True:
+                chunk = self.raw_response.read(chunk_size)
+                if not chunk:
+                    break
+                yield self.decode(chunk)
+            if self._decoder is not None:
+                yield self.decode(b"", final=True)
+
+        def close(self):
+            if self._release is not None:
+                release, self._release = self._release, None
+                release()
 
         @property
         def ok(self):
-            return self.raw_response.status <= 202
+            return self.status <= 202
 
         @property
         def content(self):
+            if self._content is None:
+                try:
+                    self._content = self.decode(self.raw_response.read(), final=True)
+                finally:
+                    self.close()
             return self._content
 
         @property
@@ -748,20 +1866,9 @@ class HttpClient(object):
             return self.content.decode("utf-8")
 
         def json(self):
-            if "application/json" in self.headers["content-type"]:
-                return json.loads(self.text)
-
-        @property
-        def headers(self):
-            return dict((key.lower(), val) for (key, val) in self.raw_response.getheaders())
-
-        @property
-        def status(self):
-            return self.raw_response.status
-
-        @property
-        def reason(self):
-            return self.raw_response.reason
+            if self._json is None and "application/json" in self.headers["content-type"]:
+                self._json = json.loads(self.text)
+            return self._json
 
         def dump(self):
             return "HTTP Response:\n%s\n%s" % (self.headers, self.text)
@@ -775,11 +1882,63 @@ class HttpClient(object):
             self.response = kwargs.pop("response", None)
             super(HttpClient.RequestException, self).__init__(message)
 
+    class DigestMismatch(RequestException):
+        pass
+
+    class ConnectionPool(object):
+        """
+        Per-host pool of persistent (keep-alive) connections, reused across requests for the whole run.
+
+        Connections are keyed by scheme, host, port and proxy so proxy tunnels are pooled as well.  A connection is
+        checked out exclusively for the duration of a request and returned once its response body has been read.
+        """
+
+        def __init__(self, max_idle_per_host=4):
+            self.max_idle_per_host = max_idle_per_host
+            self._idle = {}
+            self._lock = threading.Lock()
+
+        @staticmethod
+        def key(url):
+            proxy = HTTP_PROXY.geturl() if HTTP_PROXY else None
+            return (url.scheme, url.hostname, url.port, proxy)
+
+        def acquire(self, url, timeout, reuse=True):
+            key = self.key(url)
+            with self._lock:
+                idle = self._idle.get(key)
+                conn = idle.pop() if idle and reuse else None
+            if conn is None:
+                logger.debug("Opening new connection to %s://%s", url.scheme, url.netloc)
+                return HttpClient.get_connection(url, timeout=timeout), False
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+
+        def release(self, url, conn):
+            key = self.key(url)
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle_per_host:
+                    idle.append(conn)
+                    return
+            conn.close()
+
+        def close_all(self):
+            with self._lock:
+                connections = [conn for idle in self._idle.values() for conn in idle]
+                self._idle = {}
+            for conn in connections:
+                conn.close()
+
+    pool = ConnectionPool()
+
     @classmethod
     def get_connection(cls, url, **kwargs):
         global HTTP_PROXY
         if HTTP_PROXY:
-            logger.info("Using proxy for connection: %s" % HTTP_PROXY.geturl())
+            logger.info("Using proxy for connection: %s", HTTP_PROXY.geturl())
             if url.scheme == "https":
                 conn = HTTPSConnection(HTTP_PROXY.hostname, HTTP_PROXY.port, **kwargs)
             elif url.scheme == "http":
@@ -790,49 +1949,153 @@ class HttpClient(object):
             return conn
         else:
             if url.scheme == "https":
-                return HTTPSConnection(url.hostname, **kwargs)
+                return HTTPSConnection(url.hostname, url.port, **kwargs)
             elif url.scheme == "http":
-                return HTTPConnection(url.hostname, **kwargs)
+                return HTTPConnection(url.hostname, url.port, **kwargs)
             raise Exception("Invalid scheme for url %s", url.geturl())
 
+    @staticmethod
+    def request_path(url):
+        if url.query:
+            return "?".join([url.path, url.query])
+        return url.path
+
     @classmethod
-    def download(cls, url, file_path, headers=None):
-        headers = headers or {}
-        logger.debug("Attempting to download file from: %s" % url)
+    def request(cls, method, url, headers=None, body=None, timeout=10, stream=False):
+        """
+        Send a request over a pooled connection and return its response.
+
+        The response body is read before returning unless `stream` is set, in which case the connection goes back to
+        the pool once the caller closes the response.  Bodies that are read whole are requested gzip encoded, streamed
+        ones (installer downloads, which are hashed and resumed by byte offset) are not.  A pooled connection may have
+        been closed by the server while idle, in which case an idempotent request is retried on a fresh connection,
+        but only until a status line was received.  Other requests cannot tell whether the server already acted on
+        them, so they are always sent on a new connection and never retried.
+        """
+        headers = dict(headers or {})
+        if not stream:
+            headers.setdefault("Accept-Encoding", "gzip")
+        u = urlparse(url)
+        path = cls.request_path(u)
+        started_at = time.time()
+        idempotent = method in cls.idempotent_methods
+        with tracer.span("%s %s" % (method, u.netloc), category="http", url=url) as span:
+            while True:
+                conn, reused = cls.pool.acquire(u, timeout, reuse=idempotent)
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    raw_response = conn.getresponse()
+                    break
+                except cls.request_exceptions:
+                    conn.close()
+                    if reused:
+                        logger.debug("Pooled connection to %s://%s was closed, retrying on a new connection", u.scheme, u.netloc)
+                        continue
+                    raise
+            response = HttpClient.Response(raw_response)
+            response.elapsed = time.time() - started_at
+            response._release = lambda: cls.release_connection(u, conn, raw_response)
+            span.update(status=response.status, reused_connection=reused)
+            if not stream:
+                # The server has answered, a body that cannot be read or decoded fails the request without a retry.
+                span["bytes"] = len(response.content)
+            return response
+
+    @classmethod
+    def release_connection(cls, url, conn, raw_response):
+        if raw_response.will_close or not raw_response.isclosed():
+            conn.close()
+        else:
+            cls.pool.release(url, conn)
+
+    @staticmethod
+    def hash_file(path, digest):
+        size = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        return size
+
+    @classmethod
+    @traced("download", category="http")
+    def download(cls, url, file_path, headers=None, expected_sha256=None, resume=False, on_response=None):
+        """
+        Stream `url` into `file_path` in DOWNLOAD_CHUNK_SIZE chunks, hashing the bytes as they arrive.
+
+        The body is written to a ".part" file that is only renamed into place once the download is complete and, when
+        `expected_sha256` is given, its digest matches.  The digest is available as `response.sha256`.  With `resume`,
+        an existing ".part" file is continued with a Range request; a server that ignores the range restarts the file,
+        and one that cannot satisfy it (a ".part" file that is already complete) is asked for the whole file once.
+        `on_response` is called with the response before its body is streamed to disk.
+        """
+        headers = dict(headers or {})
+        logger.debug("Attempting to download file from: %s", url)
         u = urlparse(url)
+        file_name = u.path.split("/")[-1]
+        output_file = os.path.join(file_path, file_name)
+        partial_file = "%s.part" % output_file
+        digest = hashlib.sha256()
+        offset = 0
+        if resume and file_exists(partial_file):
+            offset = cls.hash_file(partial_file, digest)
+            if offset:
+                headers["Range"] = "bytes=%d-" % offset
         try:
-            c = cls.get_connection(u, timeout=60)
-            if u.query:
-                path = "?".join([u.path, u.query])
+            response = cls.request("GET", url, headers=headers, timeout=60, stream=True)
+            if response.status == 416 and offset:
+                response.content  # read it so the connection can be reused
+                logger.debug("Cannot resume download of %s at byte %d, downloading the whole file", url, offset)
+                os.remove(partial_file)
+                headers = dict((name, value) for (name, value) in headers.items() if name not in ("Range", "If-Range"))
+                return cls.download(url, file_path, headers, expected_sha256, resume=False, on_response=on_response)
+            if response.status == 206 and offset:
+                logger.debug("Resuming download of %s at byte %d", url, offset)
+                mode = "ab"
+            elif response.ok:
+                digest, offset, mode = hashlib.sha256(), 0, "wb"
             else:
-                path = u.path
-            c.request("GET", path, headers=headers)
-            response = HttpClient.Response(c.getresponse())
-            if not response.ok:
+                response.content  # error bodies are small, read them so the connection can be reused
                 return response, None
-            file_name = u.path.split("/")[-1]
-            output_file = os.path.join(file_path, file_name)
-            file_write(response.content, output_file, "wb")
-            c.close()
+            if on_response is not None:
+                on_response(response)
+            size = offset
+            try:
+                with open(partial_file, mode) as f:
+                    for chunk in response.iter_content():
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+            finally:
+                response.close()
+            tracer.annotate(bytes=size - offset, resumed_at=offset)
+            # A connection closed early ends the body without an error, the partial file is kept to resume from.
+            content_length = response.headers.get("content-length")
+            encoded = "content-encoding" in response.headers
+            if content_length and content_length.isdigit() and not encoded and size - offset != int(content_length):
+                raise HttpClient.RequestException("Download from %s ended after %d of %s bytes" % (url, size - offset, content_length))
+            response.sha256 = digest.hexdigest()
+            logger.debug("Downloaded %d bytes from %s (sha256: %s)", size, url, response.sha256)
+            if expected_sha256 and response.sha256 != expected_sha256.lower():
+                os.remove(partial_file)
+                raise HttpClient.DigestMismatch(
+                    "Download from %s has SHA-256 digest %s, expected %s" % (url, response.sha256, expected_sha256), response=response
+                )
+            os.rename(partial_file, output_file)
             return response, output_file
         except cls.request_exceptions as err:
+            if isinstance(err, HttpClient.RequestException):
+                raise
             raise HttpClient.RequestException("Download request to %s failed: %s" % (url, err))
 
     @classmethod
     def post_json(cls, url, data=None, headers=None):
         data = data or {}
         headers = headers or {}
-        logger.debug("Attempting POST request to: %s" % url)
+        logger.debug("Attempting POST request to: %s", url)
         headers.update({"Content-Type": "application/json", "Accept": "application/json"})
-        u = urlparse(url)
         try:
-            c = cls.get_connection(u, timeout=15)
-            if u.query:
-                path = "?".join([u.path, u.query])
-            else:
-                path = u.path
-            c.request("POST", path, headers=headers, body=json.dumps(data))
-            return HttpClient.Response(c.getresponse())
+            return cls.request("POST", url, headers=headers, body=json.dumps(data), timeout=15)
         except cls.request_exceptions as err:
             raise HttpClient.RequestException("POST request to %s failed: %s" % (url, err))
 
@@ -845,63 +2108,242 @@ class HttpClient(object):
     @classmethod
     def get(cls, url, headers=None):
         headers = headers or {}
-        logger.debug("Attempting GET request to: %s with headers: %s" % (url, headers))
-        u = urlparse(url)
+        logger.debug("Attempting GET request to: %s with headers: %s", url, headers)
         try:
-            c = cls.get_connection(u, timeout=10)
-            if u.query:
-                path = "?".join([u.path, u.query])
-            else:
-                path = u.path
-            c.request("GET", path, headers=headers)
-            return HttpClient.Response(c.getresponse())
+            return cls.request("GET", url, headers=headers, timeout=10)
         except cls.request_exceptions as err:
             raise HttpClient.RequestException("GET request to %s failed: %s" % (url, err))
 
 
-def reset_formatter(formatter_name="agent_bootstrap_stream_logs"):
-    handler = list(filter(lambda handler: handler._name == formatter_name, logger.handlers))[0]
-    handler.formatter = None
+class AsyncHttpClient(object):
+    """
+    Issues independent HTTP requests concurrently on an asyncio event loop, each with its own timeout.
+
+    `gather()` blocks until every request has completed and returns, in order, a `HttpClient.Response` or a
+    `HttpClient.RequestException` per request.  A request that exceeds its timeout is cancelled and its connection
+    closed.  Requests are sent with "Connection: close" and parsed by `HTTPResponse`, so the responses have the same
+    surface as the synchronous client's.  asyncio is not available on Python 2 and the event loop does not tunnel
+    through HTTP_PROXY, in both cases `gather()` runs the requests on the synchronous client instead.  So does a
+    single request, which gains nothing from an event loop and can reuse a pooled keep-alive connection.
+    """
+
+    class Protocol(object):
+        def __init__(self, method, data, future):
+            self.method = method
+            self.data = data
+            self.future = future
+            self.chunks = []
+
+        def connection_made(self, transport):
+            if self.future.done():
+                transport.close()
+                return
+            # Cancelling the request (a timeout) closes the connection.
+            self.future.add_done_callback(lambda _: transport.close())
+            transport.write(self.data)
+
+        def data_received(self, data):
+            self.chunks.append(data)
+
+        def eof_received(self):
+            return False
+
+        def connection_lost(self, exc):
+            if self.future.done():
+                return
+            if exc is not None:
+                self.future.set_exception(exc)
+                return
+            try:
+                self.future.set_result(AsyncHttpClient.parse_response(self.method, b"".join(self.chunks)))
+            except HttpClient.request_exceptions as err:
+                self.future.set_exception(err)
+
+        def pause_writing(self):
+            pass
+
+        def resume_writing(self):
+            pass
+
+    class BufferedSocket(object):
+        """
+        Just enough of a socket for `HTTPResponse` to parse a response that has already been received.
+        """
+
+        def __init__(self, data):
+            self.data = data
+
+        def makefile(self, *args, **kwargs):
+            return io.BytesIO(self.data)
+
+    @staticmethod
+    def available():
+        return not is_python2() and not HTTP_PROXY
+
+    @classmethod
+    def parse_response(cls, method, data):
+        raw_response = HTTPResponse(cls.BufferedSocket(data), method=method)
+        raw_response.begin()
+        return HttpClient.Response(raw_response)
+
+    @staticmethod
+    def encode_request(method, url, headers=None, body=None):
+        headers = dict(headers or {})
+        headers.setdefault("Host", url.netloc)
+        headers.setdefault("Accept-Encoding", "gzip")
+        headers["Connection"] = "close"
+        if body is not None:
+            body = body.encode("utf-8") if not isinstance(body, bytes) else body
+            headers["Content-Length"] = str(len(body))
+        lines = ["%s %s HTTP/1.1" % (method, HttpClient.request_path(url) or "/")]
+        lines += ["%s: %s" % (key, value) for (key, value) in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+
+    @classmethod
+    def send(cls, loop, method, url, headers=None, body=None, timeout=10):
+        """
+        Start a request on `loop` and return a future for its response, cancelled after `timeout` seconds.
+        """
+        u = urlparse(url)
+        if u.scheme not in ("http", "https"):
+            raise HttpClient.RequestException("Invalid scheme for url %s" % url)
+        future = loop.create_future()
+        data = cls.encode_request(method, u, headers, body)
+        connecting = loop.create_task(
+            loop.create_connection(
+                lambda: cls.Protocol(method, data, future),
+                u.hostname,
+                u.port or (443 if u.scheme == "https" else 80),
+                ssl=ssl.create_default_context() if u.scheme == "https" else None,
+            )
+        )
+
+        def connected(task):
+            error = None if task.cancelled() else task.exception()
+            if error is not None and not future.done():
+                future.set_exception(error)
+
+        started_at = time.time()
+        timer = loop.call_later(timeout, future.cancel)
+
+        def done(_):
+            timer.cancel()
+            connecting.cancel()
+            attributes = {"url": url}
+            if future.cancelled():
+                attributes["error"] = "Timed out after %g seconds" % timeout
+            elif future.exception() is not None:
+                attributes["error"] = "%s: %s" % (type(future.exception()).__name__, future.exception())
+            else:
+                future.result().elapsed = time.time() - started_at
+                attributes.update(status=future.result().status, bytes=len(future.result().content))
+            tracer.record("%s %s" % (method, u.netloc), "http", started_at, time.time(), **attributes)
+
+        connecting.add_done_callback(connected)
+        future.add_done_callback(done)
+        return future, connecting
+
+    @classmethod
+    def gather(cls, requests, timeout=10):
+        """
+        Run `requests`, a list of (method, url, headers) tuples, concurrently and return their responses in order.
+        """
+        if not requests:
+            return []
+        if len(requests) == 1 or not cls.available():
+            return cls.gather_sync(requests, timeout)
+
+        import asyncio
+
+        loop = asyncio.new_event_loop()
+        futures, connecting = [], []
+        try:
+            for method, url, headers in requests:
+                try:
+                    future, task = cls.send(loop, method, url, headers, timeout=timeout)
+                except HttpClient.RequestException as err:
+                    future, task = loop.create_future(), None
+                    future.set_exception(err)
+                futures.append(future)
+                connecting.extend([task] if task else [])
+            loop.run_until_complete(asyncio.wait(futures))
+        finally:
+            for future in futures:
+                future.cancel()
+            pending = [task for task in connecting if not task.done()]
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.close()
+
+        responses = []
+        for (method, url, _), future in zip(requests, futures):
+            if future.cancelled():
+                responses.append(HttpClient.RequestException("%s request to %s timed out after %g seconds" % (method, url, timeout)))
+            elif future.exception() is not None:
+                error = future.exception()
+                responses.append(error if isinstance(error, HttpClient.RequestException) else HttpClient.RequestException("%s request to %s failed: %s" % (method, url, error)))
+            else:
+                responses.append(future.result())
+        return responses
+
+    @classmethod
+    def gather_sync(cls, requests, timeout=10):
+        if len(requests) == 1:
+            return [cls.request_sync(*(requests[0] + (timeout,)))]
+        tasks = [Task("%s %s" % (method, url), cls.request_sync, method, url, headers, timeout).start() for (method, url, headers) in requests]
+        return [task.join() for task in tasks]
 
+    @staticmethod
+    def request_sync(method, url, headers, timeout):
+        try:
+            return HttpClient.request(method, url, headers=headers, timeout=timeout)
+        except HttpClient.request_exceptions as err:
+            return HttpClient.RequestException("%s request to %s failed: %s" % (method, url, err))
 
-def die(msg, details="", exitcode=1):
+
+def die(msg, details="", exitcode=1, diagnostics=None):
+    if Task.in_task():
+        raise Task.Failure(msg, details, exitcode, diagnostics)
     if result_format == "json":
-        reset_formatter()
-        logger.warning(result_delimiter % "Failed")
-        logger.warning(as_json(level="WARN", message=msg, details=details))
+        log_result(logging.WARNING, result_delimiter % "Failed")
+        log_result(logging.WARNING, as_json(level="WARN", message=msg, details=details, phases=tracer.phase_durations(), diagnostics=diagnostics))
     else:
         if details:
             detailed_msg = "%s: %s" % (msg, details)
         else:
             detailed_msg = msg
-        logger.warning(as_text(level="WARN", message=detailed_msg))
+        log_result(logging.WARNING, as_text(level="WARN", message=detailed_msg))
     exit(exitcode)
 
 
-def success(msg, details="", exitcode=0):
+def success(msg, details="", exitcode=0, diagnostics=None):
     if result_format == "json":
-        reset_formatter()
-        logger.debug(result_delimiter % "Success")
-        logger.debug(as_json(level="DEBUG", message=msg, details=details))
+        log_result(logging.DEBUG, result_delimiter % "Success")
+        log_result(logging.DEBUG, as_json(level="DEBUG", message=msg, details=details, phases=tracer.phase_durations(), diagnostics=diagnostics))
     else:
         if details:
             detailed_msg = "%s: %s" % (msg, details)
         else:
             detailed_msg = msg
-        logger.debug(as_text(level="DEBUG", message=detailed_msg))
+        log_result(logging.DEBUG, as_text(level="DEBUG", message=detailed_msg))
     exit(exitcode)
 
 
 class PlatformServices(object):
-    get_job_attempts = 10
-    get_job_delay = 10
+    get_job_schedule = Backoff("Agent activation job", initial_delay=0.5, max_delay=10, deadline=120, max_attempts=30)
 
     @classmethod
+    @traced("activation")
     def get_activation(cls, platform):
+        activation = journal.activation(platform)
+        if activation:
+            logger.debug("Using unused activation %s requested by an interrupted run", activation["id"])
+            return activation
         activation_url = platform.get_activation_url()
-        logger.debug("Getting auth token for agent activation on platform: %s" % platform.name)
-        token = platform.get_token()
-        logger.debug("Requesting agent activation: %s" % activation_url)
+        logger.debug("Getting auth token for agent activation on platform: %s", platform.name)
+        with tracer.span("get_token", platform=platform.name):
+            token = platform.get_token()
+        logger.debug("Requesting agent activation: %s", activation_url)
         response = HttpClient.post_json(activation_url, headers={"X-Auth-Token": token, "User-Agent": "Rackspace-SSM-Bootstrap/2.0"})
         if not response.ok:
             die("POST request to activation url %s failed: %s\n%s" % (activation_url, response.full_status, response.dump()), exitcode=108)
@@ -910,162 +2352,732 @@ class PlatformServices(object):
         job_url = response.headers["location"]
         logger.debug("Agent activation request responded with job: %s", job_url)
         job = cls.get_job(job_url, token)
-        return {
+        activation = {
             "code": job["message"]["activation_code"],
             "id": job["message"]["activation_id"],
             "region": job["message"]["region"],
             "system_account": job["message"]["system_account"],
         }
+        journal.record("activation", platform=platform.name, expires_at=time.time() + ACTIVATION_MAX_AGE, **activation)
+        return activation
 
     @staticmethod
     def format_job(job):
         return "Job Details:\n%s" % json.dumps(job)
 
     @classmethod
+    @traced("activation_job")
     def get_job(cls, job_url, token):
         job_data = None
-        for attempt in range(1, cls.get_job_attempts):
-            logger.debug("Requesting agent activation job (attempt: %d): %s" % (attempt, job_url))
+        for attempt in cls.get_job_schedule.attempts():
+            logger.debug("Requesting agent activation job (attempt: %d): %s", attempt, job_url)
             response = HttpClient.get_json(job_url, headers={"X-Auth-Token": token})
             if not response.ok:
                 die("GET request to job url %s failed: %s\nResponse:\n%s" % (job_url, response.full_status, response.dump()), exitcode=105)
             job_data = response.json()["data"]
-            logger.debug("Job data: %s" % job_data)
+            logger.debug("Job data: %s", job_data)
             job = job_data["items"][0]
             if job["status"] == "RUNNING":
-                logger.debug("Agent activation job %s still running, checking again in %d seconds" % (job_url, cls.get_job_delay))
-                time.sleep(cls.get_job_delay)
+                logger.debug("Agent activation job %s still running", job_url)
             elif job["status"] != "SUCCEEDED":
                 die(
                     "Agent activation job %s completed unsuccessfully (status: %s).\n%s" % (job_url, job["status"], PlatformServices.format_job(job)),
                     exitcode=106,
                 )
             elif job["status"] == "SUCCEEDED":
-                logger.debug("Agent activation job %s completed successfully.\n%s" % (job_url, PlatformServices.format_job(job)))
+                logger.debug("Agent activation job %s completed successfully.\n%s", job_url, PlatformServices.format_job(job))
                 return job
         die(
-            "Agent activation job %s did not complete after %d attempts.\nLast %s" % (job_url, cls.get_job_attempts, PlatformServices.format_job(job)),
+            "Agent activation job %s did not complete after %d attempts.\nLast %s" % (job_url, attempt, PlatformServices.format_job(job)),
             exitcode=107,
         )
 
 
+class Journal(object):
+    """
+    Durable record of the completed install and reregister phases and their outputs.
+
+    A run that is interrupted (cloud-init timeout, reboot) continues from the first incomplete phase instead of
+    repeating the package query, the download and the activation request.  The journal is rewritten atomically after
+    every phase and is readable by root only, as it holds activation codes.  Journaled phases are hints: every caller
+    verifies a phase (the installer digest, the agent binary, the activation expiry) before skipping it.
+    """
+
+    version = 1
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def file_path(self):
+        return guest_path(self.path)
+
+    def load(self):
+        path = self.file_path()
+        self.phases = {}
+        if not os.path.exists(path):
+            return self
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as err:
+            logger.warning("Ignoring unreadable journal %s: %s", path, err)
+            return self
+        if data.get("version") != self.version:
+            logger.debug("Ignoring journal %s with version %s", path, data.get("version"))
+            return self
+        self.phases = data.get("phases", {})
+        logger.debug("Loaded journal %s, completed phases: %s", path, ", ".join(sorted(self.phases)) or "none")
+        return self
+
+    def get(self, phase):
+        return self.phases.get(phase)
+
+    def record(self, phase, **outputs):
+        with self.lock:
+            self.phases[phase] = dict(outputs, completed_at=time.time())
+            self.save()
+
+    def discard(self, *phases):
+        with self.lock:
+            discarded = [phase for phase in phases if self.phases.pop(phase, None) is not None]
+            if discarded:
+                self.save()
+
+    def clear(self):
+        with self.lock:
+            self.phases = {}
+            try:
+                os.remove(self.file_path())
+            except OSError as err:
+                if os.path.exists(self.file_path()):
+                    logger.warning("Failed to remove journal %s: %s", self.file_path(), err)
+
+    def save(self):
+        path = self.file_path()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd = os.open("%s.tmp" % path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": self.version, "phases": self.phases}, f, indent=2, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename("%s.tmp" % path, path)
+        except (IOError, OSError) as err:
+            logger.warning("Failed to write journal %s, an interrupted run will start over: %s", path, err)
+
+    def activation(self, platform):
+        """
+        The journaled activation for `platform` if it was never used for a registration and has not expired.
+        """
+        entry = self.get("activation")
+        if not entry or entry.get("platform") != platform.name or entry.get("expires_at", 0) <= time.time():
+            return None
+        return dict((key, entry[key]) for key in ("code", "id", "region", "system_account"))
+
+
+journal = Journal()
+
+
+class InstallerCache(object):
+    """
+    On-disk cache of downloaded package installers, kept between runs.
+
+    Every installer url has its own entry directory holding the file and an "entry.json" with its SHA-256 digest and
+    the ETag/Last-Modified validators.  A cached entry whose digest matches the expected one is served without any
+    network access once its file is hashed again, otherwise it is revalidated with a conditional GET; interrupted
+    downloads are resumed with a Range request.  Entries are evicted once unused for longer than `max_age` seconds, or least recently used first
+    when the cache grows beyond `max_bytes`.
+    """
+
+    entry_file_name = "entry.json"
+
+    def __init__(self, directory=INSTALLER_CACHE_DIR, max_bytes=INSTALLER_CACHE_MAX_BYTES, max_age=INSTALLER_CACHE_MAX_AGE):
+        self.directory = guest_path(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.digests = {}
+
+    def entry_dir(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest()[:32])
+
+    def load_entry(self, entry_dir):
+        entry_path = os.path.join(entry_dir, self.entry_file_name)
+        if not file_exists(entry_path):
+            return None
+        try:
+            with open(entry_path, "r") as f:
+                entry = json.load(f)
+            installer_path = os.path.join(entry_dir, entry["file"])
+            size, entry["sha256"] = entry["size"], entry["sha256"].lower()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.debug("Ignoring corrupt installer cache entry: %s", entry_path)
+            return None
+        if not file_exists(installer_path) or os.path.getsize(installer_path) != size:
+            return None
+        entry["path"] = installer_path
+        return entry
+
+    def save_entry(self, entry_dir, entry):
+        entry = dict(entry, last_used=time.time())
+        entry.pop("path", None)
+        entry_path = os.path.join(entry_dir, self.entry_file_name)
+        file_write(json.dumps(entry), "%s.tmp" % entry_path)
+        os.rename("%s.tmp" % entry_path, entry_path)
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entry_dirs = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        return [entry_dir for entry_dir in entry_dirs if os.path.isdir(entry_dir)]
+
+    def file_digest(self, path):
+        """
+        SHA-256 digest of a cached installer file, hashed once per run for as long as its size and mtime are unchanged.
+        """
+        key = (path, os.path.getsize(path), os.path.getmtime(path))
+        if key not in self.digests:
+            digest = hashlib.sha256()
+            HttpClient.hash_file(path, digest)
+            self.digests[key] = digest.hexdigest()
+        return self.digests[key]
+
+    def find_by_digest(self, sha256):
+        """
+        The entry holding an installer with digest `sha256`.  The digest recorded in entry.json is only trusted after
+        the file is hashed again; an entry whose file no longer matches it is removed.
+        """
+        for entry_dir in self.entries():
+            entry = self.load_entry(entry_dir)
+            if not entry or entry["sha256"] != sha256.lower():
+                continue
+            if self.file_digest(entry["path"]) == entry["sha256"]:
+                return entry_dir, entry
+            logger.warning("Removing installer cache entry %s, its file does not have the recorded digest %s", entry_dir, entry["sha256"])
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        return None, None
+
+    def fetch(self, url, expected_sha256=None, mirrors=None):
+        """
+        Return `(response, installer_path)` for `url`, using the cache where possible.
+
+        `response` is None when the installer was served from the cache without a request.  The installer is
+        downloaded from `mirrors`, in order, when given; the entry stays keyed by `url`.  A mirror that fails, also
+        part way through the transfer, fails over to the next one, which resumes the partial file with a Range request
+        guarded by If-Range, so a mirror serving a different file restarts it instead.
+        """
+        if expected_sha256:
+            entry_dir, entry = self.find_by_digest(expected_sha256)
+            if entry:
+                logger.debug("Installer cache hit for digest %s: %s", expected_sha256, entry["path"])
+                self.save_entry(entry_dir, entry)
+                return None, entry["path"]
+
+        entry_dir = self.entry_dir(url)
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir)
+        entry = self.load_entry(entry_dir)
+        headers = {}
+        if entry and not expected_sha256:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        elif entry is None:
+            validator = self.load_validator(entry_dir)
+            if validator:
+                headers["If-Range"] = validator
+
+        sources = mirrors or [url]
+        for index, source in enumerate(sources):
+            try:
+                response, output_path = HttpClient.download(
+                    source,
+                    entry_dir,
+                    headers=headers,
+                    expected_sha256=expected_sha256,
+                    resume="If-Range" in headers,
+                    on_response=lambda response: self.save_validator(entry_dir, response),
+                )
+            except HttpClient.RequestException as err:
+                if isinstance(err, HttpClient.DigestMismatch) or index == len(sources) - 1:
+                    raise
+                logger.warning("Installer download from %s failed, failing over to %s: %s", source, sources[index + 1], err)
+            else:
+                if output_path is not None or response.status == 304 or index == len(sources) - 1:
+                    break
+                logger.warning("Installer download from %s failed, failing over to %s: %s", source, sources[index + 1], response.full_status)
+            validator = self.load_validator(entry_dir)
+            headers = {"If-Range": validator} if validator else {}
+        tracer.annotate(mirror=source)
+        if response.status == 304 and entry:
+            logger.debug("Installer cache entry for %s is still valid: %s", url, entry["path"])
+            self.save_entry(entry_dir, entry)
+            return response, entry["path"]
+        if output_path is None:
+            return response, None
+
+        entry = {
+            "url": url,
+            "file": os.path.basename(output_path),
+            "sha256": response.sha256,
+            "size": os.path.getsize(output_path),
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+        }
+        self.save_entry(entry_dir, entry)
+        logger.debug("Stored installer for %s in cache: %s", url, output_path)
+        self.evict(keep=entry_dir)
+        return response, output_path
+
+    def store(self, url, file_name, chunks, expected_sha256=None):
+        """
+        Store the installer for `url`, given as an iterable of byte `chunks`, in its entry without any request.
+
+        The chunks are hashed as they are written, and with `expected_sha256` the entry is only kept if they match.
+        """
+        entry_dir = self.entry_dir(url)
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir)
+        output_path = os.path.join(entry_dir, file_name)
+        partial_file = "%s.part" % output_path
+        digest = hashlib.sha256()
+        with open(partial_file, "wb") as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+        if expected_sha256 and digest.hexdigest() != expected_sha256.lower():
+            os.remove(partial_file)
+            raise HttpClient.DigestMismatch("Installer %s has SHA-256 digest %s, expected %s" % (url, digest.hexdigest(), expected_sha256))
+        os.rename(partial_file, output_path)
+        self.save_entry(entry_dir, {"url": url, "file": file_name, "sha256": digest.hexdigest(), "size": os.path.getsize(output_path)})
+        logger.debug("Stored installer for %s in cache: %s", url, output_path)
+        self.evict(keep=entry_dir)
+        return output_path
+
+    def load_validator(self, entry_dir):
+        """
+        Validator recorded when an interrupted download started, used as If-Range to resume it.
+        """
+        validator_path = os.path.join(entry_dir, "validator")
+        if not file_exists(validator_path):
+            return None
+        return file_read(validator_path).strip() or None
+
+    def save_validator(self, entry_dir, response):
+        if response.status != 206:
+            file_write(response.headers.get("etag") or response.headers.get("last-modified") or "", os.path.join(entry_dir, "validator"))
+
+    def entry_size(self, entry_dir):
+        return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+    def entry_last_used(self, entry_dir):
+        entry_path = os.path.join(entry_dir, self.entry_file_name)
+        if file_exists(entry_path):
+            return os.path.getmtime(entry_path)
+        return os.path.getmtime(entry_dir)
+
+    def evict(self, keep=None):
+        now = time.time()
+        entry_dirs = sorted(self.entries(), key=self.entry_last_used)
+        total = sum(self.entry_size(entry_dir) for entry_dir in entry_dirs)
+        for entry_dir in entry_dirs:
+            if entry_dir == keep:
+                continue
+            expired = now - self.entry_last_used(entry_dir) > self.max_age
+            if expired or total > self.max_bytes:
+                size = self.entry_size(entry_dir)
+                logger.debug("Evicting installer cache entry %s (%d bytes, expired: %s)", entry_dir, size, expired)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+
+
+class InstallerSource(object):
+    """
+    Pre-staged SSM Agent installers in a local directory, a file:// URL or an internal mirror, listed in a manifest.
+
+    The source is the directory holding "manifest.json", or the manifest itself.  The manifest maps
+    "<distro>/<arch>", or "<deb|rpm>/<arch>" for every distro using that package format, to an installer file
+    relative to the manifest and its SHA-256 digest:
+
+        {"packages": {"ubuntu/amd64": {"file": "debian_amd64/amazon-ssm-agent.deb", "sha256": "..."}}}
+
+    An installer is verified once, when it is copied or downloaded into the installer cache; later runs find it there
+    by digest.  A mirror's manifest is kept in the cache as well, so a host whose cache already holds the installer
+    that manifest names does not touch the network at all.
+    """
+
+    manifest_name = "manifest.json"
+    arches = {"x86_64": "amd64", "aarch64": "arm64"}
+
+    def __init__(self, source, cache):
+        u = urlparse(source)
+        self.remote = u.scheme in ("http", "https")
+        location = source if self.remote or not u.scheme else u.path
+        if not location.endswith(".json"):
+            location = "%s/%s" % (location.rstrip("/"), self.manifest_name)
+        self.manifest_location = location
+        self.cache = cache
+
+    @classmethod
+    def arch(cls):
+        machine = os.uname()[4]
+        return cls.arches.get(machine, machine)
+
+    def package_location(self, package):
+        return "%s/%s" % (self.manifest_location.rsplit("/", 1)[0], package["file"])
+
+    def parse_manifest(self, content):
+        try:
+            manifest = json.loads(content)
+            packages = manifest["packages"]
+            for key, package in packages.items():
+                file_name = package["file"]
+                if file_name.startswith("/") or ".." in file_name.split("/"):
+                    raise ValueError("'%s' is outside of the installer source" % file_name)
+                if len(package["sha256"]) != 64:
+                    raise ValueError("'%s' has no SHA-256 digest" % key)
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            die("Installer source manifest %s is invalid: %s" % (self.manifest_location, err), exitcode=140)
+        return packages
+
+    def cached_manifest(self):
+        if not self.remote:
+            return None
+        entry = self.cache.load_entry(self.cache.entry_dir(self.manifest_location))
+        return self.parse_manifest(file_read(entry["path"])) if entry else None
+
+    def load_manifest(self):
+        if not self.remote:
+            if not file_exists(self.manifest_location):
+                die("Installer source manifest %s does not exist" % self.manifest_location, exitcode=140)
+            return self.parse_manifest(file_read(self.manifest_location))
+        try:
+            response = HttpClient.get(self.manifest_location)
+        except HttpClient.RequestException as err:
+            die("Installer source manifest %s could not be fetched" % self.manifest_location, details=str(err), exitcode=140)
+        if not response.ok:
+            die("Installer source manifest %s could not be fetched:\n%s" % (self.manifest_location, response.dump()), exitcode=140)
+        packages = self.parse_manifest(response.text)
+        self.cache.store(self.manifest_location, self.manifest_name, [response.content])
+        return packages
+
+    def select(self, packages, distro, distro_config):
+        package_format = "deb" if distro_config.package_db == "dpkg" else "rpm"
+        for key in ("%s/%s" % (distro, self.arch()), "%s/%s" % (package_format, self.arch())):
+            if key in packages:
+                return packages[key]
+        return None
+
+    def fetch(self, distro, distro_config, expected_sha256=None):
+        """
+        Return `(location, installer_path)` of the manifest's installer for `distro` on this architecture.
+        """
+        packages = self.cached_manifest()
+        package = self.select(packages, distro, distro_config) if packages else None
+        if package is None or self.cache.find_by_digest(package["sha256"])[1] is None:
+            package = self.select(self.load_manifest(), distro, distro_config)
+        if package is None:
+            die("Installer source manifest %s has no installer for %s/%s" % (self.manifest_location, distro, self.arch()), exitcode=141)
+        if expected_sha256 and expected_sha256.lower() != package["sha256"].lower():
+            die("Installer source manifest %s lists SHA-256 digest %s, expected %s" % (self.manifest_location, package["sha256"], expected_sha256), exitcode=139)
+
+        location = self.package_location(package)
+        try:
+            if self.remote:
+                response, output_path = self.cache.fetch(location, expected_sha256=package["sha256"])
+                if output_path is None:
+                    die("Downloading SSM package installer from %s failed:\n%s" % (location, response.dump()), exitcode=126)
+                return location, output_path
+            entry_dir, entry = self.cache.find_by_digest(package["sha256"])
+            if entry:
+                logger.debug("Installer cache hit for digest %s: %s", package["sha256"], entry["path"])
+                self.cache.save_entry(entry_dir, entry)
+                return location, entry["path"]
+            if not file_exists(location):
+                die("SSM package installer %s listed in the installer source manifest does not exist" % location, exitcode=126)
+            with open(location, "rb") as f:
+                chunks = iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b"")
+                return location, self.cache.store(location, os.path.basename(location), chunks, expected_sha256=package["sha256"])
+        except HttpClient.DigestMismatch as err:
+            die(str(err), exitcode=139)
+
+
 class Package(object):
     @staticmethod
-    def download_installer(region=None):
+    def installer_probes(region=None, mirrors=None):
+        """
+        The HEAD requests probing every candidate installer url, prefetched once the package is known to be missing.
+        """
+        return [("HEAD", url, {}) for url in Distro.get_config(GuestOs.get_distro(), region).package_installer_urls(mirrors)]
+
+    @staticmethod
+    @traced("probe_mirrors")
+    def rank_mirrors(urls, expected_sha256=None):
+        """
+        Order the candidate installer `urls` by how fast their HEAD probe was answered, probing them concurrently.
+
+        Mirrors whose probe failed follow the responsive ones in their original order as a last resort, mirrors
+        without the installer are dropped.  When no mirror is left the install fails, unless `expected_sha256` may
+        still be served from the installer cache.
+        """
+        probes = [("HEAD", url, {}) for url in urls]
+        errors = Platform.metadata.fetch_missing(probes, timeout=INSTALLER_PROBE_TIMEOUT)
+        responsive, unresponsive, statuses = [], [], []
+        for url in urls:
+            probe = Platform.metadata.cached(("HEAD", url)) or errors.get(("HEAD", url))
+            if isinstance(probe, Exception) or probe is None:
+                logger.debug("Installer mirror %s: probe failed: %s", url, probe)
+                unresponsive.append(url)
+                statuses.append("%s: %s" % (url, probe))
+                continue
+            logger.debug("Installer mirror %s: %s in %.1f ms", url, probe.full_status, probe.elapsed * 1000)
+            statuses.append("%s: %s" % (url, probe.full_status))
+            if probe.ok:
+                responsive.append((probe.elapsed, url))
+            elif probe.status not in (403, 404, 410):
+                unresponsive.append(url)
+        # The sort is stable, mirrors answering equally fast keep their original order.
+        ranked = [url for _, url in sorted(responsive, key=lambda probe: probe[0])] + unresponsive
+        tracer.annotate(mirrors=len(urls), responsive=len(responsive))
+        if not ranked and expected_sha256 is None:
+            die("SSM package installer is not available from any mirror:\n%s" % "\n".join(statuses), exitcode=126)
+        if ranked:
+            logger.debug("Downloading the installer from the fastest mirror first: %s", ", ".join(ranked))
+        return ranked or urls
+
+    @staticmethod
+    @traced("download_installer")
+    def download_installer(region=None, expected_sha256=None, cache_dir=INSTALLER_CACHE_DIR, source=None, mirrors=None):
         distro = GuestOs.get_distro()
         distro_config = Distro.get_config(distro, region)
+        cache = InstallerCache(cache_dir)
+        if source:
+            location, output_path = InstallerSource(source, cache).fetch(distro, distro_config, expected_sha256=expected_sha256)
+            logger.debug("SSM installer from installer source %s: %s", location, output_path)
+            journal.record("installer", url=location, path=output_path, sha256=cache.load_entry(os.path.dirname(output_path))["sha256"])
+            return output_path
+        journaled = journal.get("installer")
+        if expected_sha256 is None and journaled and journaled.get("url") == distro_config.package_installer_url:
+            # Only pin the journaled digest while the cache still holds that installer, the url may have moved on.
+            if cache.find_by_digest(journaled["sha256"])[1]:
+                logger.debug("Using installer %s downloaded by an interrupted run", journaled["sha256"])
+                expected_sha256 = journaled["sha256"]
+        ranked = None
+        if expected_sha256 is None or cache.find_by_digest(expected_sha256)[1] is None:
+            ranked = Package.rank_mirrors(distro_config.package_installer_urls(mirrors), expected_sha256)
         try:
-            target_dir = tempfile.mkdtemp()
-            logger.debug("Downloading SSM package installer from %s to %s" % (distro_config.package_installer_url, target_dir))
-            response, output_path = HttpClient.download(distro_config.package_installer_url, target_dir)
-            if not response.ok:
+            logger.debug("Downloading SSM package installer from %s using cache %s", distro_config.package_installer_url, cache_dir)
+            try:
+                response, output_path = cache.fetch(distro_config.package_installer_url, expected_sha256=expected_sha256, mirrors=ranked)
+            except HttpClient.DigestMismatch as err:
+                die(str(err), exitcode=139)
+            if output_path is None:
                 die("Downloading SSM package installer from %s failed:\n%s" % (distro_config.package_installer_url, response.dump()), exitcode=126)
-            logger.debug("Download complete, SSM installer path: %s" % output_path)
+            logger.debug("Download complete, SSM installer path: %s", output_path)
+            entry = cache.load_entry(os.path.dirname(output_path))
+            journal.record("installer", url=distro_config.package_installer_url, path=output_path, sha256=entry["sha256"] if entry else expected_sha256)
             return output_path
         except HTTPException:
-            logger.exception("Failed to download SSM package installer from %s" % distro_config.package_installer_url)
+            logger.exception("Failed to download SSM package installer from %s", distro_config.package_installer_url)
             exit(1)
 
 
-def configure_ssm_profile():
-    config_dir = "/etc/amazon/ssm"
-    template_file = os.path.join(config_dir, "amazon-ssm-agent.json.template")
-    config_file = os.path.join(config_dir, "amazon-ssm-agent.json")
-    is_profile_updated = False
+class AgentConfig(object):
+    """
+    Transaction over the agent configuration of a run: the SSM profile, the proxy drop-in and the registration.
 
-    try:
-        # If config file doesn't exist, create it from template
-        if not os.path.exists(config_file):
-            if os.path.exists(template_file):
-                logger.debug("Creating SSM agent configuration file from template")
-                shutil.copy(template_file, config_file)
-            else:
-                logger.debug("SSM agent template configuration file not found: %s", template_file)
-                return False
+    Changes are collected first and diffed against the files on disk.  `commit()` writes only the files whose content
+    changes, each atomically, reloads systemd once if a unit drop-in changed and restarts the service once if anything
+    changed; the registration happens while the service is stopped for that restart.  A file that cannot be written is
+    logged and left as it is instead of failing the install.  With nothing to change the service is only started if it
+    is not running.  A restart still owed by an interrupted run is taken from the journal.
+    """
 
-        # Read and update the configuration file
-        with open(config_file, "r") as f:
-            config = json.load(f)
+    profile_dir = "/etc/amazon/ssm"
+    drop_in_dir = "/etc/systemd/system/amazon-ssm-agent.service.d"
+    proxy_override = """[Service]
+Environment=\"http_proxy=%s\"
+Environment=\"https_proxy=%s"
+Environment=\"no_proxy=169.254.169.254\"
+""".strip()
 
-        # Ensure Profile section exists
-        if "Profile" not in config:
-            config["Profile"] = {}
+    def __init__(self):
+        self.files = []
+        self.activation = None
 
-        # Update only the ShareProfile setting if it's different
-        if config["Profile"].get("ShareProfile") != "rackspace":
-            config["Profile"]["ShareProfile"] = "rackspace"
-            is_profile_updated = True
-
-        # Write the updated configuration only if changes were made
-        if is_profile_updated:
-            with open(config_file, "w") as f:
-                json.dump(config, f, indent=2)
-            logger.info("Updated SSM agent configuration to use 'rackspace' profile")
-        else:
-            logger.debug("SSM agent configuration already has 'rackspace' profile")
+    def set_file(self, path, content, unit=False):
+        self.files.append({"path": path, "content": content, "unit": unit})
 
-    except Exception:
-        logger.exception("Failed to update SSM agent configuration")
+    def set_profile(self):
+        config_dir = guest_path(self.profile_dir)
+        template_file = os.path.join(config_dir, "amazon-ssm-agent.json.template")
+        config_file = os.path.join(config_dir, "amazon-ssm-agent.json")
 
-    return is_profile_updated
+        # If config file doesn't exist, create it from template
+        source = config_file if os.path.exists(config_file) else template_file
+        if not os.path.exists(source):
+            logger.debug("SSM agent template configuration file not found: %s", template_file)
+            return
+        try:
+            with open(source, "r") as f:
+                config = json.load(f)
+        except (IOError, ValueError):
+            logger.exception("Failed to read SSM agent configuration %s", source)
+            return
 
+        # Update only the ShareProfile setting if it's different
+        profile = config.setdefault("Profile", {})
+        if source == config_file and profile.get("ShareProfile") == "rackspace":
+            logger.debug("SSM agent configuration already has 'rackspace' profile")
+            return
+        profile["ShareProfile"] = "rackspace"
+        self.set_file(config_file, json.dumps(config, indent=2))
+
+    def set_proxy(self, proxy_uri):
+        if not GuestOs.facts.command_path("systemctl"):
+            die("systemctl command not found in $PATH, bootstrap install cannot continue.", exitcode=130)
+        self.set_file(os.path.join(guest_path(self.drop_in_dir), "override.conf"), self.proxy_override % (proxy_uri, proxy_uri), unit=True)
+
+    def register(self, activation):
+        self.activation = activation
+
+    def changed_files(self):
+        import difflib
+
+        changed = []
+        for change in self.files:
+            current = file_read(change["path"]) if file_exists(change["path"]) else None
+            if current == change["content"]:
+                logger.debug("Agent configuration %s is up to date", change["path"])
+                continue
+            diff = difflib.unified_diff((current or "").splitlines(), change["content"].splitlines(), change["path"], change["path"], lineterm="")
+            logger.debug("Agent configuration %s changes:\n%s", change["path"], "\n".join(diff))
+            changed.append(change)
+        return changed
 
-def configure_proxy(proxy_uri):
-    config_directory = "/etc/systemd/system/amazon-ssm-agent.service.d"
-    if not os.path.exists(config_directory):
-        os.mkdir(config_directory)
-    if command_exists("systemctl"):
-        file = open(os.path.join(config_directory, "override.conf"), "w")
-        override = """[Service]
-Environment=\"http_proxy=%s\"
-Environment=\"https_proxy=%s"
-Environment=\"no_proxy=169.254.169.254\"
-""".strip()
-        file.write(override % (proxy_uri, proxy_uri))
-        file.close()
-        # reloading the modified unit files
-        run_command("systemctl daemon-reload")
-    else:
-        die("systemctl command not found in $PATH, bootstrap install cannot continue.", exitcode=130)
+    @staticmethod
+    def write_file(path, content):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd = os.open("%s.tmp" % path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(path):
+                shutil.copymode(path, "%s.tmp" % path)
+            os.rename("%s.tmp" % path, path)
+        except (IOError, OSError):
+            # The file on disk is left as it was, without the partly written copy next to it.
+            os.remove("%s.tmp" % path)
+            raise
+
+    @traced("configure_agent")
+    def commit(self):
+        """
+        Apply the collected changes and return whether the service was restarted.
+        """
+        changed = []
+        for change in self.changed_files():
+            try:
+                self.write_file(change["path"], change["content"])
+            except (IOError, OSError):
+                logger.exception("Failed to update agent configuration %s", change["path"])
+                continue
+            logger.info("Updated agent configuration %s", change["path"])
+            changed.append(change)
+        if changed:
+            journal.record("agent_config", restart_pending=True)
+
+        if any(change["unit"] for change in changed):
+            # reloading the modified unit files
+            run_command(["systemctl", "daemon-reload"])
+
+        restart = bool(changed or self.activation or (journal.get("agent_config") or {}).get("restart_pending"))
+        tracer.annotate(changed_files=len(changed), restart=restart)
+        if not restart:
+            if GuestOs.is_ssm_service_running():
+                logger.debug("Agent configuration is unchanged and the service is running, not restarting it")
+            else:
+                GuestOs.start_ssm_service()
+            return False
+
+        GuestOs.stop_ssm_service()
+        if self.activation:
+            GuestOs.register_ssm(self.activation)
+        GuestOs.start_ssm_service()
+        journal.record("agent_config", restart_pending=False)
+        return True
 
 
+@traced("install")
 def install(options):
     platform = Platform.get(options.platform)
-    logger.debug("Executing install command on platform %s" % platform.name)
+    logger.debug("Executing install command on platform %s", platform.name)
+    Platform.metadata.prefetch(platform.metadata_documents())
     try:
         if GuestOs.is_agent_disabled(platform):
             success("Found a truthy value for '%s' in %s metadata, skipping agent installation" % (IGNORE_TAG_KEY, options.platform))
         else:
-            logger.debug("Agent install is enabled, '%s' not found in metadata" % IGNORE_TAG_KEY)
+            logger.debug("Agent install is enabled, '%s' not found in metadata", IGNORE_TAG_KEY)
 
+        activation_task = None
         if not GuestOs.is_ssm_package_installed():
-            package_installer_path = Package.download_installer(region=options.installer_download_region)
-            GuestOs.install_ssm_package(package_installer_path)
+            if not options.installer_source:
+                Platform.metadata.prefetch(Package.installer_probes(options.installer_download_region, options.installer_mirror), timeout=INSTALLER_PROBE_TIMEOUT)
+            if GuestOs.has_registration_state():
+                logger.debug("Found the registration of an earlier agent, requesting an activation once it is known to be needed")
+            else:
+                # A guest that never had a registered agent needs an activation, which does not depend on anything the
+                # installer does and can be requested while the installer is downloaded and installed.
+                activation_task = Task("activation", PlatformServices.get_activation, platform).start()
+            try:
+                package_installer_path = Package.download_installer(
+                    region=options.installer_download_region,
+                    expected_sha256=options.installer_sha256,
+                    cache_dir=options.installer_cache_dir,
+                    source=options.installer_source,
+                    mirrors=options.installer_mirror,
+                )
+                GuestOs.install_ssm_package(package_installer_path)
+            except (SystemExit, HttpClient.RequestException):
+                if activation_task:
+                    # Let the activation request finish, so it is journaled and used by the next run instead of lost.
+                    activation_task.wait()
+                raise
 
         # Always configure the SSM profile
-        is_profile_updated = configure_ssm_profile()
+        config = AgentConfig()
+        config.set_profile()
+        if options.http_proxy:
+            config.set_proxy(options.http_proxy)
 
         registration = GuestOs.get_agent_information()
         if registration:
-            logger.debug("Agent is already registered: %s" % registration)
-            if is_profile_updated:
-                GuestOs.stop_ssm_service()
-
-            GuestOs.start_ssm_service()
+            logger.debug("Agent is already registered: %s", registration)
+            if activation_task:
+                activation_task.wait()
+            config.commit()
             GuestOs.check_ssm_activation()
             exit(0)
 
-        activation = PlatformServices.get_activation(platform)
-        if options.http_proxy:
-            configure_proxy(options.http_proxy)
-        GuestOs.activate_ssm(activation)
-        logger.debug("Waiting %d seconds before checking agent activation status" % REGISTRATION_WAIT)
-        time.sleep(REGISTRATION_WAIT)
-        GuestOs.check_ssm_activation()
+        if activation_task:
+            activation = activation_task.join()
+        else:
+            activation = PlatformServices.get_activation(platform)
+        config.register(activation)
+        config.commit()
+        GuestOs.check_ssm_activation(RegistrationWaiter().wait())
     except HttpClient.RequestException as err:
         die(str(err), exitcode=115)
 
 
+@traced("uninstall")
 def uninstall(options):
     logger.debug("Executing uninstall command")
     if not GuestOs.is_ssm_package_installed():
@@ -1075,48 +3087,61 @@ def uninstall(options):
     success("Agent was successfully uninstalled")
 
 
+@traced("reregister")
 def reregister(options):
     platform = Platform.get(options.platform)
-    logger.debug("Executing reregister command on platform %s" % platform.name)
+    logger.debug("Executing reregister command on platform %s", platform.name)
+    Platform.metadata.prefetch(platform.metadata_documents())
     try:
         if GuestOs.is_agent_disabled(platform):
             success("Found a truthy value for '%s' in %s metadata, skipping agent reregistration" % (IGNORE_TAG_KEY, options.platform))
         else:
-            logger.debug("Agent install is enabled, '%s' not found in metadata" % IGNORE_TAG_KEY)
+            logger.debug("Agent install is enabled, '%s' not found in metadata", IGNORE_TAG_KEY)
 
         if not GuestOs.is_ssm_package_installed():
             die("SSM package is not installed, cannot reregister agent", exitcode=128)
 
         GuestOs.clear_agent_registration()
         activation = PlatformServices.get_activation(platform)
-        GuestOs.activate_ssm(activation)
-        logger.debug("Waiting %d seconds before checking agent activation status" % REGISTRATION_WAIT)
-        time.sleep(REGISTRATION_WAIT)
-        GuestOs.check_ssm_activation()
+        config = AgentConfig()
+        config.register(activation)
+        config.commit()
+        GuestOs.check_ssm_activation(RegistrationWaiter().wait())
         success("Agent was successfully reregistered")
     except HttpClient.RequestException as err:
         die(str(err), exitcode=117)
 
 
 def main(args):
-    global logger
     global result_format
     global HTTP_PROXY
     global PLATFORM_SERVICES_BASE_URL
+    global GUEST_ROOT
+
+    import argparse
 
     scriptname = os.path.basename(__file__)
 
     parser = argparse.ArgumentParser(
         prog=scriptname,
         description="Rackspace management agent bootstrap script.",
-        formatter_class=RawTextHelpFormatter,
-        epilog="Exit Codes the script returns:\nExitcode: Description\n%s" % EXIT_CODES_FOR_EPILOG,
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog="Exit Codes the script returns:\nExitcode: Description\n%s" % exit_codes_epilog(),
     )
     parser.add_argument(
         "--log-level",
         dest="log_level",
-        default=logging.DEBUG,
+        default="DEBUG",
         choices=("DEBUG", "INFO", "WARN", "ERROR", "CRITICAL"),
+        help="Lowest level of the log records written to stdout (default: DEBUG), results are always written and the log file always keeps DEBUG",
+    )
+
+    parser.add_argument(
+        "--log-json-file",
+        dest="log_json_file",
+        metavar="path",
+        help="Also write the log to this file as JSON lines",
+        required=False,
     )
 
     parser.add_argument(
@@ -1126,6 +3151,17 @@ def main(args):
         choices=("text", "json"),
     )
 
+    # Runs against a fake root filesystem without root privileges, for the benchmark and the stand-in hosts.
+    parser.add_argument("--guest-root", dest="guest_root", default="/", help=argparse.SUPPRESS)
+
+    parser.add_argument(
+        "--trace-file",
+        dest="trace_file",
+        metavar="path",
+        help="Write a Chrome trace-event JSON file with the duration of every phase, HTTP request and command",
+        required=False,
+    )
+
     parser.add_argument(
         "--http-proxy",
         dest="http_proxy",
@@ -1150,6 +3186,32 @@ def main(args):
         help="AWS region to download SSM Agent installer from",
         required=False,
     )
+    install_cmd.add_argument(
+        "--installer-sha256",
+        metavar="digest",
+        help="Expected SHA-256 digest of the SSM Agent installer, the download is rejected if it does not match",
+        required=False,
+    )
+    install_cmd.add_argument(
+        "--installer-mirror",
+        metavar="url",
+        action="append",
+        help="Base url of a mirror laid out like the regional installer buckets, tried alongside them, may be given more than once",
+        required=False,
+    )
+    install_cmd.add_argument(
+        "--installer-source",
+        metavar="location",
+        help="Local directory, file:// URL or mirror base URL with a manifest.json listing SSM Agent installers to use instead of the public download",
+        required=False,
+    )
+    install_cmd.add_argument(
+        "--installer-cache-dir",
+        metavar="path",
+        help="Directory to cache SSM Agent installers in between runs (default: {})".format(INSTALLER_CACHE_DIR),
+        required=False,
+        default=INSTALLER_CACHE_DIR,
+    )
     install_cmd.add_argument(
         "--platform-services-base-url",
         metavar="url",
@@ -1185,25 +3247,36 @@ def main(args):
 
     options = parser.parse_args(args)
 
+    setup_logger(json_file=options.log_json_file)
+    set_log_level(options.log_level)
     result_format = options.result_format
     PLATFORM_SERVICES_BASE_URL = options.platform_services_base_url
+    GUEST_ROOT = os.path.abspath(options.guest_root)
 
-    if os.geteuid() != 0:
+    if GUEST_ROOT == "/" and os.geteuid() != 0:
         print("You need to have root privileges to run this script. Please try again, this time using 'sudo'")
         exit(1)
 
     if options.http_proxy:
         HTTP_PROXY = urlparse(options.http_proxy)
-        logger.info("Using http proxy: %s" % HTTP_PROXY.geturl())
-    if options.command == "install":
-        install(options)
-    elif options.command == "uninstall":
-        uninstall(options)
-    elif options.command == "reregister":
-        reregister(options)
-    else:
-        logger.error("Unknown command: %s, exiting..." % options.command)
-        sys.exit(1)
+        logger.info("Using http proxy: %s", HTTP_PROXY.geturl())
+    journal.load()
+    GuestOs.facts.prefetch()
+    try:
+        if options.command == "install":
+            install(options)
+        elif options.command == "uninstall":
+            uninstall(options)
+        elif options.command == "reregister":
+            reregister(options)
+        else:
+            logger.error("Unknown command: %s, exiting...", options.command)
+            sys.exit(1)
+    finally:
+        HttpClient.pool.close_all()
+        if options.trace_file:
+            tracer.write(options.trace_file)
+        stop_logging()
 
 
 if __name__ == "__main__":
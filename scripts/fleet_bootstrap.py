@@ -0,0 +1,266 @@
+"""
+Run bootstrap.py across a fleet of hosts with bounded concurrency and an aggregated report.
+
+The inventory is a JSONL file with one host per line:
+
+    {"host": "prod-app-01", "platform": "openstack", "region": "us-east-1"}
+    {"host": "prod-app-02", "platform": "openstack", "command": "reregister"}
+
+`command` defaults to --command and `region` is passed as --installer-download-region.  At most --concurrency hosts
+run at once and new runs are started through a token bucket (--rate per second, --burst at once).  The bucket limits
+how fast host runs start, not the requests they make; as a run requests its activation early, it spreads the
+activation requests to Platform Services over time without bounding their rate.  Every host's exit code (described
+from bootstrap.EXIT_CODES) and phase timings from its `--result-format json` result are collected into one report.
+A progress line per host goes to stderr, so the report on stdout stays valid JSON.
+
+With --transport ssh each host runs `--remote-command` over `--ssh-command`.  With --transport local each host is a
+stand-in (see stand_ins.py): a subprocess with its own fake guest root, talking to local stand-in services, which makes
+the orchestrator testable without real hosts:
+
+    python scripts/fleet_bootstrap.py --inventory hosts.jsonl --transport local --concurrency 50 --rate 20
+"""
+import argparse
+import ast
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark_bootstrap import percentile
+from stand_ins import SCRIPTS_DIR, FakeServices, load_bootstrap
+
+COMMANDS = ("install", "reregister", "uninstall")
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` acquisitions per second on average and bursts of up to `burst`; `acquire()` blocks until allowed.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def load_inventory(path, default_command):
+    hosts = []
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                host = json.loads(line)
+            except ValueError as err:
+                raise ValueError("%s:%d: invalid JSON: %s" % (path, line_number, err))
+            if "host" not in host:
+                raise ValueError("%s:%d: missing 'host'" % (path, line_number))
+            host.setdefault("command", default_command)
+            if host["command"] not in COMMANDS:
+                raise ValueError("%s:%d: unknown command '%s'" % (path, line_number, host["command"]))
+            if host["command"] != "uninstall" and "platform" not in host:
+                raise ValueError("%s:%d: missing 'platform'" % (path, line_number))
+            hosts.append(host)
+    return hosts
+
+
+def bootstrap_args(host):
+    args = ["--result-format", "json", host["command"]]
+    if host["command"] != "uninstall":
+        args += ["--platform", host["platform"]]
+    if host["command"] == "install" and host.get("region"):
+        args += ["--installer-download-region", host["region"]]
+    return args
+
+
+def parse_result(output):
+    """
+    The `--result-format json` result is the last line of the output that holds a result dict.
+    """
+    for line in reversed(output.splitlines()):
+        line = line.strip()
+        if line.startswith("{") and "'timestamp'" in line:
+            try:
+                return ast.literal_eval(line)
+            except (ValueError, SyntaxError):
+                return None
+    return None
+
+
+class SshTransport(object):
+    def __init__(self, ssh_command, remote_command):
+        self.ssh_command = ssh_command
+        self.remote_command = remote_command
+
+    def argv(self, host):
+        remote = " ".join([self.remote_command] + [shlex.quote(arg) for arg in bootstrap_args(host)])
+        return shlex.split(self.ssh_command.format(host=host["host"])) + [remote]
+
+
+class LocalTransport(object):
+    """
+    Runs every host as a stand-in subprocess with its own guest root below `work_dir`.
+    """
+
+    def __init__(self, work_dir, services_url):
+        self.work_dir = work_dir
+        self.services_url = services_url
+
+    def argv(self, host):
+        guest_root = os.path.join(self.work_dir, host["host"])
+        stand_ins = os.path.join(SCRIPTS_DIR, "stand_ins.py")
+        return [sys.executable, stand_ins, "run", "--guest-root", guest_root, "--services-url", self.services_url, "--"] + bootstrap_args(host)
+
+
+class Orchestrator(object):
+    def __init__(self, hosts, transport, concurrency=10, rate=0, burst=1, timeout=1800):
+        self.hosts = hosts
+        self.transport = transport
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.timeout = timeout
+        self.exit_codes = load_bootstrap().EXIT_CODES
+
+    def describe(self, exitcode):
+        if exitcode == 0:
+            return "Success"
+        return self.exit_codes.get(str(exitcode), "Unknown exit code")
+
+    def run_host(self, host):
+        self.bucket.acquire()
+        argv = self.transport.argv(host)
+        started_at = time.time()
+        try:
+            process = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=self.timeout)
+            exitcode, output = process.returncode, process.stdout
+        except subprocess.TimeoutExpired as err:
+            exitcode, output = None, err.output or ""
+        wall = time.time() - started_at
+
+        result = parse_result(output) or {}
+        host_report = {
+            "host": host["host"],
+            "platform": host.get("platform"),
+            "region": host.get("region"),
+            "command": host["command"],
+            "exitcode": exitcode,
+            "description": "Timed out after %d seconds" % self.timeout if exitcode is None else self.describe(exitcode),
+            "message": result.get("message"),
+            "wall": round(wall, 3),
+            "phases": result.get("phases", {}),
+        }
+        if exitcode != 0:
+            host_report["output_tail"] = output.splitlines()[-20:]
+        print("%-30s %-10s exit %-4s %7.2fs %s" % (host["host"], host["command"], exitcode, wall, host_report["description"]), file=sys.stderr)
+        sys.stderr.flush()
+        return host_report
+
+    def run(self):
+        started_at = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            host_reports = list(pool.map(self.run_host, self.hosts))
+        return self.report(host_reports, time.time() - started_at)
+
+    def report(self, host_reports, elapsed):
+        by_exit_code = {}
+        phases = {}
+        for host_report in host_reports:
+            code = "timeout" if host_report["exitcode"] is None else str(host_report["exitcode"])
+            entry = by_exit_code.setdefault(code, {"count": 0, "description": host_report["description"], "hosts": []})
+            entry["count"] += 1
+            entry["hosts"].append(host_report["host"])
+            for phase, duration in host_report["phases"].items():
+                phases.setdefault(phase, []).append(duration)
+        phases["wall"] = [host_report["wall"] for host_report in host_reports]
+
+        return {
+            "summary": {
+                "hosts": len(host_reports),
+                "succeeded": sum(1 for host_report in host_reports if host_report["exitcode"] == 0),
+                "failed": sum(1 for host_report in host_reports if host_report["exitcode"] != 0),
+                "elapsed": round(elapsed, 3),
+                "by_exit_code": by_exit_code,
+            },
+            "phases": dict(
+                (phase, {"p50": round(percentile(values, 0.5), 3), "p95": round(percentile(values, 0.95), 3), "max": round(max(values), 3)})
+                for phase, values in phases.items()
+                if values
+            ),
+            "hosts": host_reports,
+        }
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Run bootstrap.py across a fleet of hosts.")
+    parser.add_argument("--inventory", required=True, help="JSONL inventory, one host per line")
+    parser.add_argument("--command", choices=COMMANDS, default="install", help="Command for hosts that do not set one (default: install)")
+    parser.add_argument("--concurrency", type=int, default=10, help="Hosts to bootstrap at once (default: 10)")
+    parser.add_argument("--rate", type=float, default=5, help="Host runs started per second, 0 for no limit (default: 5)")
+    parser.add_argument("--burst", type=int, default=10, help="Host runs that may start at once (default: 10)")
+    parser.add_argument("--timeout", type=int, default=1800, help="Seconds before a host run is abandoned (default: 1800)")
+    parser.add_argument("--report", metavar="path", help="Write the aggregated JSON report to this file (default: stdout)")
+    parser.add_argument("--transport", choices=("ssh", "local"), default="ssh")
+    parser.add_argument("--ssh-command", default="ssh -o BatchMode=yes {host}", help="ssh transport: command connecting to {host}")
+    parser.add_argument(
+        "--remote-command",
+        default="sudo python3 /usr/local/bin/bootstrap.py",
+        help="ssh transport: command running bootstrap.py on the host (default: sudo python3 /usr/local/bin/bootstrap.py)",
+    )
+    parser.add_argument("--services-url", help="local transport: stand-in services url (default: start them in-process)")
+    parser.add_argument("--job-seconds", type=float, default=1.0, help="local transport: seconds in-process stand-in jobs stay RUNNING")
+    parser.add_argument("--work-dir", help="local transport: directory for the stand-in guest roots (default: a temporary directory)")
+    return parser.parse_args(args)
+
+
+def main(args):
+    options = parse_args(args)
+    hosts = load_inventory(options.inventory, options.command)
+
+    services = None
+    if options.transport == "local":
+        services_url = options.services_url
+        if not services_url:
+            services = FakeServices(job_seconds=options.job_seconds, installer_size=1024 * 1024).start()
+            services_url = services.base_url
+        transport = LocalTransport(options.work_dir or tempfile.mkdtemp(prefix="fleet-bootstrap-"), services_url)
+    else:
+        transport = SshTransport(options.ssh_command, options.remote_command)
+
+    try:
+        report = Orchestrator(hosts, transport, options.concurrency, options.rate, options.burst, options.timeout).run()
+    finally:
+        if services:
+            services.stop()
+
+    if options.report:
+        with open(options.report, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0 if report["summary"]["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,366 @@
+"""
+Split one deployment of this module into N independently planned and applied shards, and merge their outputs back.
+
+`split` reads the root module inputs (JSON tfvars, with the defaults taken from variables.tf) and writes, per shard,
+a working directory that links the root module's files and adds:
+
+    <out-dir>/shard-00/terraform.tfvars.json   the inputs with this shard's VMs, static_ips and add_nics_static_ips
+    <out-dir>/shard-00/backend_override.tf     the backend of this shard's state
+    <out-dir>/shards.json                      the manifest `merge` reads
+
+Every VM keeps its name, so the resource keys in each shard are the ones the single deployment uses.  A VM is placed
+in shard `sha256(name) % N`, which keeps existing VMs in their shard when the fleet grows; changing N moves VMs.
+The shard tfvars therefore set `use_name_formatting = false` and list the VM names explicitly.
+
+compute_instance picks a VM's primary IP as `static_ips[<trailing number of the name> - 1]`, so a shard's static_ips
+keeps every address at its original position up to the shard's highest one, with "" at the positions of VMs in other
+shards (never read by this shard).  add_nics reads `add_nics_static_ips[nic_index * len(vms) + vm_index]`, so that
+list is re-laid out NIC-major over the shard's VMs.  Either way each VM gets exactly the addresses it would get
+without sharding.
+
+The module itself declares no backend, as it is mostly used as a child module.  Without --backend-config each shard
+gets its own local state file; for a remote backend pass its type and settings, e.g. `--backend-type s3
+--backend-config bucket=tfstate --backend-config key=fleet/{shard}.tfstate`.  Shards run in parallel, each in its
+own directory:
+
+    python scripts/shard_fleet.py split --var-file fleet.tfvars.json --shards 8 --out-dir shards
+    cd shards/shard-00
+    terraform init
+    terraform apply
+    terraform output -json > outputs.json
+
+`merge` combines every shard's outputs.json into the outputs of one deployment and can also write a fleet_bootstrap.py
+inventory:
+
+    python scripts/shard_fleet.py merge --out-dir shards --output fleet-outputs.json --fleet-inventory hosts.jsonl
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VARIABLES_FILE = os.path.join(ROOT_DIR, "variables.tf")
+MANIFEST_NAME = "shards.json"
+TFVARS_NAME = "terraform.tfvars.json"
+BACKEND_NAME = "backend_override.tf"
+OUTPUTS_NAME = "outputs.json"
+# Root module entries a shard directory does not link: state, var files and terraform's working data.
+UNLINKED = re.compile(r"^\.|\.tfvars(\.json)?$|\.tfstate(\.backup)?$")
+
+# Root outputs, all maps keyed by VM name.
+OUTPUTS = ("vm_ids", "floating_ips", "additional_volumes", "additional_nics_ports", "primary_ips")
+
+
+def load_variable_defaults(path=VARIABLES_FILE):
+    """
+    Defaults of the variables in a variables.tf whose default is a JSON compatible literal (true, 1, "vm", [], {}).
+    """
+    defaults = {}
+    with open(path, "r") as f:
+        text = f.read()
+    for match in re.finditer(r'^variable\s+"([^"]+)"\s*{(.*?)^}', text, re.MULTILINE | re.DOTALL):
+        default = re.search(r"^\s*default\s*=\s*(.+?)\s*$", match.group(2), re.MULTILINE)
+        if not default:
+            continue
+        try:
+            defaults[match.group(1)] = json.loads(default.group(1))
+        except ValueError:
+            pass
+    return defaults
+
+
+def load_var_files(var_files):
+    """
+    The variables set by the var files, later files overriding earlier ones like terraform does.
+    """
+    variables = {}
+    for path in var_files:
+        if not path.endswith(".json"):
+            raise ValueError("%s: only JSON tfvars are supported" % path)
+        with open(path, "r") as f:
+            try:
+                values = json.load(f)
+            except ValueError as err:
+                raise ValueError("%s: invalid JSON: %s" % (path, err))
+        if not isinstance(values, dict):
+            raise ValueError("%s: expected an object of variables" % path)
+        variables.update(values)
+    return variables
+
+
+def vm_names(variables):
+    """
+    The VM names in the order the modules create them (local.vm_names).
+    """
+    if variables.get("use_name_formatting", True):
+        base_name = variables.get("instance_base_name", "vm")
+        names = ["%s-%02d" % (base_name, i + 1) for i in range(int(variables.get("vm_count", 1)))]
+    else:
+        names = list(variables.get("instance_names") or [])
+    seen = set()
+    duplicates = sorted(set(name for name in names if name in seen or seen.add(name)))
+    if duplicates:
+        raise ValueError("duplicate VM names: %s" % ", ".join(duplicates))
+    return names
+
+
+def name_index(name):
+    """
+    The static_ips position compute_instance reads for a VM: the trailing number of its name less one, or None.
+    """
+    match = re.search(r"[0-9]+$", name)
+    if not match or int(match.group(0)) < 1:
+        return None
+    return int(match.group(0)) - 1
+
+
+def static_ip_index(name, static_ips):
+    """
+    The static_ips position compute_instance reads for a VM, or None when it gets no static IP.
+    """
+    index = name_index(name)
+    return index if index is not None and index < len(static_ips) else None
+
+
+def shard_index(name, shards):
+    return int(hashlib.sha256(name.encode("utf-8")).hexdigest(), 16) % shards
+
+
+class Shard(object):
+    def __init__(self, index):
+        self.index = index
+        self.name = "shard-%02d" % index
+        self.vm_indexes = []
+
+    def static_ips(self, names, static_ips):
+        """
+        static_ips with this shard's addresses at their original positions and "" at positions only other shards read.
+        """
+        indexes = [static_ip_index(names[vm_index], static_ips) for vm_index in self.vm_indexes]
+        indexes = set(index for index in indexes if index is not None)
+        if not indexes:
+            return []
+        return [static_ips[i] if i in indexes else "" for i in range(max(indexes) + 1)]
+
+    def add_nics_static_ips(self, vm_total, nic_total, add_nics_static_ips):
+        """
+        add_nics_static_ips laid out NIC-major over this shard's VMs.  NICs the full list has no address for are at
+        its end, and so also at the end here since the shard keeps the global VM order, and are left out the same way.
+        """
+        layout = []
+        for nic_index in range(nic_total):
+            for vm_index in self.vm_indexes:
+                position = nic_index * vm_total + vm_index
+                if position >= len(add_nics_static_ips):
+                    return layout
+                layout.append(add_nics_static_ips[position])
+        return layout
+
+    def tfvars(self, values, variables, names):
+        tfvars = dict(values)
+        tfvars["use_name_formatting"] = False
+        tfvars["instance_names"] = [names[vm_index] for vm_index in self.vm_indexes]
+        tfvars["vm_count"] = len(self.vm_indexes)
+        tfvars["static_ips"] = self.static_ips(names, variables.get("static_ips") or [])
+        tfvars["add_nics_static_ips"] = self.add_nics_static_ips(
+            len(names), len(variables.get("additional_nics") or []), variables.get("add_nics_static_ips") or []
+        )
+        return tfvars
+
+
+def backend_config(shard_dir, shard_name, backend_type, settings):
+    if not settings and backend_type == "local":
+        return [("path", os.path.join(os.path.abspath(shard_dir), "terraform.tfstate"))]
+    return [(key, value.format(shard=shard_name)) for key, value in settings or []]
+
+
+def backend_override(backend_type, settings):
+    """
+    A terraform block declaring the backend, for an override file (the module itself declares none).
+    """
+    lines = ["terraform {", '  backend "%s" {' % backend_type]
+    lines += ["    %s = %s" % (key, json.dumps(value)) for key, value in settings]
+    return "\n".join(lines + ["  }", "}", ""])
+
+
+def link_module(module_dir, shard_dir):
+    """
+    Link the root module's files and directories into `shard_dir`, making it a working directory of the module.
+    """
+    out_dir = os.path.dirname(os.path.abspath(shard_dir))
+    for entry in sorted(os.listdir(module_dir)):
+        source = os.path.join(os.path.abspath(module_dir), entry)
+        target = os.path.join(shard_dir, entry)
+        if UNLINKED.search(entry) or source == out_dir or os.path.lexists(target):
+            continue
+        os.symlink(source, target)
+
+
+def write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def split(values, defaults, shard_count, out_dir, backend_type="local", backend_settings=None, module_dir=ROOT_DIR):
+    """
+    Write the shards of the deployment the var file `values` and variables.tf `defaults` describe, and the manifest.
+    """
+    variables = dict(defaults)
+    variables.update(values)
+    names = vm_names(variables)
+    shards = [Shard(index) for index in range(shard_count)]
+    for vm_index, name in enumerate(names):
+        shards[shard_index(name, shard_count)].vm_indexes.append(vm_index)
+
+    manifest = {"vm_count": len(names), "shards": []}
+    for shard in shards:
+        shard_dir = os.path.join(out_dir, shard.name)
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+        tfvars = shard.tfvars(values, variables, names)
+        write_json(os.path.join(shard_dir, TFVARS_NAME), tfvars)
+        with open(os.path.join(shard_dir, BACKEND_NAME), "w") as f:
+            f.write(backend_override(backend_type, backend_config(shard_dir, shard.name, backend_type, backend_settings)))
+        link_module(module_dir, shard_dir)
+        manifest["shards"].append({"name": shard.name, "vm_count": len(shard.vm_indexes), "instance_names": tfvars["instance_names"]})
+    write_json(os.path.join(out_dir, MANIFEST_NAME), manifest)
+    return manifest
+
+
+def output_values(outputs):
+    """
+    `terraform output -json` wraps every value as {"sensitive": ..., "type": ..., "value": ...}; plain values pass as is.
+    """
+    values = {}
+    for name, output in outputs.items():
+        if isinstance(output, dict) and "value" in output and "type" in output:
+            output = output["value"]
+        values[name] = output
+    return values
+
+
+def merge(out_dir):
+    """
+    The outputs of every shard in the manifest merged into the outputs of one deployment.  Every VM must be reported
+    by its own shard and by no other.
+    """
+    with open(os.path.join(out_dir, MANIFEST_NAME), "r") as f:
+        manifest = json.load(f)
+
+    merged = dict((name, {}) for name in OUTPUTS)
+    owners = {}
+    for shard in manifest["shards"]:
+        path = os.path.join(out_dir, shard["name"], OUTPUTS_NAME)
+        if not shard["instance_names"]:
+            continue
+        if not os.path.exists(path):
+            raise ValueError("%s: missing, run `terraform output -json > %s` for %s" % (path, path, shard["name"]))
+        with open(path, "r") as f:
+            try:
+                values = output_values(json.load(f))
+            except ValueError as err:
+                raise ValueError("%s: invalid JSON: %s" % (path, err))
+        expected = set(shard["instance_names"])
+        for output in OUTPUTS:
+            for vm_name, value in (values.get(output) or {}).items():
+                if vm_name not in expected:
+                    raise ValueError("%s: %s reports VM '%s' that is not in %s" % (path, output, vm_name, shard["name"]))
+                if vm_name in merged[output]:
+                    raise ValueError("%s: %s reports VM '%s' also reported by %s" % (path, output, vm_name, owners[vm_name]))
+                merged[output][vm_name] = value
+                owners[vm_name] = shard["name"]
+
+    missing = sorted(set(name for shard in manifest["shards"] for name in shard["instance_names"]) - set(merged["vm_ids"]))
+    if missing:
+        raise ValueError("VMs missing from the shard outputs: %s" % ", ".join(missing))
+    return merged
+
+
+def fleet_inventory(merged, platform, region=None):
+    """
+    fleet_bootstrap.py inventory lines, reaching every VM on its floating IP or else its primary IP.
+    """
+    hosts = []
+    for vm_name in sorted(merged["vm_ids"]):
+        address = merged["floating_ips"].get(vm_name) or merged["primary_ips"].get(vm_name)
+        if not address:
+            continue
+        host = {"host": address, "name": vm_name, "platform": platform}
+        if region:
+            host["region"] = region
+        hosts.append(host)
+    return hosts
+
+
+def backend_setting(value):
+    key, separator, setting = value.partition("=")
+    if not separator or not key:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE, got '%s'" % value)
+    return key, setting
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Split a deployment into independent shards and merge their outputs.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    split_parser = subparsers.add_parser("split", help="Write per-shard working directories with their tfvars and backend")
+    split_parser.add_argument("--var-file", action="append", required=True, help="JSON tfvars of the deployment, repeat to layer them")
+    split_parser.add_argument("--variables-file", default=VARIABLES_FILE, help="variables.tf with the defaults (default: the root module's)")
+    split_parser.add_argument("--shards", type=int, required=True, help="Number of shards")
+    split_parser.add_argument("--out-dir", required=True, help="Directory for the shard directories and the manifest")
+    split_parser.add_argument("--backend-type", default="local", help="Backend of the shard states (default: local)")
+    split_parser.add_argument(
+        "--backend-config",
+        action="append",
+        type=backend_setting,
+        metavar="KEY=VALUE",
+        help="Backend setting for every shard, {shard} is replaced by the shard name (default: a local state file per shard)",
+    )
+
+    merge_parser = subparsers.add_parser("merge", help="Merge the shard outputs into one")
+    merge_parser.add_argument("--out-dir", required=True, help="Directory split wrote to, with <shard>/%s from `terraform output -json`" % OUTPUTS_NAME)
+    merge_parser.add_argument("--output", metavar="path", help="Write the merged outputs to this file (default: stdout)")
+    merge_parser.add_argument("--fleet-inventory", metavar="path", help="Also write a fleet_bootstrap.py JSONL inventory")
+    merge_parser.add_argument("--platform", default="openstack", help="Inventory platform (default: openstack)")
+    merge_parser.add_argument("--region", help="Inventory installer download region")
+
+    options = parser.parse_args(args)
+    if options.command == "split" and options.shards < 1:
+        parser.error("--shards must be at least 1")
+    return options
+
+
+def main(args):
+    options = parse_args(args)
+    try:
+        if options.command == "split":
+            values = load_var_files(options.var_file)
+            defaults = load_variable_defaults(options.variables_file)
+            manifest = split(values, defaults, options.shards, options.out_dir, options.backend_type, options.backend_config)
+            for shard in manifest["shards"]:
+                print("%-10s %6d VMs" % (shard["name"], shard["vm_count"]))
+            return 0
+
+        merged = merge(options.out_dir)
+    except (IOError, OSError, ValueError) as err:
+        print("Error: %s" % err, file=sys.stderr)
+        return 1
+
+    if options.output:
+        write_json(options.output, merged)
+    else:
+        print(json.dumps(merged, indent=2, sort_keys=True))
+    if options.fleet_inventory:
+        with open(options.fleet_inventory, "w") as f:
+            for host in fleet_inventory(merged, options.platform, options.region):
+                f.write(json.dumps(host) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
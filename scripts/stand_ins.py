@@ -0,0 +1,281 @@
+"""
+Local stand-ins for the services and guest a bootstrap run talks to.
+
+`FakeServices` is an HTTP server standing in for the OpenStack vendordata endpoint, the Platform Services activation
+and job API and the installer host.  `create_guest_root()` builds a fake guest root with stub `dpkg`, `rpm`, `yum`,
+`systemctl`, `amazon-ssm-agent` and `ssm-cli` binaries.  Used by the benchmark and the fleet orchestrator, and from
+the command line:
+
+    python scripts/stand_ins.py serve --job-seconds 2
+    python scripts/stand_ins.py run --guest-root /tmp/host1 --services-url http://127.0.0.1:8080 -- install -p openstack
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STUBS = {
+    "dpkg": """
+STATUS="$ROOT/var/lib/dpkg/status"
+case "$1" in
+  -l) test -f "$STATE/installed" ;;
+  -i) sleep "${STUB_INSTALL_SECONDS:-0}"; install_agent
+      mkdir -p "$(dirname "$STATUS")"
+      printf 'Package: amazon-ssm-agent\nStatus: install ok installed\nVersion: %s\n\n' "$AGENT_VERSION" > "$STATUS" ;;
+  -r) rm -f "$STATE/installed"
+      printf 'Package: amazon-ssm-agent\nStatus: deinstall ok config-files\nVersion: %s\n\n' "$AGENT_VERSION" > "$STATUS" ;;
+esac
+""",
+    "rpm": """
+case "$1" in
+  -q) if test -f "$STATE/installed"; then printf '%s' "$AGENT_VERSION"; else echo "package amazon-ssm-agent is not installed"; exit 1; fi ;;
+  --install) sleep "${STUB_INSTALL_SECONDS:-0}"; install_agent ;;
+  -e) rm -f "$STATE/installed" ;;
+esac
+""",
+    "yum": """
+case "$1" in
+  list) test -f "$STATE/installed" ;;
+  install) sleep "${STUB_INSTALL_SECONDS:-0}"; install_agent ;;
+  remove) rm -f "$STATE/installed" ;;
+esac
+""",
+    "systemctl": """
+case "$1" in
+  start) touch "$STATE/running" ;;
+  stop) rm -f "$STATE/running" ;;
+  is-active) test -f "$STATE/running" ;;
+esac
+""",
+    "amazon-ssm-agent": """
+REGISTRATION="$ROOT/var/lib/amazon/ssm/registration"
+case "$*" in
+  *-clear*) rm -f "$STATE/registered" "$REGISTRATION" ;;
+  *-register*) sleep "${STUB_REGISTER_SECONDS:-0}"; touch "$STATE/registered"
+      mkdir -p "$(dirname "$REGISTRATION")"
+      echo '{"ManagedInstanceID": "mi-0123456789abcdef0", "Region": "us-east-1"}' > "$REGISTRATION" ;;
+esac
+""",
+    "ssm-cli": """
+case "$1" in
+  get-diagnostics) echo '{"DiagnosticsOutput": [{"Check": "Connectivity", "Status": "Success", "Note": ""}]}' ;;
+  get-instance-information)
+    test -f "$STATE/registered" || { echo "error: agent is not registered"; exit 1; }
+    echo '{"instance-id": "mi-0123456789abcdef0", "region": "us-east-1"}' ;;
+esac
+""",
+}
+
+# Installing the stub package also installs the agent configuration template, like the real package does.
+INSTALL_AGENT = """AGENT_VERSION="3.3.0.0-1"
+install_agent() {
+  mkdir -p "$ROOT/etc/amazon/ssm"
+  echo '{"Profile": {"ShareCreds": true, "ShareProfile": ""}}' > "$ROOT/etc/amazon/ssm/amazon-ssm-agent.json.template"
+  touch "$STATE/installed"
+}
+"""
+
+
+def create_guest_root(path, distro="ubuntu"):
+    """
+    Create a fake guest root with an os-release file and stub agent/package binaries, returning the stub bin dir.
+    """
+    state_dir = os.path.join(path, "var", "lib", "fake-agent")
+    bin_dir = os.path.join(path, "usr", "local", "bin")
+    for directory in (os.path.join(path, "etc"), state_dir, bin_dir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    with open(os.path.join(path, "etc", "os-release"), "w") as f:
+        f.write('NAME="Fake Linux"\nID=%s\n' % distro)
+    for name, body in STUBS.items():
+        stub_path = os.path.join(bin_dir, name)
+        with open(stub_path, "w") as f:
+            f.write('#!/bin/sh\nROOT="%s"\nSTATE="%s"\n%s%s' % (path, state_dir, INSTALL_AGENT, body.lstrip()))
+        os.chmod(stub_path, 0o755)
+    return bin_dir
+
+
+class FakeServices(object):
+    """
+    Local HTTP server standing in for vendordata, Platform Services and the installer host.
+
+    Activation jobs stay RUNNING for `job_seconds` after the activation request; the installer body is served at
+    `bandwidth` bytes per second (unthrottled when 0) after `latency` seconds of delay on every request.
+    """
+
+    def __init__(self, job_seconds=1.0, bandwidth=0, installer_size=20 * 1024 * 1024, latency=0.0, port=0):
+        self.job_seconds = job_seconds
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.installer = os.urandom(installer_size)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d" % self.server.server_port
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_job(self):
+        with self.lock:
+            job_id = "job-%d" % len(self.jobs)
+            self.jobs[job_id] = time.time()
+        return job_id
+
+    def job_status(self, job_id):
+        with self.lock:
+            created_at = self.jobs[job_id]
+        return "SUCCEEDED" if time.time() - created_at >= self.job_seconds else "RUNNING"
+
+    def handler_class(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Buffer responses so headers and body go out together, like a real server, instead of tripping
+            # Nagle/delayed-ACK stalls on keep-alive connections.
+            wbufsize = -1
+
+            def reply(self, status, body, content_type="application/json", headers=None):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                time.sleep(services.latency)
+                if self.path.endswith("/vendor_data2.json"):
+                    self.reply(200, {"platform_services": {"token": "fake-token"}})
+                elif self.path.startswith("/jobs/"):
+                    job_id = self.path.split("/")[-1]
+                    message = {"activation_code": "code", "activation_id": "id", "region": "us-east-1", "system_account": "account"}
+                    self.reply(200, {"data": {"items": [{"status": services.job_status(job_id), "message": message}]}})
+                elif self.path.endswith((".deb", ".rpm")):
+                    self.send_installer()
+                else:
+                    self.reply(404, {"error": "not found"})
+
+            def do_HEAD(self):
+                time.sleep(services.latency)
+                self.send_response(200 if self.path.endswith((".deb", ".rpm")) else 404)
+                self.send_header("Content-Length", str(len(services.installer)))
+                self.send_header("ETag", '"fake-installer"')
+                self.end_headers()
+
+            def do_POST(self):
+                time.sleep(services.latency)
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                job_id = services.create_job()
+                self.reply(202, {}, headers={"Location": "%s/jobs/%s" % (services.base_url, job_id)})
+
+            def send_installer(self):
+                if self.headers.get("If-None-Match") == '"fake-installer"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    self.wfile.flush()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(services.installer)))
+                self.send_header("ETag", '"fake-installer"')
+                self.end_headers()
+                chunk_size = 64 * 1024
+                for offset in range(0, len(services.installer), chunk_size):
+                    self.wfile.write(services.installer[offset : offset + chunk_size])
+                    if services.bandwidth:
+                        time.sleep(float(chunk_size) / services.bandwidth)
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def patch_endpoints(bootstrap, services_url):
+    """
+    Point a loaded bootstrap module's metadata and installer urls at the stand-in services.
+    """
+    bootstrap.Platform.OpenStack.vendordata_api_url = "%s/openstack/latest/vendor_data2.json" % services_url
+    for config in (bootstrap.Distro.UbuntuConfig, bootstrap.Distro.DebianConfig, bootstrap.Distro.RhelConfig, bootstrap.Distro.SuseConfig):
+        file_name = config.default_package_installer_url.split("/")[-1]
+        config.default_package_installer_url = "%s/latest/%s" % (services_url, file_name)
+        config.regional_package_installer_url = "%s/{region}/latest/%s" % (services_url, file_name)
+
+
+def load_bootstrap():
+    sys.path.insert(0, SCRIPTS_DIR)
+    import bootstrap
+
+    return bootstrap
+
+
+def run_stand_in_host(guest_root, services_url, args):
+    """
+    Run bootstrap.main(args) as a stand-in host: against `guest_root` with its stub binaries and the stand-in services.
+    """
+    os.environ["PATH"] = os.pathsep.join([create_guest_root(guest_root), os.environ.get("PATH", "")])
+    os.chdir(guest_root)
+    bootstrap = load_bootstrap()
+    patch_endpoints(bootstrap, services_url)
+    if "--platform-services-base-url" not in args:
+        args = list(args) + ["--platform-services-base-url", services_url]
+    bootstrap.main(["--guest-root", guest_root] + list(args))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Local stand-ins for bootstrap.py services and guests.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    serve_cmd = subparsers.add_parser("serve", help="Serve the stand-in services until interrupted")
+    serve_cmd.add_argument("--port", type=int, default=0, help="Port to listen on (default: any free port)")
+    serve_cmd.add_argument("--job-seconds", type=float, default=1.0, help="Seconds an activation job stays RUNNING (default: 1)")
+    serve_cmd.add_argument("--bandwidth", type=int, default=0, help="Installer download bandwidth in bytes per second, 0 for unthrottled")
+    serve_cmd.add_argument("--installer-size", type=int, default=20 * 1024 * 1024, help="Installer size in bytes (default: 20 MiB)")
+
+    run_cmd = subparsers.add_parser("run", help="Run bootstrap.py as a stand-in host")
+    run_cmd.add_argument("--guest-root", required=True, help="Fake guest root directory, created if missing")
+    run_cmd.add_argument("--services-url", required=True, help="Base url of the stand-in services")
+    run_cmd.add_argument("bootstrap_args", nargs=argparse.REMAINDER, help="Arguments for bootstrap.py, after --")
+
+    options = parser.parse_args(args)
+    if options.command == "serve":
+        services = FakeServices(options.job_seconds, options.bandwidth, options.installer_size, port=options.port).start()
+        print(services.base_url)
+        sys.stdout.flush()
+        try:
+            services.thread.join()
+        except KeyboardInterrupt:
+            services.stop()
+    else:
+        bootstrap_args = options.bootstrap_args
+        if bootstrap_args and bootstrap_args[0] == "--":
+            bootstrap_args = bootstrap_args[1:]
+        run_stand_in_host(os.path.abspath(options.guest_root), options.services_url, bootstrap_args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
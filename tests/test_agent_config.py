@@ -0,0 +1,97 @@
+import json
+import os
+
+import pytest
+
+import bootstrap
+
+TEMPLATE = {"Profile": {"ShareCreds": True, "ShareProfile": ""}, "Mds": {"CommandWorkersLimit": 5}}
+
+
+@pytest.fixture
+def guest_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(bootstrap, "GUEST_ROOT", str(tmp_path))
+    monkeypatch.setattr(bootstrap, "journal", bootstrap.Journal("/var/lib/rackspace/bootstrap-journal.json"))
+    return tmp_path
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    for name in ("stop_ssm_service", "start_ssm_service", "register_ssm"):
+        monkeypatch.setattr(bootstrap.GuestOs, name, (lambda name: lambda *args: calls.append(name))(name))
+    monkeypatch.setattr(bootstrap.GuestOs, "is_ssm_service_running", lambda: True)
+    monkeypatch.setattr(bootstrap.GuestOs.facts, "command_path", lambda prog: "/usr/bin/%s" % prog)
+    monkeypatch.setattr(bootstrap, "run_command", lambda cmd, timeout=bootstrap.COMMAND_TIMEOUT, stream=False: calls.append(" ".join(cmd)))
+    return calls
+
+
+def profile_dir(guest_root):
+    return guest_root / bootstrap.AgentConfig.profile_dir.lstrip("/")
+
+
+def write_template(guest_root):
+    path = profile_dir(guest_root) / "amazon-ssm-agent.json.template"
+    path.parent.mkdir(parents=True)
+    path.write_text(json.dumps(TEMPLATE))
+
+
+def test_the_profile_is_created_from_the_template(guest_root, calls):
+    write_template(guest_root)
+    config = bootstrap.AgentConfig()
+    config.set_profile()
+    assert config.commit() is True
+    with open(str(profile_dir(guest_root) / "amazon-ssm-agent.json")) as f:
+        assert json.load(f) == dict(TEMPLATE, Profile={"ShareCreds": True, "ShareProfile": "rackspace"})
+    assert calls == ["stop_ssm_service", "start_ssm_service"]
+    assert bootstrap.journal.get("agent_config")["restart_pending"] is False
+
+
+def test_a_missing_template_changes_nothing(guest_root, calls):
+    config = bootstrap.AgentConfig()
+    config.set_profile()
+    assert config.files == []
+    assert config.commit() is False
+    assert calls == []
+    assert not os.path.exists(str(profile_dir(guest_root)))
+
+
+def test_a_file_that_cannot_be_written_is_left_as_it_was(guest_root, calls, monkeypatch):
+    write_template(guest_root)
+    config_file = str(profile_dir(guest_root) / "amazon-ssm-agent.json")
+    with open(config_file, "w") as f:
+        f.write("{}")
+    rename = os.rename
+
+    def failing_rename(source, target):
+        if target == config_file:
+            raise OSError(30, "Read-only file system")
+        rename(source, target)
+
+    monkeypatch.setattr(bootstrap.os, "rename", failing_rename)
+    config = bootstrap.AgentConfig()
+    config.set_profile()
+    config.set_proxy("http://proxy.example.com:8080")
+    assert config.commit() is True
+
+    with open(config_file) as f:
+        assert f.read() == "{}"
+    assert sorted(os.listdir(str(profile_dir(guest_root)))) == ["amazon-ssm-agent.json", "amazon-ssm-agent.json.template"]
+    drop_in = guest_root / bootstrap.AgentConfig.drop_in_dir.lstrip("/") / "override.conf"
+    assert "http_proxy=http://proxy.example.com:8080" in drop_in.read_text()
+    assert calls == ["systemctl daemon-reload", "stop_ssm_service", "start_ssm_service"]
+
+
+def test_nothing_is_restarted_when_every_write_fails(guest_root, calls, monkeypatch):
+    write_template(guest_root)
+
+    def failing_fsync(fd):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(bootstrap.os, "fsync", failing_fsync)
+    config = bootstrap.AgentConfig()
+    config.set_profile()
+    assert config.commit() is False
+    assert os.listdir(str(profile_dir(guest_root))) == ["amazon-ssm-agent.json.template"]
+    assert calls == []
+    assert bootstrap.journal.get("agent_config") is None
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+import allocate_static_ips
+
+
+@pytest.fixture
+def run(tmp_path):
+    def run(variables, *args):
+        var_file = str(tmp_path / "fleet.tfvars.json")
+        output = str(tmp_path / "static-ips.tfvars.json")
+        with open(var_file, "w") as f:
+            json.dump(variables, f)
+        assert allocate_static_ips.main(["--var-file", var_file, "--output", output] + list(args)) == 0
+        with open(output) as f:
+            return json.load(f)
+
+    return run
+
+
+def deployment(vm_count, static_ips=(), add_nics_static_ips=(), nics=2):
+    return {
+        "vm_count": vm_count,
+        "instance_base_name": "app",
+        "static_ips": list(static_ips),
+        "additional_nics": [{"network_name": "nic-%d" % i} for i in range(nics)],
+        "add_nics_static_ips": list(add_nics_static_ips),
+    }
+
+
+def assert_unique(tfvars):
+    addresses = [address for address in tfvars["static_ips"] + tfvars["add_nics_static_ips"] if address]
+    assert len(addresses) == len(set(addresses))
+
+
+def test_nics_on_one_subnet_share_its_addresses(run):
+    variables = deployment(3, ["10.0.0.10", "10.0.0.11", "10.0.0.12"], ["", "10.1.0.5", "", "10.1.0.6"])
+    tfvars = run(variables, "--subnet", "10.0.0.0/24", "--nic-subnet", "10.1.0.0/28", "--nic-subnet", "10.1.0.0/28")
+    assert_unique(tfvars)
+    assert tfvars["add_nics_static_ips"][1] == "10.1.0.5"
+    assert tfvars["add_nics_static_ips"][3] == "10.1.0.6"
+    assert len(tfvars["add_nics_static_ips"]) == 6
+
+
+def test_primary_and_nic_on_one_subnet_share_its_addresses(run):
+    variables = deployment(3, ["10.1.0.2"], ["10.1.0.3"], nics=1)
+    tfvars = run(variables, "--subnet", "10.1.0.0/28", "--nic-subnet", "10.1.0.0/28")
+    assert_unique(tfvars)
+    assert tfvars["static_ips"][0] == "10.1.0.2"
+    assert tfvars["add_nics_static_ips"][0] == "10.1.0.3"
+
+
+def test_an_address_assigned_in_two_lists_of_one_subnet_is_rejected(tmp_path, capsys):
+    var_file = str(tmp_path / "fleet.tfvars.json")
+    with open(var_file, "w") as f:
+        json.dump(deployment(2, ["10.1.0.2", "10.1.0.3"], ["", "10.1.0.2"], nics=1), f)
+    assert allocate_static_ips.main(["--var-file", var_file, "--subnet", "10.1.0.0/28", "--nic-subnet", "10.1.0.0/28"]) == 1
+    assert "10.1.0.2 is assigned to both static_ips of app-01 and NIC 0 of app-02" in capsys.readouterr().err
+
+
+def test_growing_the_fleet_keeps_every_address(run):
+    variables = deployment(2, ["10.0.0.10", "10.0.0.11"], ["10.1.0.10", "10.1.0.11", "10.1.0.20", "10.1.0.21"])
+    tfvars = run(variables, "--subnet", "10.0.0.0/24", "--nic-subnet", "10.1.0.0/24", "--nic-subnet", "10.1.0.0/24", "--vm-count", "4")
+    assert tfvars["vm_count"] == 4
+    assert_unique(tfvars)
+    assert tfvars["static_ips"][:2] == ["10.0.0.10", "10.0.0.11"]
+    nic_0, nic_1 = tfvars["add_nics_static_ips"][:4], tfvars["add_nics_static_ips"][4:]
+    assert nic_0[:2] == ["10.1.0.10", "10.1.0.11"]
+    assert nic_1[:2] == ["10.1.0.20", "10.1.0.21"]
+    assert all(nic_0[2:] + nic_1[2:])
+
+
+def test_only_new_leaves_existing_vms_without_an_address(run):
+    variables = deployment(2, ["10.0.0.10"], nics=0)
+    tfvars = run(variables, "--subnet", "10.0.0.0/24", "--vm-count", "3", "--only-new")
+    assert tfvars["static_ips"] == ["10.0.0.10", "", "10.0.0.2"]
+
+
+def test_vms_without_a_trailing_number_are_reported():
+    variables = {"use_name_formatting": False, "instance_names": ["db", "app-01"]}
+    allocator = allocate_static_ips.Allocator(variables, ["db", "app-01"])
+    assert allocator.indexes == {"app-01": 0}
+    assert allocator.warnings == ["VM 'db' has no trailing number and gets no static IP"]
+
+
+def test_pool_skips_blocked_ranges():
+    pool = allocate_static_ips.AddressPool("10.0.0.0/29", [allocate_static_ips.parse_range("10.0.0.3-10.0.0.4")])
+    assert [str(pool.allocate()) for _ in range(3)] == ["10.0.0.2", "10.0.0.5", "10.0.0.6"]
+    with pytest.raises(ValueError):
+        pool.allocate()
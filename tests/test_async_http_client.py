@@ -0,0 +1,131 @@
+import gzip
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bootstrap
+
+DELAY = 0.5
+
+pytestmark = pytest.mark.skipif(not bootstrap.AsyncHttpClient.available(), reason="asyncio requests are not available")
+
+
+class Server(object):
+    """
+    HTTP server that answers /slow after `DELAY` seconds, /chunked with a gzip body in chunked transfer-encoding and any
+    other path with a small JSON document, and records the Connection header of every request.
+    """
+
+    def __init__(self):
+        self.connection_headers = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d" % self.server.server_port
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with server.lock:
+                    server.connection_headers.append(self.headers.get("Connection"))
+                if self.path == "/slow":
+                    time.sleep(DELAY)
+                if self.path == "/chunked":
+                    body = gzip.compress(b'{"chunked": true}')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Encoding", "gzip")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for start in range(0, len(body), 7):
+                        chunk = body[start:start + 7]
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    self.wfile.write(b"0\r\n\r\n")
+                    return
+                body = ('{"path": "%s"}' % self.path).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def server():
+    bootstrap.HttpClient.pool = bootstrap.HttpClient.ConnectionPool()
+    server = Server()
+    server.thread.start()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+    bootstrap.HttpClient.pool.close_all()
+
+
+def refused_url():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "http://127.0.0.1:%d/refused" % port
+
+
+def test_requests_run_concurrently_and_return_in_order(server):
+    paths = ["/slow", "/a", "/slow", "/b", "/slow"]
+    started_at = time.time()
+    responses = bootstrap.AsyncHttpClient.gather([("GET", server.base_url + path, None) for path in paths], timeout=5)
+    assert time.time() - started_at < 2 * DELAY
+    assert [response.json()["path"] for response in responses] == paths
+    assert server.connection_headers == ["close"] * len(paths)
+
+
+def test_a_request_past_its_timeout_is_cancelled(server):
+    started_at = time.time()
+    slow, fast = bootstrap.AsyncHttpClient.gather([("GET", server.base_url + "/slow", None), ("GET", server.base_url + "/fast", None)], timeout=DELAY / 5)
+    assert time.time() - started_at < DELAY
+    assert isinstance(slow, bootstrap.HttpClient.RequestException)
+    assert "timed out after" in str(slow)
+    assert fast.json() == {"path": "/fast"}
+
+
+def test_a_chunked_gzip_body_is_decoded(server):
+    chunked, plain = bootstrap.AsyncHttpClient.gather([("GET", server.base_url + "/chunked", None), ("GET", server.base_url + "/plain", None)])
+    assert chunked.status == 200
+    assert chunked.json() == {"chunked": True}
+    assert plain.json() == {"path": "/plain"}
+
+
+def test_a_refused_connection_is_returned_in_place(server):
+    refused, ok = bootstrap.AsyncHttpClient.gather([("GET", refused_url(), None), ("GET", server.base_url + "/ok", None)])
+    assert isinstance(refused, bootstrap.HttpClient.RequestException)
+    assert "/refused failed" in str(refused)
+    assert ok.json() == {"path": "/ok"}
+
+
+def test_an_invalid_scheme_is_returned_in_place(server):
+    invalid, ok = bootstrap.AsyncHttpClient.gather([("GET", "ftp://127.0.0.1/file", None), ("GET", server.base_url + "/ok", None)])
+    assert isinstance(invalid, bootstrap.HttpClient.RequestException)
+    assert ok.json() == {"path": "/ok"}
+
+
+def test_a_single_request_reuses_a_pooled_connection(server):
+    for _ in range(2):
+        (response,) = bootstrap.AsyncHttpClient.gather([("GET", server.base_url + "/single", None)])
+        assert response.json() == {"path": "/single"}
+    assert "close" not in server.connection_headers
@@ -0,0 +1,71 @@
+import itertools
+import random
+
+import pytest
+
+import bootstrap
+
+
+class Clock(object):
+    """
+    Stands in for the time module, sleeping only advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bootstrap, "time", clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def seeded(monkeypatch):
+    monkeypatch.setattr(bootstrap, "random", random.Random(20261018))
+
+
+def test_delays_grow_within_the_jitter_up_to_the_cap():
+    backoff = bootstrap.Backoff("test", initial_delay=0.5, max_delay=10, multiplier=2, jitter=0.5)
+    delays = list(itertools.islice(backoff.delays(), 200))
+    ceilings = [min(0.5 * 2 ** n, 10) for n in range(200)]
+    for delay, ceiling in zip(delays, ceilings):
+        assert ceiling * 0.5 <= delay <= ceiling
+    assert max(delays) <= 10
+    # Capped delays are still jittered instead of all being the cap.
+    assert len(set(delays[10:])) == len(delays[10:])
+
+
+def test_the_jitter_is_reproducible_with_a_seed(monkeypatch):
+    first = list(itertools.islice(bootstrap.Backoff("test").delays(), 20))
+    monkeypatch.setattr(bootstrap, "random", random.Random(20261018))
+    assert list(itertools.islice(bootstrap.Backoff("test").delays(), 20)) == first
+
+
+def test_without_jitter_the_delays_are_exact():
+    backoff = bootstrap.Backoff("test", initial_delay=1, max_delay=5, jitter=0)
+    assert list(itertools.islice(backoff.delays(), 5)) == [1, 2, 4, 5, 5]
+
+
+def test_attempts_stop_at_max_attempts(clock):
+    backoff = bootstrap.Backoff("test", initial_delay=1, max_delay=4, max_attempts=4)
+    assert list(backoff.attempts()) == [1, 2, 3, 4]
+    assert len(clock.sleeps) == 3
+    assert all(0.5 * ceiling <= delay <= ceiling for delay, ceiling in zip(clock.sleeps, [1, 2, 4]))
+
+
+def test_attempts_stop_at_the_deadline_without_sleeping_past_it(clock):
+    backoff = bootstrap.Backoff("test", initial_delay=1, max_delay=60, deadline=10)
+    attempts = list(backoff.attempts())
+    assert clock.now == 1010.0
+    assert len(attempts) == len(clock.sleeps) + 1
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+
+# Runs the benchmark with the file system calls that remove or move files recorded, and only carried out below the
+# benchmark's work dir, so a regression cannot remove anything on the host running the tests.
+SPY = """
+import json, os, shutil, sys, tempfile
+sys.path.insert(0, %(scripts)r)
+prefix = os.path.join(tempfile.gettempdir(), "bootstrap-benchmark-")
+touched = []
+
+def spy(function):
+    def call(path, *args, **kwargs):
+        if kwargs.get("dir_fd") is not None:
+            # Relative to a directory rmtree() already opened, the path of that directory was recorded.
+            return function(path, *args, **kwargs)
+        path = os.path.abspath(path)
+        touched.append(path)
+        if path.startswith(prefix):
+            return function(path, *args, **kwargs)
+    return call
+
+shutil.rmtree, os.remove, os.unlink = spy(shutil.rmtree), spy(os.remove), spy(os.unlink)
+rename = os.rename
+os.rename = lambda source, target: spy(lambda path: rename(source, path))(target)
+
+import benchmark_bootstrap
+exitcode = benchmark_bootstrap.main(%(args)r)
+print(json.dumps({"exitcode": exitcode, "prefix": prefix, "touched": touched}))
+"""
+
+
+def test_cold_cache_benchmark_stays_in_its_work_dir(tmp_path):
+    args = ["--iterations", "2", "--commands", "install,uninstall", "--cold-cache", "--job-seconds", "0.1"]
+    args += ["--installer-size", "100000", "--install-seconds", "0", "--register-seconds", "0"]
+    cwd = tmp_path / "cwd"
+    cwd.mkdir()
+    env = dict(os.environ, TMPDIR=str(tmp_path))
+    output = subprocess.check_output([sys.executable, "-c", SPY % {"scripts": SCRIPTS_DIR, "args": args}], cwd=str(cwd), env=env)
+    result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    assert result["exitcode"] == 0
+    assert result["touched"]
+    assert [path for path in result["touched"] if not path.startswith(result["prefix"])] == []
@@ -0,0 +1,65 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+import bootstrap
+
+
+@pytest.fixture(autouse=True)
+def history(monkeypatch):
+    history = []
+    monkeypatch.setattr(bootstrap.CommandRunner, "history", history)
+    return history
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_output_is_returned_as_text():
+    output = bootstrap.CommandRunner.run(python("import sys; sys.stdout.write('one\\r\\ntwo\\n'); sys.stderr.write('three\\n')"))
+    assert isinstance(output, str)
+    assert output.splitlines() == ["one", "two", "three"]
+
+
+def test_the_exit_code_and_output_of_a_failure_are_captured(history):
+    with pytest.raises(subprocess.CalledProcessError) as raised:
+        bootstrap.CommandRunner.run(python("import sys; print('failing'); sys.exit(3)"))
+    assert not isinstance(raised.value, bootstrap.CommandRunner.Timeout)
+    assert raised.value.returncode == 3
+    assert raised.value.output == "failing\n"
+    assert [(entry["returncode"], entry["timed_out"]) for entry in history] == [(3, False)]
+
+
+def test_a_command_past_its_timeout_is_killed(history):
+    started_at = time.time()
+    with pytest.raises(bootstrap.CommandRunner.Timeout) as raised:
+        bootstrap.CommandRunner.run(python("import sys, time; print('started'); sys.stdout.flush(); time.sleep(30)"), timeout=0.5)
+    assert time.time() - started_at < 5
+    assert raised.value.output == "started\n\n[command timed out after 0.5 seconds]"
+    assert raised.value.returncode != 0
+    assert history[0]["timed_out"] is True
+
+
+def test_a_missing_command_exits_with_127(history, tmp_path):
+    missing = str(tmp_path / "missing")
+    with pytest.raises(subprocess.CalledProcessError) as raised:
+        bootstrap.CommandRunner.run([missing, "--version"])
+    assert raised.value.returncode == 127
+    assert raised.value.output.startswith(missing + ": ")
+    assert history == []
+
+
+def test_output_past_the_limit_is_truncated():
+    output = bootstrap.CommandRunner.run(python("for i in range(100): print('x' * 9)"), output_limit=50)
+    assert output == ("x" * 9 + "\n") * 5 + "\n[output truncated after 50 bytes]"
+
+
+def test_every_command_is_recorded(history):
+    bootstrap.CommandRunner.run(python("pass"))
+    bootstrap.CommandRunner.run(python("print('done')"))
+    assert [entry["returncode"] for entry in history] == [0, 0]
+    assert history[0]["argv"] == python("pass")
+    assert all(entry["duration"] >= 0 for entry in history)
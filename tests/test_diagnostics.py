@@ -0,0 +1,70 @@
+import json
+import subprocess
+
+import pytest
+
+import bootstrap
+
+CHECKS = [
+    {"Check": "EC2 IMDS", "Status": "Skipped", "Note": "Not an EC2 instance"},
+    {"Check": "Hybrid instance registration", "Status": "Success", "Note": "Instance is registered"},
+    {"Check": "Connectivity to ssm endpoint", "Status": "Failed", "Note": "Unreachable"},
+]
+INSTANCE_INFORMATION = {"instance-id": "mi-0123456789abcdef0", "region": "us-east-1"}
+
+
+@pytest.fixture
+def outputs(monkeypatch):
+    outputs = {}
+
+    def run_command(cmd, timeout=bootstrap.COMMAND_TIMEOUT, stream=False):
+        output = outputs[cmd[1]]
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+    monkeypatch.setattr(bootstrap, "run_command", run_command)
+    monkeypatch.setattr(bootstrap.GuestOs.facts, "command_path", lambda prog: "/usr/bin/%s" % prog)
+    return outputs
+
+
+def test_a_failed_diagnostics_command_keeps_the_instance_information(outputs):
+    outputs["get-diagnostics"] = subprocess.CalledProcessError(1, "ssm-cli get-diagnostics", output="agent is not running")
+    outputs["get-instance-information"] = json.dumps(INSTANCE_INFORMATION)
+    diagnostics, agent_info, report = bootstrap.GuestOs.collect_diagnostics()
+    assert diagnostics is None
+    assert agent_info == INSTANCE_INFORMATION
+    assert report["instance_information"] == INSTANCE_INFORMATION
+    assert "checks" not in report
+    assert report["collectors"]["diagnostics"]["ok"] is False
+    assert "Failed command: ssm-cli get-diagnostics" in report["collectors"]["diagnostics"]["error"]
+    assert "ExitCode: 1" in report["collectors"]["diagnostics"]["error"]
+    assert report["collectors"]["instance_information"]["ok"] is True
+    assert all(collector["seconds"] >= 0 for collector in report["collectors"].values())
+
+
+def test_a_timed_out_instance_information_command_keeps_the_diagnostics(outputs):
+    outputs["get-diagnostics"] = json.dumps({"DiagnosticsOutput": CHECKS})
+    outputs["get-instance-information"] = bootstrap.CommandRunner.Timeout(-9, "ssm-cli get-instance-information", output="\n[command timed out after 30 seconds]")
+    diagnostics, agent_info, report = bootstrap.GuestOs.collect_diagnostics()
+    assert agent_info is None
+    assert [check["Check"] for check in diagnostics.failed_checks()] == ["Connectivity to ssm endpoint"]
+    assert report["checks"]["total"] == 3
+    assert report["instance_information"] is None
+    assert report["collectors"]["diagnostics"]["ok"] is True
+    assert "timed out after 30 seconds" in report["collectors"]["instance_information"]["error"]
+
+
+def test_unexpected_diagnostics_output_is_reported(outputs):
+    outputs["get-diagnostics"] = json.dumps({"Output": []})
+    diagnostics, agent_info, report = bootstrap.GuestOs.collect_diagnostics(agent_info=INSTANCE_INFORMATION)
+    assert diagnostics is None
+    assert agent_info == INSTANCE_INFORMATION
+    assert report["collectors"]["diagnostics"]["ok"] is False
+    assert report["collectors"]["diagnostics"]["error"] == "Unexpected output: 'DiagnosticsOutput'"
+    assert "instance_information" not in report["collectors"]
+
+
+def test_111_stays_reserved():
+    assert "111" in bootstrap.EXIT_CODES
+    assert "111: Reserved" in bootstrap.exit_codes_epilog()
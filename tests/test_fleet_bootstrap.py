@@ -0,0 +1,81 @@
+import json
+import time
+
+import pytest
+
+import fleet_bootstrap
+
+
+def write_inventory(tmp_path, *lines):
+    path = tmp_path / "hosts.jsonl"
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+def test_load_inventory_applies_the_default_command(tmp_path):
+    path = write_inventory(
+        tmp_path,
+        "# fleet",
+        '{"host": "app-01", "platform": "openstack", "region": "us-east-1"}',
+        "",
+        '{"host": "app-02", "command": "uninstall"}',
+    )
+    hosts = fleet_bootstrap.load_inventory(path, "install")
+    assert [(host["host"], host["command"]) for host in hosts] == [("app-01", "install"), ("app-02", "uninstall")]
+
+
+@pytest.mark.parametrize(
+    "line, error",
+    [
+        ("{not json", "invalid JSON"),
+        ('{"platform": "openstack"}', "missing 'host'"),
+        ('{"host": "app-01", "platform": "openstack", "command": "upgrade"}', "unknown command 'upgrade'"),
+        ('{"host": "app-01"}', "missing 'platform'"),
+    ],
+)
+def test_load_inventory_reports_the_bad_line(tmp_path, line, error):
+    path = write_inventory(tmp_path, '{"host": "app-00", "platform": "openstack"}', line)
+    with pytest.raises(ValueError, match="hosts.jsonl:2: %s" % error):
+        fleet_bootstrap.load_inventory(path, "install")
+
+
+def test_parse_result_takes_the_last_result_line():
+    result = {"timestamp": "2026-10-18T07:00:00Z", "level": "DEBUG", "message": "registered", "phases": {"install": 1.5}}
+    output = "\n".join(["[2026-10-18T07:00:00.000] DEBUG - {'starting': True}", str(dict(result, message="first")), "-" * 10, str(result), ""])
+    assert fleet_bootstrap.parse_result(output) == result
+
+
+@pytest.mark.parametrize("output", ["", "no result here\n", "{'timestamp': broken\n"])
+def test_parse_result_without_a_result(output):
+    assert fleet_bootstrap.parse_result(output) is None
+
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    bucket = fleet_bootstrap.TokenBucket(rate=20, burst=3)
+    started_at = time.time()
+    for _ in range(3):
+        bucket.acquire()
+    assert time.time() - started_at < 0.05
+    for _ in range(4):
+        bucket.acquire()
+    assert time.time() - started_at >= 4 / 20.0 - 0.01
+
+
+def test_token_bucket_without_a_rate_never_blocks():
+    bucket = fleet_bootstrap.TokenBucket(rate=0)
+    started_at = time.time()
+    for _ in range(100):
+        bucket.acquire()
+    assert time.time() - started_at < 0.05
+
+
+def test_local_fleet_run_reports_json_on_stdout(tmp_path, capsys):
+    path = write_inventory(tmp_path, '{"host": "app-01", "platform": "openstack"}', '{"host": "app-02", "platform": "openstack"}')
+    args = ["--inventory", path, "--transport", "local", "--work-dir", str(tmp_path / "hosts"), "--job-seconds", "0.1", "--rate", "0"]
+    assert fleet_bootstrap.main(args) == 0
+    captured = capsys.readouterr()
+    report = json.loads(captured.out)
+    assert report["summary"]["succeeded"] == 2
+    assert report["summary"]["by_exit_code"]["0"]["hosts"] == ["app-01", "app-02"]
+    assert "install" in report["phases"]
+    assert "app-01" in captured.err and "app-02" in captured.err
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+import bootstrap
+
+ATTRIBUTES_URL = bootstrap.Platform.Gcp.attributes_url()
+
+
+def response(body):
+    return bootstrap.HttpCache.response(
+        {"status": 200, "reason": "OK", "headers": {"content-type": "application/json", "etag": '"v1"'}, "body": body}
+    )
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return bootstrap.HttpCache(str(tmp_path / "metadata"))
+
+
+def test_documents_without_credentials_are_stored(cache):
+    cache.save(ATTRIBUTES_URL, response('{"rax_skip_ssm_bootstrap": "false"}'))
+    entry = cache.load(ATTRIBUTES_URL)
+    assert entry["body"] == '{"rax_skip_ssm_bootstrap": "false"}'
+    assert cache.validators(entry) == {"If-None-Match": '"v1"'}
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        bootstrap.Platform.Gcp.instance_identity_url(),
+        bootstrap.Platform.Azure.attest_url,
+        bootstrap.Platform.OpenStack.vendordata_api_url,
+    ],
+)
+def test_credentials_are_never_stored(cache, url):
+    cache.save(url, response('{"token": "secret"}'))
+    assert cache.load(url) is None
+    assert not os.path.exists(cache.file_path(url))
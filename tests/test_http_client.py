@@ -0,0 +1,106 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bootstrap
+
+
+class Server(object):
+    """
+    Keep-alive HTTP server that counts requests per path and closes every connection after its response without a
+    `Connection: close` header, like a server dropping idle keep-alive connections.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d" % self.server.server_port
+
+    def count(self, path):
+        with self.lock:
+            return self.requests.get(path, 0)
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with server.lock:
+                    server.connections += 1
+
+            def handle_request(self):
+                with server.lock:
+                    server.requests[self.path] = server.requests.get(self.path, 0) + 1
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path == "/slow":
+                    time.sleep(1)
+                body = b"not gzip" if self.path == "/corrupt" else b"{}"
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if self.path == "/corrupt":
+                    self.send_header("Content-Encoding", "gzip")
+                self.end_headers()
+                self.wfile.write(body)
+                self.close_connection = self.path != "/keep-alive"
+
+            do_GET = do_POST = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def server():
+    bootstrap.HttpClient.pool = bootstrap.HttpClient.ConnectionPool()
+    server = Server()
+    server.thread.start()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+    bootstrap.HttpClient.pool.close_all()
+
+
+def test_get_is_retried_when_the_pooled_connection_was_closed(server):
+    assert bootstrap.HttpClient.request("GET", server.base_url + "/closed").ok
+    response = bootstrap.HttpClient.request("GET", server.base_url + "/closed")
+    assert response.ok
+    assert server.count("/closed") == 2
+    assert server.connections == 2
+
+
+def test_post_is_sent_on_a_new_connection(server):
+    bootstrap.HttpClient.request("GET", server.base_url + "/keep-alive")
+    assert bootstrap.HttpClient.request("POST", server.base_url + "/closed", body="{}").ok
+    assert server.count("/closed") == 1
+    assert server.connections == 2
+
+
+def test_post_that_times_out_is_not_sent_again(server):
+    bootstrap.HttpClient.request("GET", server.base_url + "/keep-alive")
+    with pytest.raises(bootstrap.HttpClient.request_exceptions):
+        bootstrap.HttpClient.request("POST", server.base_url + "/slow", body="{}", timeout=0.2)
+    time.sleep(0.1)
+    assert server.count("/slow") == 1
+
+
+def test_corrupt_body_on_a_pooled_connection_is_not_requested_again(server):
+    bootstrap.HttpClient.request("GET", server.base_url + "/keep-alive")
+    with pytest.raises(bootstrap.HttpClient.RequestException):
+        bootstrap.HttpClient.request("GET", server.base_url + "/corrupt")
+    assert server.count("/corrupt") == 1
@@ -0,0 +1,47 @@
+import argparse
+import time
+
+import pytest
+
+import bootstrap
+
+
+@pytest.fixture
+def options():
+    return argparse.Namespace(
+        platform="openstack",
+        installer_source=None,
+        installer_download_region=None,
+        installer_sha256=None,
+        installer_cache_dir=bootstrap.INSTALLER_CACHE_DIR,
+        installer_mirror=None,
+        http_proxy=None,
+    )
+
+
+@pytest.fixture
+def new_guest(monkeypatch):
+    monkeypatch.setattr(bootstrap.Platform, "metadata", bootstrap.MetadataCache())
+    monkeypatch.setattr(bootstrap.Platform.metadata, "prefetch", lambda documents, timeout=None: None)
+    monkeypatch.setattr(bootstrap.GuestOs, "is_agent_disabled", staticmethod(lambda platform: False))
+    monkeypatch.setattr(bootstrap.GuestOs, "is_ssm_package_installed", staticmethod(lambda: False))
+    monkeypatch.setattr(bootstrap.GuestOs, "has_registration_state", staticmethod(lambda: False))
+
+
+def test_failed_download_waits_for_the_activation_in_flight(monkeypatch, options, new_guest):
+    activations = []
+
+    def get_activation(platform):
+        time.sleep(0.3)
+        activations.append(platform.name)
+        return {"code": "code", "id": "id", "region": "us-east-1", "system_account": "account"}
+
+    def download_installer(**kwargs):
+        raise bootstrap.HttpClient.RequestException("Download request to https://example.com failed: reset")
+
+    monkeypatch.setattr(bootstrap.PlatformServices, "get_activation", staticmethod(get_activation))
+    monkeypatch.setattr(bootstrap.Package, "download_installer", staticmethod(download_installer))
+    with pytest.raises(SystemExit) as exit_info:
+        bootstrap.install(options)
+    assert exit_info.value.code == 115
+    assert activations == ["openstack"]
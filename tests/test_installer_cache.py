@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bootstrap
+
+URL = "https://example.com/latest/amazon-ssm-agent.deb"
+INSTALLER = b"installer" * 1000
+SHA256 = hashlib.sha256(INSTALLER).hexdigest()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = bootstrap.InstallerCache(str(tmp_path / "installers"))
+    cache.store(URL, "amazon-ssm-agent.deb", [INSTALLER])
+    return cache
+
+
+def test_digest_hit_serves_the_cached_installer_without_a_request(cache):
+    response, path = cache.fetch(URL, expected_sha256=SHA256.upper())
+    assert response is None
+    with open(path, "rb") as f:
+        assert f.read() == INSTALLER
+
+
+def test_digest_hit_rehashes_the_cached_installer(cache):
+    entry_dir = cache.entry_dir(URL)
+    with open(os.path.join(entry_dir, "amazon-ssm-agent.deb"), "r+b") as f:
+        f.write(b"tampered!")
+    assert cache.find_by_digest(SHA256) == (None, None)
+    assert not os.path.exists(entry_dir)
+
+
+@pytest.mark.parametrize("key", ["file", "size", "sha256"])
+def test_entry_without_a_required_key_is_corrupt(cache, key):
+    entry_dir = cache.entry_dir(URL)
+    entry_path = os.path.join(entry_dir, cache.entry_file_name)
+    with open(entry_path) as f:
+        entry = json.load(f)
+    del entry[key]
+    with open(entry_path, "w") as f:
+        json.dump(entry, f)
+    assert cache.load_entry(entry_dir) is None
+    assert cache.find_by_digest(SHA256) == (None, None)
+
+
+class InstallerServer(object):
+    """
+    Serves INSTALLER with an ETag and honours Range requests guarded by If-Range, answering 416 to a range that starts
+    at or past the end of the file.  Records the Range header of every request.
+    """
+
+    etag = '"installer-v1"'
+
+    def __init__(self):
+        self.ranges = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/latest/amazon-ssm-agent.deb" % self.server.server_port
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.ranges.append(self.headers.get("Range"))
+                match = re.match(r"bytes=([0-9]+)-$", self.headers.get("Range") or "")
+                start = int(match.group(1)) if match and self.headers.get("If-Range") == server.etag else 0
+                if start >= len(INSTALLER):
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % len(INSTALLER))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = INSTALLER[start:]
+                self.send_response(206 if start else 200)
+                if start:
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(INSTALLER) - 1, len(INSTALLER)))
+                self.send_header("ETag", server.etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def installer_server():
+    bootstrap.HttpClient.pool = bootstrap.HttpClient.ConnectionPool()
+    server = InstallerServer()
+    server.thread.start()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+    bootstrap.HttpClient.pool.close_all()
+
+
+def test_a_complete_partial_download_is_downloaded_again(tmp_path, installer_server):
+    cache = bootstrap.InstallerCache(str(tmp_path / "installers"))
+    response, path = cache.fetch(installer_server.url, expected_sha256=SHA256)
+    # A run that stopped between writing the last byte and renaming the file leaves a complete ".part" file.
+    os.rename(path, "%s.part" % path)
+    os.remove(os.path.join(cache.entry_dir(installer_server.url), cache.entry_file_name))
+
+    response, path = cache.fetch(installer_server.url, expected_sha256=SHA256)
+    assert response.status == 200
+    with open(path, "rb") as f:
+        assert f.read() == INSTALLER
+    assert not os.path.exists("%s.part" % path)
+    assert installer_server.ranges == [None, "bytes=%d-" % len(INSTALLER), None]
+    # The next run is served from the cache.
+    assert cache.fetch(installer_server.url, expected_sha256=SHA256) == (None, path)
@@ -0,0 +1,73 @@
+import pytest
+
+import bootstrap
+
+REGIONAL = "https://s3.us-east-1.amazonaws.com/amazon-ssm-us-east-1/latest/debian_amd64/amazon-ssm-agent.deb"
+DEFAULT = "https://s3.amazonaws.com/ec2-downloads-windows/SSMAgent/latest/debian_amd64/amazon-ssm-agent.deb"
+MIRROR = "https://mirror.example.com/latest/debian_amd64/amazon-ssm-agent.deb"
+BACKUP = "https://backup.example.com/latest/debian_amd64/amazon-ssm-agent.deb"
+
+
+class Probe(object):
+    def __init__(self, status, elapsed):
+        self.status = status
+        self.ok = 200 <= status < 300
+        self.full_status = "%d" % status
+        self.elapsed = elapsed
+
+
+class Metadata(object):
+    """
+    Answers the HEAD probes of the mirrors with the given responses or errors, like `MetadataCache.fetch_missing`.
+    """
+
+    def __init__(self, probes):
+        self.probes = probes
+        self.requests = []
+
+    def fetch_missing(self, requests, timeout=None):
+        self.requests.extend(requests)
+        return dict((request[:2], self.probes[request[1]]) for request in requests)
+
+    def cached(self, key):
+        return None
+
+
+def rank(monkeypatch, probes, expected_sha256=None):
+    metadata = Metadata(probes)
+    monkeypatch.setattr(bootstrap.Platform, "metadata", metadata)
+    ranked = bootstrap.Package.rank_mirrors(list(probes), expected_sha256)
+    assert metadata.requests == [("HEAD", url, {}) for url in probes]
+    return ranked
+
+
+def test_mirrors_are_ordered_by_their_probe_time(monkeypatch):
+    probes = {REGIONAL: Probe(200, 0.3), DEFAULT: Probe(200, 0.1), MIRROR: Probe(200, 0.2)}
+    assert rank(monkeypatch, probes) == [DEFAULT, MIRROR, REGIONAL]
+
+
+def test_mirrors_answering_equally_fast_keep_their_order(monkeypatch):
+    probes = {REGIONAL: Probe(200, 0.1), MIRROR: Probe(200, 0.1), DEFAULT: Probe(200, 0.1), BACKUP: Probe(200, 0.05)}
+    assert rank(monkeypatch, probes) == [BACKUP, REGIONAL, MIRROR, DEFAULT]
+
+
+def test_failed_mirrors_are_tried_last_in_their_order_and_missing_ones_dropped(monkeypatch):
+    probes = {
+        REGIONAL: bootstrap.HttpClient.RequestException("HEAD request to %s timed out after 2 seconds" % REGIONAL),
+        BACKUP: Probe(503, 0.01),
+        DEFAULT: Probe(404, 0.01),
+        MIRROR: Probe(200, 0.2),
+    }
+    assert rank(monkeypatch, probes) == [MIRROR, REGIONAL, BACKUP]
+
+
+def test_no_mirror_with_the_installer_fails_with_126(monkeypatch):
+    probes = {REGIONAL: Probe(403, 0.1), DEFAULT: Probe(404, 0.1)}
+    with pytest.raises(SystemExit) as raised:
+        rank(monkeypatch, probes)
+    assert raised.value.code == 126
+
+
+def test_no_mirror_with_the_installer_is_left_to_the_cache_of_a_pinned_digest(monkeypatch):
+    probes = {REGIONAL: Probe(403, 0.1), DEFAULT: Probe(404, 0.1)}
+    assert rank(monkeypatch, probes, expected_sha256="0" * 64) == [REGIONAL, DEFAULT]
@@ -0,0 +1,98 @@
+import argparse
+import hashlib
+import json
+
+import pytest
+
+import bootstrap
+
+INSTALLER = b"amazon-ssm-agent installer\n" * 100
+DEB = argparse.Namespace(package_db="dpkg")
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    source_dir = tmp_path / "source"
+    (source_dir / "debian").mkdir(parents=True)
+    (source_dir / "debian" / "amazon-ssm-agent.deb").write_bytes(INSTALLER)
+    return source_dir
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return bootstrap.InstallerCache(str(tmp_path / "cache"))
+
+
+def write_manifest(source_dir, packages):
+    (source_dir / "manifest.json").write_text(json.dumps({"packages": packages}))
+
+
+def package(sha256=hashlib.sha256(INSTALLER).hexdigest(), file_name="debian/amazon-ssm-agent.deb"):
+    return {"file": file_name, "sha256": sha256}
+
+
+def fetch(source, cache, distro="ubuntu", expected_sha256=None):
+    return bootstrap.InstallerSource(source, cache).fetch(distro, DEB, expected_sha256=expected_sha256)
+
+
+def test_the_installer_of_the_distro_is_copied_into_the_cache(source_dir, cache):
+    write_manifest(source_dir, {"deb/%s" % bootstrap.InstallerSource.arch(): package()})
+    location, path = fetch("file://%s" % source_dir, cache)
+    assert location == "%s/debian/amazon-ssm-agent.deb" % source_dir
+    with open(path, "rb") as f:
+        assert f.read() == INSTALLER
+    (source_dir / "debian" / "amazon-ssm-agent.deb").unlink()
+    assert fetch(str(source_dir), cache) == (location, path)
+
+
+def test_the_distro_entry_is_preferred_over_the_package_format(source_dir, cache):
+    arch = bootstrap.InstallerSource.arch()
+    write_manifest(source_dir, {"deb/%s" % arch: package(file_name="missing.deb"), "ubuntu/%s" % arch: package()})
+    assert fetch(str(source_dir / "manifest.json"), cache)[0].endswith("/debian/amazon-ssm-agent.deb")
+
+
+@pytest.mark.parametrize(
+    "manifest",
+    [
+        "{not json",
+        "[]",
+        '{"installers": {}}',
+        '{"packages": {"deb/amd64": {"file": "../amazon-ssm-agent.deb", "sha256": "%s"}}}' % ("0" * 64),
+        '{"packages": {"deb/amd64": {"file": "/srv/amazon-ssm-agent.deb", "sha256": "%s"}}}' % ("0" * 64),
+        '{"packages": {"deb/amd64": {"file": "debian/amazon-ssm-agent.deb", "sha256": "abc"}}}',
+        '{"packages": {"deb/amd64": {"file": "debian/amazon-ssm-agent.deb"}}}',
+    ],
+)
+def test_a_malformed_manifest_fails_with_140(source_dir, cache, manifest):
+    (source_dir / "manifest.json").write_text(manifest)
+    with pytest.raises(SystemExit) as raised:
+        fetch(str(source_dir), cache)
+    assert raised.value.code == 140
+
+
+def test_a_missing_manifest_fails_with_140(tmp_path, cache):
+    with pytest.raises(SystemExit) as raised:
+        fetch(str(tmp_path / "missing"), cache)
+    assert raised.value.code == 140
+
+
+def test_a_manifest_without_the_distro_fails_with_141(source_dir, cache):
+    write_manifest(source_dir, {"rpm/%s" % bootstrap.InstallerSource.arch(): package()})
+    with pytest.raises(SystemExit) as raised:
+        fetch(str(source_dir), cache)
+    assert raised.value.code == 141
+
+
+def test_an_installer_not_matching_its_manifest_digest_fails_with_139(source_dir, cache):
+    write_manifest(source_dir, {"deb/%s" % bootstrap.InstallerSource.arch(): package(sha256="0" * 64)})
+    with pytest.raises(SystemExit) as raised:
+        fetch(str(source_dir), cache)
+    assert raised.value.code == 139
+    assert cache.find_by_digest(hashlib.sha256(INSTALLER).hexdigest())[1] is None
+
+
+def test_a_manifest_digest_other_than_the_expected_one_fails_with_139(source_dir, cache):
+    write_manifest(source_dir, {"deb/%s" % bootstrap.InstallerSource.arch(): package()})
+    with pytest.raises(SystemExit) as raised:
+        fetch(str(source_dir), cache, expected_sha256="1" * 64)
+    assert raised.value.code == 139
@@ -0,0 +1,23 @@
+import os
+
+import bootstrap
+
+
+def test_recorded_phases_survive_a_reload(tmp_path):
+    path = str(tmp_path / "journal.json")
+    bootstrap.Journal(path).record("package_installed", installer="/tmp/amazon-ssm-agent.deb")
+    assert bootstrap.Journal(path).load().get("package_installed")["installer"] == "/tmp/amazon-ssm-agent.deb"
+
+
+def test_clear_removes_the_journal(tmp_path):
+    journal = bootstrap.Journal(str(tmp_path / "journal.json"))
+    journal.record("package_installed", installer="/tmp/amazon-ssm-agent.deb")
+    journal.clear()
+    assert journal.get("package_installed") is None
+    assert not os.path.exists(journal.file_path())
+
+
+def test_clear_without_a_journal_file(tmp_path):
+    journal = bootstrap.Journal(str(tmp_path / "missing" / "journal.json"))
+    journal.clear()
+    assert journal.phases == {}
@@ -0,0 +1,83 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bootstrap
+
+ETAG = '"vendordata-v1"'
+BODY = b'{"platform_services": {"token": "secret"}}'
+
+
+class VendordataServer(object):
+    """
+    Serves a vendordata document with an ETag, answering 304 to a matching If-None-Match, and records the
+    If-None-Match header of every request.
+    """
+
+    def __init__(self):
+        self.conditions = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/openstack/latest/vendor_data2.json" % self.server.server_port
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                condition = self.headers.get("If-None-Match")
+                server.conditions.append(condition)
+                if condition == ETAG:
+                    self.send_response(304)
+                    self.send_header("ETag", ETAG)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("ETag", ETAG)
+                self.send_header("Content-Length", str(len(BODY)))
+                self.end_headers()
+                self.wfile.write(BODY)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def server():
+    bootstrap.HttpClient.pool = bootstrap.HttpClient.ConnectionPool()
+    server = VendordataServer()
+    server.thread.start()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+    bootstrap.HttpClient.pool.close_all()
+
+
+def test_credentials_are_revalidated_in_memory_and_never_stored(tmp_path, server):
+    store_dir = tmp_path / "metadata"
+    cache = bootstrap.MetadataCache(store=bootstrap.HttpCache(str(store_dir), urls=()))
+    responses = [cache.get(server.url, refresh=attempt > 0) for attempt in range(3)]
+    assert server.conditions == [None, ETAG, ETAG]
+    assert [response.status for response in responses] == [200, 200, 200]
+    assert all(response.json() == {"platform_services": {"token": "secret"}} for response in responses)
+    assert not os.path.exists(str(store_dir))
+
+
+def test_a_new_cache_does_not_revalidate_credentials(tmp_path, server):
+    store = bootstrap.HttpCache(str(tmp_path / "metadata"), urls=())
+    bootstrap.MetadataCache(store=store).get(server.url)
+    bootstrap.MetadataCache(store=store).get(server.url)
+    assert server.conditions == [None, None]
@@ -0,0 +1,98 @@
+import subprocess
+
+import pytest
+
+import bootstrap
+
+STATUS = """\
+Package: amazon-ssm-agent-plugin
+Status: install ok installed
+Version: 1.0.0
+
+Package: amazon-ssm-agent
+Status: deinstall ok config-files
+Priority: optional
+Version: 3.2.100.0-1
+Description: Amazon SSM Agent
+ The agent of AWS Systems Manager.
+ Package: not-a-field
+
+Package: bash
+Status: install ok installed
+Version: 5.1-6
+"""
+
+
+@pytest.fixture
+def guest_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(bootstrap, "GUEST_ROOT", str(tmp_path))
+    return tmp_path
+
+
+def write_status(guest_root, text):
+    path = guest_root / bootstrap.PackageDatabase.dpkg_status_file.lstrip("/")
+    path.parent.mkdir(parents=True)
+    path.write_text(text)
+    return str(path)
+
+
+def test_a_removed_package_with_config_files_is_not_installed(guest_root):
+    path = write_status(guest_root, STATUS)
+    assert bootstrap.PackageDatabase.query("dpkg") == {"installed": False, "version": None, "source": path}
+
+
+def test_the_stanza_of_the_package_is_read_among_others(guest_root):
+    path = write_status(guest_root, STATUS.replace("deinstall ok config-files", "install ok installed"))
+    assert bootstrap.PackageDatabase.query("dpkg") == {"installed": True, "version": "3.2.100.0-1", "source": path}
+    assert bootstrap.PackageDatabase.query("dpkg", "bash")["version"] == "5.1-6"
+    assert bootstrap.PackageDatabase.query("dpkg", "missing-package")["installed"] is False
+
+
+def test_a_missing_status_file_cannot_be_read(guest_root):
+    assert bootstrap.PackageDatabase.query("dpkg") is None
+
+
+def test_an_unknown_database_is_not_queried():
+    assert bootstrap.PackageDatabase.query("apk") is None
+
+
+@pytest.fixture
+def rpm(monkeypatch):
+    commands = []
+    result = {}
+
+    def run_command(cmd, timeout=bootstrap.COMMAND_TIMEOUT, stream=False):
+        commands.append(cmd)
+        if "returncode" in result:
+            raise subprocess.CalledProcessError(result["returncode"], bootstrap.command_line(cmd), output=result["output"])
+        return result["output"]
+
+    monkeypatch.setattr(bootstrap.GuestOs.facts, "command_path", lambda prog: "/usr/bin/rpm" if prog == "rpm" else None)
+    monkeypatch.setattr(bootstrap, "run_command", run_command)
+    return commands, result
+
+
+def test_rpm_reports_the_installed_version(rpm):
+    commands, result = rpm
+    result.update(output="3.2.100.0-1\n")
+    assert bootstrap.PackageDatabase.query("rpm") == {"installed": True, "version": "3.2.100.0-1", "source": "rpmdb"}
+    assert commands == [["rpm", "-q", "--queryformat", "%{VERSION}-%{RELEASE}", "amazon-ssm-agent"]]
+
+
+@pytest.mark.parametrize(
+    "returncode, output, state",
+    [
+        (1, "package amazon-ssm-agent is not installed", {"installed": False, "version": None, "source": "rpmdb"}),
+        (1, "error: rpmdb open failed", None),
+        (127, "rpm: not found", None),
+    ],
+)
+def test_rpm_failures(rpm, returncode, output, state):
+    rpm[1].update(returncode=returncode, output=output)
+    assert bootstrap.PackageDatabase.query("rpm") == state
+
+
+def test_rpm_is_not_queried_without_the_command(rpm, monkeypatch):
+    monkeypatch.setattr(bootstrap.GuestOs.facts, "command_path", lambda prog: None)
+    assert bootstrap.PackageDatabase.query("rpm") is None
+    assert rpm[0] == []
@@ -0,0 +1,44 @@
+import threading
+import time
+
+import pytest
+
+import bootstrap
+
+
+@pytest.fixture
+def busy_dir(tmp_path):
+    stop = threading.Event()
+
+    def write():
+        index = 0
+        while not stop.is_set():
+            index += 1
+            with open(str(tmp_path / ("%d.log" % index)), "w") as f:
+                f.write("log line\n")
+            time.sleep(0.001)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    yield str(tmp_path)
+    stop.set()
+    writer.join()
+
+
+def test_checks_are_rate_limited_while_the_watched_directory_changes(monkeypatch, busy_dir):
+    checks = []
+    monkeypatch.setattr(bootstrap.GuestOs, "get_agent_information", staticmethod(lambda quiet=False: checks.append(time.time())))
+    waiter = bootstrap.RegistrationWaiter(timeout=1, poll_interval=0.25)
+    monkeypatch.setattr(waiter, "watch_dirs", (busy_dir,))
+    assert waiter.wait() is None
+    assert len(checks) <= 6
+    # The last check is made at the deadline, however close it is to the one before.
+    assert all(later - earlier >= 0.24 for earlier, later in zip(checks, checks[1:-1]))
+
+
+def test_registration_is_returned_once_the_agent_reports_it(monkeypatch, tmp_path):
+    answers = [None, {"InstanceId": "mi-0123456789abcdef0"}]
+    monkeypatch.setattr(bootstrap.GuestOs, "get_agent_information", staticmethod(lambda quiet=False: answers.pop(0)))
+    waiter = bootstrap.RegistrationWaiter(timeout=5, poll_interval=0.05)
+    monkeypatch.setattr(waiter, "watch_dirs", (str(tmp_path),))
+    assert waiter.wait() == {"InstanceId": "mi-0123456789abcdef0"}
@@ -0,0 +1,122 @@
+import json
+import os
+
+import pytest
+
+import shard_fleet
+
+STATIC_IPS = ["10.0.0.%d" % (10 + i) for i in range(1, 9)]
+NIC_IPS = ["10.1.0.%d" % (10 + i) for i in range(1, 17)]
+
+
+@pytest.fixture
+def module_dir(tmp_path):
+    module_dir = tmp_path / "module"
+    (module_dir / "modules").mkdir(parents=True)
+    for name in ("main.tf", "variables.tf", "terraform.tfvars", "terraform.tfstate"):
+        (module_dir / name).write_text("")
+    (module_dir / ".terraform").mkdir()
+    return str(module_dir)
+
+
+@pytest.fixture
+def values():
+    return {
+        "vm_count": 8,
+        "instance_base_name": "app",
+        "static_ips": STATIC_IPS,
+        "additional_nics": [{"network_name": "a"}, {"network_name": "b"}],
+        "add_nics_static_ips": NIC_IPS,
+    }
+
+
+def read_json(*parts):
+    with open(os.path.join(*parts)) as f:
+        return json.load(f)
+
+
+def test_split_places_every_vm_in_one_shard_with_its_addresses(tmp_path, module_dir, values):
+    out_dir = str(tmp_path / "shards")
+    manifest = shard_fleet.split(values, {}, 3, out_dir, module_dir=module_dir)
+    assert read_json(out_dir, shard_fleet.MANIFEST_NAME) == manifest
+    names = ["app-%02d" % (i + 1) for i in range(8)]
+    assert sorted(name for shard in manifest["shards"] for name in shard["instance_names"]) == names
+
+    for shard in manifest["shards"]:
+        tfvars = read_json(out_dir, shard["name"], shard_fleet.TFVARS_NAME)
+        assert tfvars["use_name_formatting"] is False
+        assert tfvars["vm_count"] == len(tfvars["instance_names"])
+        for vm_position, name in enumerate(tfvars["instance_names"]):
+            vm_index = names.index(name)
+            assert tfvars["static_ips"][vm_index] == STATIC_IPS[vm_index]
+            for nic_index in range(2):
+                assert tfvars["add_nics_static_ips"][nic_index * tfvars["vm_count"] + vm_position] == NIC_IPS[nic_index * 8 + vm_index]
+
+
+def test_split_keeps_vms_in_their_shard_when_the_fleet_grows(tmp_path, module_dir, values):
+    before = shard_fleet.split(values, {}, 4, str(tmp_path / "before"), module_dir=module_dir)
+    after = shard_fleet.split(dict(values, vm_count=20), {}, 4, str(tmp_path / "after"), module_dir=module_dir)
+    for old, new in zip(before["shards"], after["shards"]):
+        assert set(old["instance_names"]) <= set(new["instance_names"])
+
+
+def test_split_writes_a_working_directory_per_shard(tmp_path, module_dir, values):
+    out_dir = str(tmp_path / "shards")
+    shard_fleet.split(values, {}, 1, out_dir, module_dir=module_dir)
+    shard_dir = os.path.join(out_dir, "shard-00")
+    assert sorted(os.listdir(shard_dir)) == ["backend_override.tf", "main.tf", "modules", "terraform.tfvars.json", "variables.tf"]
+    assert os.path.realpath(os.path.join(shard_dir, "main.tf")) == os.path.realpath(os.path.join(module_dir, "main.tf"))
+    with open(os.path.join(shard_dir, shard_fleet.BACKEND_NAME)) as f:
+        assert f.read() == 'terraform {\n  backend "local" {\n    path = "%s"\n  }\n}\n' % os.path.join(os.path.abspath(shard_dir), "terraform.tfstate")
+
+
+def test_split_writes_the_backend_settings_of_each_shard(tmp_path, module_dir, values):
+    out_dir = str(tmp_path / "shards")
+    settings = [("bucket", "tfstate"), ("key", "fleet/{shard}.tfstate")]
+    shard_fleet.split(values, {}, 2, out_dir, "s3", settings, module_dir=module_dir)
+    with open(os.path.join(out_dir, "shard-01", shard_fleet.BACKEND_NAME)) as f:
+        assert f.read() == 'terraform {\n  backend "s3" {\n    bucket = "tfstate"\n    key = "fleet/shard-01.tfstate"\n  }\n}\n'
+
+
+def test_duplicate_vm_names_are_rejected():
+    with pytest.raises(ValueError, match="app-02"):
+        shard_fleet.vm_names({"use_name_formatting": False, "instance_names": ["app-01", "app-02", "app-02"]})
+
+
+def write_outputs(out_dir, manifest, reported=None):
+    for shard in manifest["shards"]:
+        names = shard["instance_names"] if reported is None else reported.get(shard["name"], [])
+        outputs = dict((output, {"sensitive": False, "type": "map", "value": {}}) for output in shard_fleet.OUTPUTS)
+        for name in names:
+            outputs["vm_ids"]["value"][name] = "id-%s" % name
+            outputs["primary_ips"]["value"][name] = "ip-%s" % name
+        with open(os.path.join(out_dir, shard["name"], shard_fleet.OUTPUTS_NAME), "w") as f:
+            json.dump(outputs, f)
+
+
+def test_merge_combines_the_shard_outputs(tmp_path, module_dir, values):
+    out_dir = str(tmp_path / "shards")
+    manifest = shard_fleet.split(values, {}, 3, out_dir, module_dir=module_dir)
+    write_outputs(out_dir, manifest)
+    merged = shard_fleet.merge(out_dir)
+    assert merged["vm_ids"] == dict(("app-%02d" % i, "id-app-%02d" % i) for i in range(1, 9))
+    hosts = shard_fleet.fleet_inventory(merged, "openstack")
+    assert [host["host"] for host in hosts] == ["ip-app-%02d" % i for i in range(1, 9)]
+
+
+def test_merge_rejects_a_vm_reported_by_another_shard(tmp_path, module_dir, values):
+    out_dir = str(tmp_path / "shards")
+    manifest = shard_fleet.split(values, {}, 2, out_dir, module_dir=module_dir)
+    first, second = manifest["shards"]
+    write_outputs(out_dir, manifest, {first["name"]: first["instance_names"] + second["instance_names"][:1]})
+    with pytest.raises(ValueError, match="not in %s" % first["name"]):
+        shard_fleet.merge(out_dir)
+
+
+def test_merge_reports_missing_vms(tmp_path, module_dir, values):
+    out_dir = str(tmp_path / "shards")
+    manifest = shard_fleet.split(values, {}, 2, out_dir, module_dir=module_dir)
+    first, second = manifest["shards"]
+    write_outputs(out_dir, manifest, {first["name"]: first["instance_names"], second["name"]: second["instance_names"][1:]})
+    with pytest.raises(ValueError, match=second["instance_names"][0]):
+        shard_fleet.merge(out_dir)